@@ -18,15 +18,208 @@
 #                 --DNSTarget foobar.com.au \
 #                 --stack_name ben-test-v1
 
+# Same, as a Route53 ALIAS (A record), which also works at the zone apex
+# ./PublishDNS.py --AWSRegion ap-southeast-2 \
+#                 --DNSTarget ninja.com.au \
+#                 --stackname ben-test-v1 \
+#                 --alias
+
+# Cut over with the TTL ramped down to 10secs first, then back after 5mins
+# ./PublishDNS.py --AWSRegion ap-southeast-2 \
+#                 --DNSTarget example.ninja.com.au \
+#                 --stackname ben-test-v2 \
+#                 --rampTTL 10 --soak 300
+
+# Move traffic over in steps, checking health between them
+# ./PublishDNS.py --AWSRegion ap-southeast-2 \
+#                 --DNSTarget example.ninja.com.au \
+#                 --stackname ben-test-v2 \
+#                 --shift 5,25,50,100 --dwell 300 \
+#                 --healthcheck 'curl -fs https://example.ninja.com.au/health'
+
+# From Python, without the CLI. Errors raise PublishError
+#   publisher = PublishDNS.Publisher('ap-southeast-2', alias_types=['A'],
+#                                    journal_file='.PublishDNS-journal.jsonl')
+#   publisher.publish('ben-test-v2', 'ninja.com.au')
+#   await publisher.publish_async('ben-api-v2', 'api.ninja.com.au')
+
+# Warm the new stack up with 500 requests, 20 at a time, and only cut over
+# once its p99 is within 1.5 times that of the stack the CNAME points at now
+# ./PublishDNS.py --AWSRegion ap-southeast-2 \
+#                 --DNSTarget example.ninja.com.au \
+#                 --stackname ben-test-v2 \
+#                 --warmup https://example.ninja.com.au/health \
+#                 --warmupRequests 500 --warmupConcurrency 20 --latencySLO 1.5
+
+# Undo the last run, a single publish or a whole manifest, in one
+# ChangeBatch per zone, from the --journal. list shows the runs in it
+# ./PublishDNS.py --AWSRegion ap-southeast-2 --rollback last
+# ./PublishDNS.py --AWSRegion ap-southeast-2 --rollback list
+# ./PublishDNS.py --AWSRegion ap-southeast-2 \
+#                 --rollback 20171101T093000.123-4242 \
+#                 --DNSTarget example.ninja.com.au
+
+# Daemon, publish each manifest entry when its stack completes a create/update
+# ./PublishDNS.py --AWSRegion ap-southeast-2 \
+#                 --watch cutover.yaml
+
+# Which hostnames point at ELBs that are gone, or at stacks being deleted?
+# ./PublishDNS.py --AWSRegion ap-southeast-2 \
+#                 --regions ap-southeast-2,us-east-1 \
+#                 --drift drift.json
+
+# Repeat publishes against a stack that hasn't changed, one describe_stacks
+# call. Load balancers are read from the stack's Outputs when it has
+# <prefix>DNSName and <prefix>CanonicalHostedZoneID ones (the prefix picked
+# with --elb), or from the Exports it makes named <stackname>-<key>
+# ./PublishDNS.py --AWSRegion ap-southeast-2 \
+#                 --DNSTarget example.ninja.com.au \
+#                 --stackname ben-test-v2 \
+#                 --stackcache .PublishDNS-stacks.json
+
+# Stacks without a load balancer of their own publish their ECS service (as
+# the load balancer in front of it), API Gateway custom domain or listener.
+# What could be published, and the --elb to pick each:
+# ./PublishDNS.py --AWSRegion ap-southeast-2 \
+#                 --stackname ben-ecs-v2 --listEndpoints
+
+# Batch cutover, many stacks -> CNAMEs in one run (YAML, JSON or CSV)
+# Stacks are looked up concurrently, AWSRegion defaults to --AWSRegion
+# ./PublishDNS.py --AWSRegion ap-southeast-2 \
+#                 --manifest cutover.yaml
+#
+#   cutover.yaml:
+#     - stackname: ben-test-v2
+#       DNSTarget: www.example.ninja.com.au
+#     - stackname: ben-api-v2
+#       DNSTarget: api.example.ninja.com.au
+#       AWSRegion: us-east-1
+#       elb: PublicNLB           # only if the stack has several
+#
+#   cutover.csv:
+#     stackname,DNSTarget
+#     ben-test-v2,www.example.ninja.com.au
+
 import argparse
-import boto3
+import asyncio
+import atexit
+import concurrent.futures
+import contextlib
+import csv
+import json
+import math
+import os
+import random
+import shlex
+import socket
+import ssl
+import struct
 import subprocess
 import sys
+import threading
 import time
+import urllib.parse
 
-# For DNS updates DNS to become visible, in local DNS
+# For DNS updates DNS to become visible, in local DNS, secs
 MAX_WAIT = 300
 
+# Route53 ChangeBatch limits. An UPSERT counts twice against both.
+R53_MAX_RECORDS_PER_BATCH = 1000
+R53_MAX_CHARS_PER_BATCH = 32000
+
+# DNS probing, seconds. Each round of queries backs off from
+# DNS_BACKOFF_BASE doubling up to DNS_BACKOFF_CAP, with jitter
+DNS_QUERY_TIMEOUT = 2.0
+DNS_BACKOFF_BASE = 0.25
+DNS_BACKOFF_CAP = 5.0
+DNS_TYPES = {'A': 1, 'NS': 2, 'CNAME': 5, 'AAAA': 28}
+
+# Route53 GetChange polling, seconds. Changes usually go INSYNC inside a
+# minute, once they have the confirmation probe only needs a moment
+R53_CHANGE_BACKOFF_BASE = 2.0
+R53_CHANGE_BACKOFF_CAP = 10.0
+CONFIRM_WAIT = 30
+
+# Concurrent stack discovery, also the size of each client's HTTP pool
+DISCOVERY_WORKERS = 16
+
+# Load balancers we can publish, and how many to describe per API call
+LB_RESOURCE_TYPES = ('AWS::ElasticLoadBalancing::LoadBalancer',
+                     'AWS::ElasticLoadBalancingV2::LoadBalancer')
+LB_DESCRIBE_BATCH = 20
+# describe_services takes at most this many services per call
+ECS_DESCRIBE_BATCH = 10
+
+# stack Outputs (or <stackname>-<key> Exports) that name a load balancer,
+# <prefix>DNSName with <prefix>CanonicalHostedZoneID, e.g. LoadBalancerDNSName
+OUTPUT_DNS_NAME = 'dnsname'
+OUTPUT_ZONE_IDS = ('canonicalhostedzoneid', 'canonicalhostedzonenameid',
+                   'hostedzoneid')
+
+# --rampTTL, how long to run on the short TTL before the original goes back
+RAMP_SOAK = 300
+
+# --drift, stacks in these states have taken, or are taking, their load
+# balancers with them. ROLLBACK_* is a create that failed
+GONE_STACK_STATUSES = ('DELETE_IN_PROGRESS', 'DELETE_FAILED', 'DELETE_COMPLETE',
+                       'ROLLBACK_IN_PROGRESS', 'ROLLBACK_FAILED',
+                       'ROLLBACK_COMPLETE')
+
+# --shift, secs to sit on each weight before the health check decides
+SHIFT_DWELL = 300
+
+# AWS error codes counted as throttling by the instrumentation
+THROTTLE_CODES = ('Throttling', 'ThrottlingException', 'PriorRequestNotComplete',
+                  'RequestLimitExceeded', 'TooManyRequestsException')
+
+# Route53 allows 5 requests/sec per account, shared by every client we
+# make. The limiter starts there, halves on a throttle and climbs back by
+# R53_RATE_STEP per good call. Retries, with jittered backoff from
+# R53_RETRY_BASE to R53_RETRY_CAP secs, come out of one shared budget.
+# Every R53_RETRY_EARN good calls earn a retry back, up to the full
+# budget, so a long --watch never runs it dry for good
+R53_RATE = 5.0
+R53_RATE_MIN = 0.5
+R53_RATE_STEP = 0.1
+R53_MAX_ATTEMPTS = 8
+R53_RETRY_BUDGET = 100
+R53_RETRY_EARN = 10
+R53_RETRY_BASE = 0.5
+R53_RETRY_CAP = 20.0
+
+# Every ChangeBatch sent, with what it replaced, is appended here as a JSON
+# line. --rollback puts the records back from it, without asking AWS
+JOURNAL_FILE = '.PublishDNS-journal.jsonl'
+
+# record set keys compact_record() has a place for, others go in its extra
+RECORD_SET_KEYS = ('Name', 'Type', 'TTL', 'ResourceRecords', 'AliasTarget',
+                   'SetIdentifier', 'Weight')
+
+# --warmup, synthetic load on the new load balancer before the cutover.
+# Requests per round, how many at once, rounds it has to meet the SLO in,
+# and secs a connect or request may take
+WARMUP_REQUESTS = 200
+WARMUP_CONCURRENCY = 10
+WARMUP_ROUNDS = 3
+HTTP_TIMEOUT = 5.0
+
+# The new stack's p99 may be LATENCY_SLO times the live one's, a p99 under
+# LATENCY_SLO_FLOOR secs always passes. Up to MAX_ERROR_RATE of requests may
+# fail, with a 4xx/5xx, a timeout or a connection error
+LATENCY_SLO = 1.5
+LATENCY_SLO_FLOOR = 0.05
+MAX_ERROR_RATE = 0.01
+
+# Latency histogram buckets, HISTOGRAM_GROWTH apart from HISTOGRAM_FLOOR secs
+HISTOGRAM_FLOOR = 0.0001
+HISTOGRAM_GROWTH = 1.05
+
+# --watch, secs between polls of the stack events
+WATCH_INTERVAL = 30
+
+# How long an on disk --zonecache stays fresh, in seconds
+ZONE_CACHE_TTL = 3600
+
 # Pretty Colours
 PINK = '\033[95m'
 BLUE = '\033[94m'
@@ -35,17 +228,36 @@ YELLOW = '\033[93m'
 RED = '\033[91m'
 ENDC = '\033[0m'
 
-# globals
-_AWS_region = None
-_boto_cfn = None
-_boto_ELB = None
+# globals. A publish's own options, its region, --journal and --stackcache
+# included, live on Publisher. What's here is process wide and shared by
+# every Publisher: the boto3 session, its clients and the Route53 limiter
+# (Route53 has one endpoint and one per account rate), the zone index and
+# its --zonecache file, the record, Exports and stack caches' contents,
+# the DNS backend, and logging and instrumentation
+_boto_clients = {}
+_boto_clients_lock = threading.Lock()
+_boto_session = None
 _boto_r53 = None
-_DNS_target = ""
-_DNS_suffix = ""
-_live_dns_record = None
-_print_elb_dns = True
+_dns_backend = None
+_event_log = None
+_exports = {}
+_exports_locks = {}
+_exports_lock = threading.Lock()
+_journal_lock = threading.Lock()
+_journal_seq = 0
+_metrics_file = None
+_metrics_lock = threading.Lock()
+_counters = {}
+_profile = False
 _show_debug = False
-_stack_name = ""
+_span_totals = {}
+_r53_limiter = None
+_r53_rate = R53_RATE
+_record_cache = {}
+_stack_caches = {}
+_stack_cache_lock = threading.Lock()
+_zone_cache_file = None
+_zone_index = None
 
 
 class DNSCNameRecord:
@@ -54,13 +266,234 @@ class DNSCNameRecord:
         self.name = name
         self.zoneid = None
         self.cname = None
+        self._cname_target = None
+        self.alias_zoneid = None
         self.ttl = None
         self.orignalttl = None
+        self.change_id = None
+        self.journal = None
+
+
+class R53ChangeTracker:
+    """Follows Route53 change ids through to INSYNC, timing each phase"""
+    def __init__(self, change_ids):
+        self.change_ids = list(change_ids)
+        self.phases = []
+
+    def wait_insync(self, max_wait):
+        with span('r53_insync', changes=len(self.change_ids)):
+            return self._wait_insync(max_wait)
+
+    def _wait_insync(self, max_wait):
+        start = time.time()
+        deadline = start + max_wait
+        pending = list(self.change_ids)
+        attempt = 0
+
+        while True:
+            pending = [c for c in pending
+                       if route53_client().get_change(Id=c)['ChangeInfo']['Status'] != 'INSYNC']
+            if not pending or time.time() >= deadline:
+                break
+
+            delay = backoff_delay(attempt, R53_CHANGE_BACKOFF_BASE,
+                                  R53_CHANGE_BACKOFF_CAP)
+            attempt += 1
+            progress('waiting on ' + str(len(pending)) + ' Route53 change(s) #'
+                     + str(attempt))
+            time.sleep(max(min(delay, deadline - time.time()), 0))
+
+        self.phases.append(('insync', time.time() - start))
+        if pending:
+            warning('Timeout waiting for Route53 change(s):' + ', '.join(pending))
+            return -1
+        return 0
+
+    def confirm(self, host, match, nameservers, max_wait, alias_type=None):
+        start = time.time()
+        with span('dns_confirm', host=host):
+            if alias_type is None:
+                ret = poll_for_cname_update(host, match, max_wait, nameservers)
+            else:
+                ret = poll_for_alias_update(host, alias_type, match, max_wait,
+                                            nameservers)
+        self.phases.append(('confirm', time.time() - start))
+        return ret
+
+    def report(self):
+        info('propagation: '
+             + ', '.join(name + ' %.1fs' % secs for name, secs in self.phases)
+             + ', total %.1fs' % sum(secs for _, secs in self.phases))
+
+
+class R53RateLimiter:
+    """Token bucket and retry budget shared by every Route53 call"""
+    def __init__(self, rate=R53_RATE, budget=R53_RETRY_BUDGET,
+                 max_attempts=R53_MAX_ATTEMPTS):
+        self.max_rate = rate
+        self.rate = rate
+        self.tokens = rate
+        self.budget = budget
+        self.max_budget = budget
+        self.good_calls = 0
+        self.max_attempts = max_attempts
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+        self.waited = 0.0
+        self.waits = 0
+        self.retries = 0
+
+    def acquire(self):
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.max_rate, self.tokens
+                                  + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    if waited:
+                        self.waited += waited
+                        self.waits += 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(R53_RATE_MIN, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + R53_RATE_STEP)
+            self.good_calls += 1
+            if self.good_calls % R53_RETRY_EARN == 0:
+                self.budget = min(self.max_budget, self.budget + 1)
+
+    # secs to sleep before retrying, None when the call has had its go
+    def retry_delay(self, attempts):
+        with self.lock:
+            if attempts >= self.max_attempts or self.budget <= 0:
+                return None
+            self.budget -= 1
+            self.retries += 1
+        return backoff_delay(attempts - 1, R53_RETRY_BASE, R53_RETRY_CAP)
+
+    # botocore hooks, registered on each Route53 client. request-created
+    # fires per HTTP attempt, needs-retry after each attempt's response
+    def on_request(self, **kwargs):
+        waited = self.acquire()
+        if waited:
+            count('r53_limiter_waits', 'route53')
+            emit_event('r53_limiter_wait', secs=round(waited, 3))
+
+    def on_response(self, response=None, attempts=1, caught_exception=None,
+                    **kwargs):
+        import botocore.exceptions
+        if caught_exception is not None:
+            if not isinstance(caught_exception,
+                              (botocore.exceptions.ConnectionError,
+                               botocore.exceptions.HTTPClientError)):
+                return None
+        elif response is not None:
+            code = response[1].get('Error', {}).get('Code')
+            if code in THROTTLE_CODES:
+                self.throttled()
+            elif response[0].status_code < 500:
+                if code is None:
+                    self.succeeded()
+                return None
+        else:
+            return None
+
+        delay = self.retry_delay(attempts)
+        if delay is None:
+            warning('Route53 giving up after ' + str(attempts) + ' attempt(s), '
+                    + str(self.budget) + ' retries left in the budget')
+        return delay
+
+
+class LatencyHistogram:
+    """Streaming latency histogram. Buckets grow by HISTOGRAM_GROWTH, so
+    percentiles are good to a few percent from a few hundred counters,
+    however many requests are recorded"""
+    def __init__(self, floor=HISTOGRAM_FLOOR, growth=HISTOGRAM_GROWTH):
+        self.floor = floor
+        self.growth = growth
+        self.buckets = {}
+        self.count = 0
+        self.errors = 0
+
+    # a failed request counts as an error, not a latency
+    def record(self, secs, ok=True):
+        self.count += 1
+        if not ok:
+            self.errors += 1
+            return
+        bucket = 0
+        if secs > self.floor:
+            bucket = int(math.log(secs / self.floor) / math.log(self.growth)) + 1
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    # secs, the top of the bucket the p'th percentile is in. None if no
+    # request succeeded
+    def percentile(self, p):
+        total = self.count - self.errors
+        if total == 0:
+            return None
+        rank = max(math.ceil(total * p / 100.0), 1)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return self.floor * self.growth ** bucket
+
+    def error_rate(self):
+        return self.errors / float(self.count) if self.count else 1.0
+
+    def summary(self):
+        p50 = self.percentile(50)
+        p99 = self.percentile(99)
+        return '%d requests, p50 %s, p99 %s, %.1f%% errors' % (
+            self.count, '-' if p50 is None else '%.1fms' % (p50 * 1000),
+            '-' if p99 is None else '%.1fms' % (p99 * 1000),
+            self.error_rate() * 100)
+
+
+class PublishError(Exception):
+    """A publish that can't go on. The CLI prints it and exits 1"""
+
+
+class StackError(PublishError):
+    """The stack isn't there, isn't COMPLETE or has no usable ELB"""
+
+
+class ZoneError(PublishError):
+    """No hosted zone in this account for the record"""
+
 
+class Route53Error(PublishError):
+    """Route53 rejected a change, or didn't get it INSYNC in time"""
 
-def bail(message):
-    print(RED + message.replace('<message text>', message) + ENDC)
-    sys.exit(1)
+
+class DNSTimeoutError(PublishError):
+    """A name didn't resolve, or a change didn't show in DNS, in time"""
+
+
+class HealthCheckError(PublishError):
+    """--shift's health check failed and traffic was rolled back"""
+
+
+class ManifestError(PublishError):
+    """The manifest can't be read or has bad entries"""
+
+
+# give up on the publish, the caller (the CLI in main()) reports it
+def bail(message, error=PublishError):
+    raise error(message)
 
 
 def warning(message):
@@ -80,12 +513,128 @@ def debug(message):
         print(GREEN + 'debug::' + str(message) + ENDC)
 
 
+# one JSON object per line to --eventlog, if there is one
+def emit_event(event, **fields):
+    if _event_log is None:
+        return
+    fields['event'] = event
+    fields['ts'] = round(time.time(), 3)
+    with _metrics_lock:
+        _event_log.write(json.dumps(fields, sort_keys=True) + '\n')
+        _event_log.flush()
+
+
+def count(name, label, amount=1):
+    with _metrics_lock:
+        _counters[(name, label)] = _counters.get((name, label), 0) + amount
+
+
+# time a phase of the publish, totals feed --profile and --metrics
+@contextlib.contextmanager
+def span(name, **fields):
+    emit_event('span_start', span=name, **fields)
+    start = time.time()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        secs = time.time() - start
+        with _metrics_lock:
+            total = _span_totals.setdefault(name, [0, 0.0])
+            total[0] += 1
+            total[1] += secs
+        emit_event('span_end', span=name, secs=round(secs, 4), ok=ok, **fields)
+
+
+# botocore event hooks: after-call fires once per API call, request-created
+# once per HTTP attempt and needs-retry after each attempt's response
+def count_aws_call(event_name, **kwargs):
+    count('aws_calls', '.'.join(event_name.split('.')[1:3]))
+
+
+def count_aws_attempt(event_name, **kwargs):
+    count('aws_attempts', '.'.join(event_name.split('.')[1:3]))
+
+
+def count_aws_throttle(event_name, response=None, **kwargs):
+    if response is None or response[1] is None:
+        return None
+    if response[1].get('Error', {}).get('Code') in THROTTLE_CODES:
+        operation = '.'.join(event_name.split('.')[1:3])
+        count('aws_throttles', operation)
+        emit_event('aws_throttle', operation=operation)
+    return None
+
+
+def write_metrics_file(path):
+    lines = []
+    with _metrics_lock:
+        for (name, label), value in sorted(_counters.items()):
+            lines.append('publishdns_' + name + '_total{operation="' + label
+                         + '"} ' + str(value))
+        for name, (calls, secs) in sorted(_span_totals.items()):
+            lines.append('publishdns_phase_seconds{phase="' + name + '"} '
+                         + '%.4f' % secs)
+            lines.append('publishdns_phase_count{phase="' + name + '"} '
+                         + str(calls))
+        if _r53_limiter is not None:
+            lines.append('publishdns_r53_limiter_wait_seconds_total '
+                         + '%.4f' % _r53_limiter.waited)
+            lines.append('publishdns_r53_limiter_rate '
+                         + '%.2f' % _r53_limiter.rate)
+            lines.append('publishdns_r53_retry_budget_remaining '
+                         + str(_r53_limiter.budget))
+
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_file, path)
+
+
+def print_profile():
+    info('phase                       count      secs')
+    for name, (calls, secs) in sorted(_span_totals.items(),
+                                      key=lambda i: -i[1][1]):
+        info('%-26s %6d %9.3f' % (name, calls, secs))
+
+    calls = dict((label, v) for (n, label), v in _counters.items()
+                 if n == 'aws_calls')
+    retries = sum(v for (n, _), v in _counters.items() if n == 'aws_attempts') \
+        - sum(calls.values())
+    throttles = sum(v for (n, _), v in _counters.items() if n == 'aws_throttles')
+    info('AWS API calls:' + str(sum(calls.values())) + ' retries:'
+         + str(max(retries, 0)) + ' throttles:' + str(throttles))
+    for label in sorted(calls):
+        info('  %-38s %4d' % (label, calls[label]))
+    if _r53_limiter is not None:
+        info('Route53 limiter: waited %.2fs over %d call(s), rate now %.1f/s, '
+             '%d retries used, %d left' % (_r53_limiter.waited,
+                                          _r53_limiter.waits, _r53_limiter.rate,
+                                          _r53_limiter.retries,
+                                          _r53_limiter.budget))
+
+
+# at exit, errors included
+def finish_instrumentation():
+    if _metrics_file is not None:
+        write_metrics_file(_metrics_file)
+    if _profile:
+        print_profile()
+    if _event_log is not None and _event_log is not sys.stdout:
+        _event_log.close()
+
+
+# the process wide settings go to globals, the publish options into the
+# Publisher returned with the parsed args
 def parsecommandline():
-    global _AWS_region
-    global _stack_name
-    global _DNS_target
     global _show_debug
-    global _print_elb_dns
+    global _zone_cache_file
+    global _event_log
+    global _metrics_file
+    global _profile
+    global _r53_rate
+    global _dns_backend
 
     parser = argparse.ArgumentParser(description='Utilitiy to add/update an '
                                      'AWS Route53 CNAME to point to a'
@@ -103,8 +652,14 @@ def parsecommandline():
                         help="true for debug")
     parser.add_argument('--stackname',
                         default=None,
-                        required=True,
+                        required=False,
                         help='Name of the CFN stack, MUST have one ELB')
+    parser.add_argument('--elb',
+                        default=None,
+                        required=False,
+                        help='Which load balancer, ECS service, API Gateway '
+                        'domain or listener to publish when the stack has '
+                        'several: logical id, name or ARN')
     parser.add_argument('--DNSTarget',
                         default=None,
                         required=False,
@@ -115,29 +670,276 @@ def parsecommandline():
                         default=False,
                         required=False,
                         help='No changes. Just output DNS name of the ELB')
+    parser.add_argument('--listEndpoints',
+                        action='store_const',
+                        const=True,
+                        default=False,
+                        required=False,
+                        help='No changes. List every endpoint in --stackname '
+                        'that could be published, one JSON object a line')
+    parser.add_argument('--manifest',
+                        default=None,
+                        required=False,
+                        help='YAML, JSON or CSV file of stackname/DNSTarget '
+                        'pairs, published as one ChangeBatch per zone')
+    parser.add_argument('--zonecache',
+                        default=None,
+                        required=False,
+                        help='file to cache the hosted zone list in, reused '
+                        'for ' + str(ZONE_CACHE_TTL) + ' secs')
+    parser.add_argument('--stackcache',
+                        default=None,
+                        required=False,
+                        help='file to keep each stack\'s load balancer in, '
+                        'reused until the stack is updated')
+    parser.add_argument('--alias',
+                        nargs='?',
+                        const='A',
+                        default=None,
+                        required=False,
+                        help='Publish a Route53 ALIAS to the load balancer '
+                        'instead of a CNAME, A (default), AAAA or A,AAAA. '
+                        'Works at the zone apex')
+    parser.add_argument('--rampTTL',
+                        type=int,
+                        default=None,
+                        required=False,
+                        help='Lower an existing CNAME to this TTL (secs) and '
+                        'wait out the old TTL before the cutover')
+    parser.add_argument('--soak',
+                        type=int,
+                        default=RAMP_SOAK,
+                        required=False,
+                        help='With --rampTTL, secs on the short TTL after '
+                        'the cutover before the original TTL is put back')
+    parser.add_argument('--statefile',
+                        default=None,
+                        required=False,
+                        help='With --rampTTL, where progress is kept so an '
+                        'interrupted ramp can be rerun and resume')
+    parser.add_argument('--shift',
+                        default=None,
+                        required=False,
+                        help='Move traffic over gradually with weighted '
+                        'records, percent steps for the new stack e.g. '
+                        '5,25,50,100')
+    parser.add_argument('--dwell',
+                        type=int,
+                        default=SHIFT_DWELL,
+                        required=False,
+                        help='With --shift, secs to stay on each step')
+    parser.add_argument('--healthcheck',
+                        default=None,
+                        required=False,
+                        help='With --shift, command run after each step, '
+                        'a non zero exit rolls traffic back. Not run by a '
+                        'shell, use sh -c \'...\' for pipes')
+    parser.add_argument('--shiftFrom',
+                        default=None,
+                        required=False,
+                        help='With --shift, the stack traffic moves off, '
+                        'defaults to wherever the CNAME points now')
+    parser.add_argument('--journal',
+                        default=JOURNAL_FILE,
+                        required=False,
+                        help='Append every Route53 change, and the records '
+                        'it replaced, to this file, default ' + JOURNAL_FILE)
+    parser.add_argument('--rollback',
+                        default=None,
+                        required=False,
+                        help='Put back the records a run changed, from the '
+                        '--journal: a run id, last, or list to see them. '
+                        'With --DNSTarget just that record')
+    parser.add_argument('--eventlog',
+                        default=None,
+                        required=False,
+                        help='Append a JSON line per phase and AWS throttle '
+                        'to this file, - for stdout')
+    parser.add_argument('--metrics',
+                        default=None,
+                        required=False,
+                        help='Write phase timings and AWS call counts here, '
+                        'Prometheus textfile format')
+    parser.add_argument('--profile',
+                        action='store_const',
+                        const=True,
+                        default=False,
+                        required=False,
+                        help='Print time spent per phase and AWS calls made')
+    parser.add_argument('--readyPort',
+                        type=int,
+                        default=None,
+                        required=False,
+                        help='Before publishing, wait until every address of '
+                        'the ELB takes TCP connections on this port')
+    parser.add_argument('--warmup',
+                        default=None,
+                        required=False,
+                        help='Before publishing, GET this URL from the new '
+                        'load balancer (its host sent as the Host) until it '
+                        'is as fast as the live target, see --latencySLO')
+    parser.add_argument('--warmupRequests',
+                        type=int,
+                        default=WARMUP_REQUESTS,
+                        required=False,
+                        help='With --warmup, requests per round, default '
+                        + str(WARMUP_REQUESTS))
+    parser.add_argument('--warmupConcurrency',
+                        type=int,
+                        default=WARMUP_CONCURRENCY,
+                        required=False,
+                        help='With --warmup, requests at once, default '
+                        + str(WARMUP_CONCURRENCY))
+    parser.add_argument('--latencySLO',
+                        type=float,
+                        default=LATENCY_SLO,
+                        required=False,
+                        help='With --warmup, the new p99 may be this times '
+                        'the live p99, default ' + str(LATENCY_SLO))
+    parser.add_argument('--maxErrorRate',
+                        type=float,
+                        default=MAX_ERROR_RATE,
+                        required=False,
+                        help='With --warmup, fraction of requests that may '
+                        'fail, default ' + str(MAX_ERROR_RATE))
+    parser.add_argument('--watch',
+                        default=None,
+                        required=False,
+                        help='Run as a daemon: watch the stacks in this '
+                        'manifest and publish each one when it reaches '
+                        'CREATE_COMPLETE or UPDATE_COMPLETE')
+    parser.add_argument('--R53Rate',
+                        type=float,
+                        default=R53_RATE,
+                        required=False,
+                        help='Most Route53 requests/sec to make, shared by '
+                        'every call in the run (default 5, the AWS limit)')
+    parser.add_argument('--drift',
+                        default=None,
+                        required=False,
+                        help='Check every Route53 record pointing at an ELB '
+                        'against the live stacks, JSON report to this file, '
+                        '- for stdout. With --manifest, records are also '
+                        'checked against it')
+    parser.add_argument('--regions',
+                        default=None,
+                        required=False,
+                        help='--drift, comma separated regions to look for '
+                        'load balancers in, defaults to --AWSRegion')
+    parser.add_argument('--dnsBackend',
+                        default='inprocess',
+                        choices=('inprocess', 'dig'),
+                        required=False,
+                        help='How DNS is looked up and probed, in process '
+                        '(default) or by running getent and dig')
+    parser.add_argument('--noconfirm',
+                        action='store_const',
+                        const=True,
+                        default=False,
+                        required=False,
+                        help='Trust Route53 INSYNC, skip asking the name '
+                        'servers for the new CNAME')
 
     args = parser.parse_args()
-    _AWS_region = args.AWSRegion
-    _stack_name = args.stackname
-    _DNS_target = args.DNSTarget
+    if args.manifest is None and args.stackname is None and args.watch is None \
+            and args.drift is None and args.rollback is None:
+        parser.error('one of --stackname, --manifest, --watch, --drift or '
+                     '--rollback is required')
+    if args.listEndpoints and args.stackname is None:
+        parser.error('--listEndpoints lists the endpoints of one --stackname')
     _show_debug = args.debug
-    _print_elb_dns = args.GetELBDNS
-
-
+    _zone_cache_file = args.zonecache
+    _metrics_file = args.metrics
+    _profile = args.profile
+    if args.R53Rate < R53_RATE_MIN:
+        parser.error('--R53Rate is at least ' + str(R53_RATE_MIN))
+    _r53_rate = args.R53Rate
+    _dns_backend = DNS_BACKENDS[args.dnsBackend]()
+    if args.regions is not None:
+        args.regions = [r.strip() for r in args.regions.split(',') if r.strip()]
+    else:
+        args.regions = [args.AWSRegion]
+    if args.eventlog == '-':
+        _event_log = sys.stdout
+    elif args.eventlog is not None:
+        _event_log = open(args.eventlog, 'a')
+    if _event_log is not None or _metrics_file is not None or _profile:
+        atexit.register(finish_instrumentation)
+
+    if args.warmup is not None:
+        if args.manifest is not None or args.watch is not None or args.GetELBDNS:
+            parser.error('--warmup is for publishing one --stackname')
+        if urllib.parse.urlsplit(args.warmup).scheme not in ('http', 'https'):
+            parser.error('--warmup takes an http:// or https:// URL')
+        if args.warmupRequests < 1 or args.warmupConcurrency < 1:
+            parser.error('--warmupRequests and --warmupConcurrency are at least 1')
+    # a manifest, and each --watch publish, is one hard flip per record
+    if (args.manifest is not None or args.watch is not None) and (
+            args.rampTTL is not None or args.shift is not None
+            or args.dwell != SHIFT_DWELL or args.healthcheck is not None
+            or args.shiftFrom is not None):
+        parser.error('--rampTTL, --shift, --dwell, --healthcheck and '
+                     '--shiftFrom are for publishing one --stackname')
+    if args.rampTTL is not None and args.alias is not None:
+        parser.error('--rampTTL is for CNAMEs, an ALIAS has no TTL')
+    shift_weights = None
+    if args.shift is not None:
+        if args.alias is not None or args.rampTTL is not None:
+            parser.error('--shift can not be used with --alias or --rampTTL')
+        try:
+            shift_weights = [int(w) for w in args.shift.split(',')]
+        except ValueError:
+            parser.error('--shift takes percents, e.g. 5,25,50,100')
+        if shift_weights != sorted(set(shift_weights)) \
+                or shift_weights[0] < 1 or shift_weights[-1] > 100:
+            parser.error('--shift percents go up, from 1 to 100')
+        if shift_weights[-1] != 100:
+            shift_weights.append(100)
+    alias_types = None
+    if args.alias is not None:
+        alias_types = [t.strip().upper() for t in args.alias.split(',')]
+        if not set(alias_types) <= set(('A', 'AAAA')):
+            parser.error('--alias takes A, AAAA or A,AAAA')
+
+    return args, Publisher(args.AWSRegion,
+                           elb_selector=args.elb,
+                           alias_types=alias_types,
+                           ready_port=args.readyPort,
+                           confirm=not args.noconfirm,
+                           ramp_ttl=args.rampTTL,
+                           ramp_soak=args.soak,
+                           ramp_state_file=args.statefile,
+                           shift_weights=shift_weights,
+                           shift_dwell=args.dwell,
+                           shift_healthcheck=args.healthcheck,
+                           shift_from=args.shiftFrom,
+                           warmup_url=args.warmup,
+                           warmup_requests=args.warmupRequests,
+                           warmup_concurrency=args.warmupConcurrency,
+                           latency_slo=args.latencySLO,
+                           max_error_rate=args.maxErrorRate,
+                           journal_file=args.journal,
+                           stack_cache_file=args.stackcache)
+
+
+# run a command without a shell. A string is split the way a shell would
+# split it, but pipes, redirects and $VARS are not expanded. Returns the
+# output, or -1 if it could not be run or exited non zero
 def run_os_command(to_run):
     try:
-        p = subprocess.Popen(to_run,
-                             shell=True,
+        args = shlex.split(to_run) if isinstance(to_run, str) else list(to_run)
+        p = subprocess.Popen(args,
                              stdout=subprocess.PIPE,
                              stderr=subprocess.PIPE)
 
-        ph_ret = p.wait()
-        ph_ret = p.returncode
+        # communicate() drains both pipes, a wait() first can block forever
+        # once the command fills one
         ph_outb, ph_err = p.communicate()
+        ph_ret = p.returncode
         ph_out = str(ph_outb.decode("utf-8"))
 
         if p.returncode != 0:
-            warning(to_run +
+            warning(str(to_run) +
                     " returned an error: " +
                     str(ph_ret) + " " +
                     str(ph_err) + " " +
@@ -148,281 +950,2447 @@ def run_os_command(to_run):
             debug(ph_out)
             return ph_out
 
-    except:
-        bail(str(to_run) + " failed: ")
+    except (OSError, ValueError) as e:
+        warning(str(to_run) + " failed: " + str(e))
         return -1
 
 
-def do_boto_setup():
-    global _AWS_region
-    global _boto_cfn
-    global _boto_ELB
+# one client per (service, region), all from one shared session. Clients
+# are thread safe, creating them from the session isn't, hence the lock.
+# boto3 is only imported here, importing PublishDNS stays cheap
+def get_boto_client(service, region):
+    global _boto_session
+
+    with _boto_clients_lock:
+        if (service, region) not in _boto_clients:
+            if _boto_session is None:
+                import boto3
+                _boto_session = boto3.session.Session()
+                _boto_session.events.register('after-call', count_aws_call)
+                _boto_session.events.register('request-created',
+                                              count_aws_attempt)
+                _boto_session.events.register('needs-retry',
+                                              count_aws_throttle)
+            _boto_clients[(service, region)] = make_boto_client(service,
+                                                                region)
+        return _boto_clients[(service, region)]
+
+
+# Route53 clients leave retrying to the shared limiter, botocore's own
+# retries would go round it
+def make_boto_client(service, region):
+    global _r53_limiter
+    import botocore.config
+
+    if service != 'route53':
+        return _boto_session.client(
+            service, region_name=region,
+            config=botocore.config.Config(
+                max_pool_connections=DISCOVERY_WORKERS))
+
+    if _r53_limiter is None:
+        _r53_limiter = R53RateLimiter(_r53_rate)
+    client = _boto_session.client(
+        service, region_name=region,
+        config=botocore.config.Config(
+            max_pool_connections=DISCOVERY_WORKERS,
+            retries={'mode': 'standard', 'total_max_attempts': 1}))
+    client.meta.events.register('request-created', _r53_limiter.on_request)
+    client.meta.events.register('needs-retry', _r53_limiter.on_response)
+    return client
+
+
+# Route53 has one endpoint, every publish in the process shares the client
+def route53_client():
     global _boto_r53
 
-    _boto_cfn = boto3.client('cloudformation', region_name=_AWS_region)
-    _boto_ELB = boto3.client('elb', region_name=_AWS_region)
-    _boto_r53 = boto3.client('route53', region_name=_AWS_region)
+    if _boto_r53 is None:
+        _boto_r53 = get_boto_client('route53', 'us-east-1')
+    return _boto_r53
 
-    for con in _boto_cfn, _boto_ELB, _boto_r53:
-        if con is None:
-            bail("boto failed in AWS Region:" + str(_AWS_region))
 
-    return True
+# read the --zonecache file, None if there isn't one or it's stale
+def read_zone_cache(cache_file, max_age):
+    try:
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if time.time() - cache.get('created', 0) > max_age:
+        debug('zone cache is stale:' + cache_file)
+        return None
+
+    return cache.get('zones')
+
+
+# write via a temp file, so readers never see half a file
+def write_json_file(path, data):
+    tmp_file = path + '.tmp'
+    try:
+        with open(tmp_file, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_file, path)
+    except (IOError, OSError) as e:
+        warning('unable to write:' + path + ' ' + str(e))
+        return -1
+    return 0
+
+
+def write_zone_cache(cache_file, zones):
+    write_json_file(cache_file, {'created': time.time(), 'zones': zones})
+
+
+# zone name -> HostedZoneID for every zone in the account, built once per run
+def load_zone_index():
+    global _zone_index
+
+    if _zone_index is not None:
+        return _zone_index
+
+    if _zone_cache_file is not None:
+        _zone_index = read_zone_cache(_zone_cache_file, ZONE_CACHE_TTL)
+        if _zone_index is not None:
+            debug('using zone cache:' + _zone_cache_file)
+            return _zone_index
+
+    zones = {}
+    private = set()
+    for page in route53_client().get_paginator('list_hosted_zones').paginate():
+        for i in page['HostedZones']:
+            name = i['Name'].lower()
+            is_private = i.get('Config', {}).get('PrivateZone', False)
+            # a public zone wins over a private one of the same name
+            if name in zones and (is_private or name not in private):
+                continue
+            zones[name] = i['Id'].replace('/hostedzone/', '')
+            if is_private:
+                private.add(name)
+            else:
+                private.discard(name)
+
+    debug('indexed ' + str(len(zones)) + ' hosted zones')
+    _zone_index = zones
+    if _zone_cache_file is not None:
+        write_zone_cache(_zone_cache_file, zones)
+
+    return _zone_index
 
 
 # Give me a domain name, I'll respond with the AWS HostedZoneID
 def get_r53_zoneid(domain):
-    global _boto_r53
-
     if domain[-1] != '.':
         domain += '.'
 
-    for i in _boto_r53.list_hosted_zones()['HostedZones']:
-        if i['Name'] == domain:
-            return i['Id'].replace('/hostedzone/', '')
+    return load_zone_index().get(domain.lower(), -1)
+
+
+# the most specific hosted zone holding name, (zone name, zone id) or -1
+def find_r53_zone(name):
+    zones = load_zone_index()
+    labels = name.rstrip('.').lower().split('.')
+
+    for i in range(0, len(labels)):
+        zone_name = '.'.join(labels[i:]) + '.'
+        if zone_name in zones:
+            return zone_name.rstrip('.'), zones[zone_name]
 
     return -1
 
 
+# a record set as (ttl, values, alias target, weight, extra), a lot smaller
+# than the dict boto hands back when a whole zone is held in memory. extra
+# is anything else (health checks, failover..) as JSON, usually None
+def compact_record(rrs):
+    alias = rrs.get('AliasTarget')
+    extra = dict((k, v) for k, v in rrs.items() if k not in RECORD_SET_KEYS)
+    if alias and alias.get('EvaluateTargetHealth'):
+        extra['AliasTarget'] = {'EvaluateTargetHealth': True}
+    return (rrs.get('TTL'),
+            tuple(r['Value'] for r in rrs.get('ResourceRecords', [])),
+            (alias['HostedZoneId'], alias['DNSName']) if alias else None,
+            rrs.get('Weight'),
+            json.dumps(extra, sort_keys=True) if extra else None)
+
+
+# compact_record() back to the ResourceRecordSet it came from
+def record_set(name, rtype, set_id, compact):
+    ttl, values, alias, weight, extra = compact
+    rrs = {'Name': name, 'Type': rtype}
+    if set_id is not None:
+        rrs['SetIdentifier'] = set_id
+    if weight is not None:
+        rrs['Weight'] = weight
+    if alias is not None:
+        rrs['AliasTarget'] = {'HostedZoneId': alias[0], 'DNSName': alias[1],
+                              'EvaluateTargetHealth': False}
+    else:
+        rrs['TTL'] = ttl
+        rrs['ResourceRecords'] = [{'Value': v} for v in values]
+    for key, value in json.loads(extra or '{}').items():
+        if key == 'AliasTarget':
+            rrs['AliasTarget'].update(value)
+        else:
+            rrs[key] = value
+    return rrs
+
+
+# read every record in a zone, one paginated pass, into _record_cache as
+# (name, type) -> {set id: compact_record()}
+def load_zone_records(zone_id):
+    records = {}
+
+    pages = route53_client().get_paginator('list_resource_record_sets').paginate(
+        HostedZoneId=zone_id)
+    for page in pages:
+        for rrs in page['ResourceRecordSets']:
+            key = (sys.intern(rrs['Name'].lower()), rrs['Type'])
+            records.setdefault(key, {})[rrs.get('SetIdentifier')] = compact_record(rrs)
+
+    debug('cached ' + str(len(records)) + ' record names for zone ' + zone_id)
+    _record_cache[zone_id] = records
+    return records
+
+
+# Cache the zone when reading it whole is cheaper than the lookups that are
+# coming, one per name. A page holds 300 record sets
+def prefetch_zone_records(zone_id, lookups):
+    if zone_id in _record_cache:
+        return 0
+    zone = route53_client().get_hosted_zone(Id=zone_id)['HostedZone']
+    if lookups > zone.get('ResourceRecordSetCount', 0) // 300 + 1:
+        load_zone_records(zone_id)
+    return 0
+
+
+# exact name and type lookup, {set id: compact_record()}, {} if there's none.
+# Unweighted records have set id None
+def lookup_r53_records(zone_id, name, rtype):
+    name = name.lower()
+
+    if zone_id in _record_cache:
+        return _record_cache[zone_id].get((name, rtype), {})
+
+    sets = {}
+    args = {'HostedZoneId': zone_id, 'StartRecordName': name,
+            'StartRecordType': rtype, 'MaxItems': '1'}
+    while True:
+        ret = route53_client().list_resource_record_sets(**args)
+        for rrs in ret['ResourceRecordSets']:
+            if rrs['Name'].lower() != name or rrs['Type'] != rtype:
+                return sets
+            sets[rrs.get('SetIdentifier')] = compact_record(rrs)
+
+        # more sets (weighted etc) of the same name and type follow
+        if not ret.get('IsTruncated') or ret.get('NextRecordName', '').lower() != name \
+                or ret.get('NextRecordType') != rtype:
+            return sets
+        args['StartRecordIdentifier'] = ret['NextRecordIdentifier']
+
+
 # construct and send back a DNSCNameRecord Object
 def get_r53_cname_rec(dns_rec):
-    global _boto_r53
-
-    name = dns_rec.name + '.'
-    res = _boto_r53.list_resource_record_sets(
-        HostedZoneId=dns_rec.zoneid,
-        StartRecordType="CNAME",
-        StartRecordName=name)['ResourceRecordSets']
-
-    for record in res:
-        if record["Name"] == name:
-            dns_rec._cname_target = record['ResourceRecords'][-1]['Value']
-            dns_rec.ttl = record["TTL"]
-            dns_rec.orignalttl = record["TTL"]
+    sets = lookup_r53_records(dns_rec.zoneid, dns_rec.name + '.', 'CNAME')
+
+    for set_id in sorted(sets, key=lambda i: (i is not None, i)):
+        ttl, values = sets[set_id][:2]
+        if values:
+            dns_rec._cname_target = values[-1]
+            dns_rec.ttl = ttl
+            dns_rec.orignalttl = ttl
             return 0
 
     return(-1)
 
 
-def get_stack_status(stack_name):
-    global _AWS_region
-    global _boto_cfn
+def get_stack_status(stack_name, region):
+    cfn = get_boto_client('cloudformation', region)
 
     try:
-        stk = _boto_cfn.describe_stacks(StackName=stack_name)
+        stk = cfn.describe_stacks(StackName=stack_name)
         if stk['Stacks'][-1]['StackName'] == stack_name:
             return stk['Stacks'][-1]['StackStatus']
 
-    except _boto_cfn.exceptions.ClientError as e:
-        if e.response['Error']['Message'] == "Stack with id " + _stack_name + " does not exist":
+    except cfn.exceptions.ClientError as e:
+        if e.response['Error']['Message'] == "Stack with id " + stack_name + " does not exist":
             bail("unable to find stack:"
                  + stack_name
                  + " ,in region:"
-                 + _AWS_region)
+                 + str(region), StackError)
 
     bail("Internal Error in def StackStatus."
          "Failed to parse the error output from cloudformation via boto")
 
 
-# TODO a) does this work, b) is it used, c) should be used?
+# same CNAME target, new TTL
 def set_r53_ttl(dns_rec, updated_ttl):
-    global _DNS_suffix
-
     info(dns_rec.name +
          ' DNS TTL is ' +
-         dns_rec.ttl +
+         str(dns_rec.ttl) +
          'secs, changing to ' +
          str(updated_ttl) + 'secs')
 
-    ret = _boto_r53.get_zone(_DNS_suffix).update_cname(
-        dns_rec.name
-        + "." + _DNS_suffix
-        + ".", dns_rec._cname_target,
-        ttl=int(updated_ttl),
-        identifier=None,
-        comment='was:'+str(dns_rec.orignalttl) + 'setdown')
-    if 'Status:PENDING' in str(ret):
-        return 0
+    CB = {
+        'Comment': 'PublishDNS.py was:' + str(dns_rec.orignalttl) + ' setdown',
+        'Changes': [cname_change(dns_rec.name + '.', dns_rec._cname_target,
+                                 int(updated_ttl))]
+    }
+
+    ret = send_change_batch(dns_rec.zoneid, CB, journal=dns_rec.journal)
+
+    dns_rec.ttl = int(updated_ttl)
+    dns_rec.change_id = ret['ChangeInfo']['Id']
+    return 0
+
+
+def wait_until(when, why):
+    remaining = when - time.time()
+    if remaining > 0:
+        progress('waiting ' + str(int(remaining + 0.5)) + 'secs for ' + why)
+        time.sleep(remaining)
+
+
+def wait_for_change(dns_rec):
+    if R53ChangeTracker([dns_rec.change_id]).wait_insync(MAX_WAIT) == -1:
+        bail('Route53 has not synced the change to:' + dns_rec.name, Route53Error)
+
+
+# the saved ramp for this record and target, None to start a new one
+def read_ttl_ramp_state(state_file, name, cname_target):
+    try:
+        with open(state_file, 'r') as f:
+            state = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if state.get('name') != name or state.get('target') != cname_target:
+        warning('ignoring ' + state_file + ', it is a ramp for '
+                + str(state.get('name')) + ' -> ' + str(state.get('target')))
+        return None
+
+    return state
+
+
+# Lower the TTL, wait out the old one, cut over on the short TTL, soak,
+# then put the original TTL back. Every step is saved in state_file, so
+# an interrupted ramp rerun with the same arguments carries on
+def ttl_ramp_cutover(dns_rec, cname_target, short_ttl, soak, state_file):
+    state = read_ttl_ramp_state(state_file, dns_rec.name, cname_target)
+    if state is None:
+        state = {'name': dns_rec.name,
+                 'target': cname_target,
+                 'old_target': dns_rec._cname_target,
+                 'original_ttl': dns_rec.orignalttl,
+                 'short_ttl': short_ttl,
+                 'phase': 'start'}
+        # saved before anything changes, so a rerun after an interrupted
+        # lowering never takes the short TTL for the original
+        write_json_file(state_file, state)
     else:
-        return 1
+        info('resuming TTL ramp for ' + dns_rec.name + ' after:' + state['phase'])
+        dns_rec.orignalttl = state['original_ttl']
+
+    if state['phase'] == 'start':
+        if dns_rec.ttl > short_ttl:
+            if set_r53_ttl(dns_rec, short_ttl) != 0:
+                bail('unable to lower the TTL on:' + dns_rec.name, Route53Error)
+            wait_for_change(dns_rec)
+        state['phase'] = 'lowered'
+        state['lowered_at'] = time.time()
+        write_json_file(state_file, state)
+
+    if state['phase'] == 'lowered':
+        # resolvers may hold the old TTL from just before it was lowered,
+        # nothing to wait for if it was already as short
+        if state['original_ttl'] > state['short_ttl']:
+            wait_until(state['lowered_at'] + state['original_ttl'],
+                       'the old ' + str(state['original_ttl']) + 'sec TTL to expire')
+        update_r53(dns_rec, cname_target, state['short_ttl'])
+        wait_for_change(dns_rec)
+        state['phase'] = 'flipped'
+        state['flipped_at'] = time.time()
+        write_json_file(state_file, state)
+
+    if state['phase'] == 'flipped':
+        wait_until(state['flipped_at'] + soak, 'the soak')
+        dns_rec._cname_target = cname_target
+        dns_rec.ttl = state['short_ttl']
+        if set_r53_ttl(dns_rec, state['original_ttl']) != 0:
+            bail('unable to restore the TTL on:' + dns_rec.name
+                 + ', rerun to retry', Route53Error)
+        wait_for_change(dns_rec)
+
+    os.remove(state_file)
+    info(dns_rec.name + ' TTL ramp done, TTL back to '
+         + str(state['original_ttl']) + 'secs')
+    return 0
 
 
-def update_r53(dns_rec, updated_cname):
-    global _boto_r53
-    global _DNS_suffix
+def record_key(rrs):
+    return (rrs['Name'].lower().rstrip('.') + '.', rrs['Type'],
+            rrs.get('SetIdentifier'))
+
+
+# the record sets changes will replace or delete, as they are now, by
+# record_key(). None for those that don't exist yet
+def snapshot_records(zone_id, changes):
+    keys = [record_key(c['ResourceRecordSet']) for c in changes]
+    names = sorted(set(k[:2] for k in keys))
+    if len(names) > 2:
+        prefetch_zone_records(zone_id, len(names))
+
+    previous = {}
+    for name, rtype in names:
+        sets = lookup_r53_records(zone_id, name, rtype)
+        for key in keys:
+            if key[:2] == (name, rtype):
+                previous[key] = record_set(name, rtype, key[2], sets[key[2]]) \
+                    if key[2] in sets else None
+    return previous
+
+
+class JournalRun:
+    """The --journal lines of one publish, one per ChangeBatch: the run it
+    was part of, the change id, and each change with the record set it
+    replaced. --rollback undoes a run in one go, so every publish makes its
+    own and concurrent ones, e.g. from --watch, never share one"""
+    def __init__(self, path):
+        global _journal_seq
+
+        now = time.time()
+        with _journal_lock:
+            _journal_seq += 1
+            seq = _journal_seq
+        self.path = path
+        self.run = time.strftime('%Y%m%dT%H%M%S', time.localtime(now)) \
+            + '.%03d-%d-%d' % (int(now * 1000) % 1000, os.getpid(), seq)
+        self.written = 0
+
+    def write(self, zone_id, change_id, changes, previous):
+        entry = {'run': self.run, 'ts': round(time.time(), 3),
+                 'zone_id': zone_id, 'change_id': change_id,
+                 'changes': [{'action': c['Action'],
+                              'record': c['ResourceRecordSet'],
+                              'previous': previous.get(record_key(c['ResourceRecordSet']))}
+                             for c in changes]}
+        with _journal_lock:
+            try:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(entry, sort_keys=True) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+                self.written += 1
+            except (IOError, OSError) as e:
+                warning('unable to write the journal:' + self.path + ' ' + str(e))
+
+    # once the publish is done, how to undo it
+    def report(self):
+        if self.written:
+            info('journaled as run ' + self.run + ', undo with --rollback '
+                 + self.run)
+
+
+# a JournalRun for one publish, None without a --journal
+def new_journal_run(journal_file):
+    if journal_file is None:
+        return None
+    return JournalRun(journal_file)
+
+
+# every record change goes through here, the zone's cached records are
+# dropped as they're now out of date. With a JournalRun what's there now is
+# read first, unless the caller knows, previous as from snapshot_records()
+def send_change_batch(zone_id, change_batch, previous=None, journal=None):
+    if journal is not None and previous is None:
+        previous = snapshot_records(zone_id, change_batch['Changes'])
+
+    ret = route53_client().change_resource_record_sets(HostedZoneId=zone_id,
+                                                       ChangeBatch=change_batch)
+    _record_cache.pop(zone_id, None)
+    if ret['ResponseMetadata']['HTTPStatusCode'] != 200 or ret['ChangeInfo']['Status'] != "PENDING":
+        bail("AWS rejected update:" + str(ret), Route53Error)
+
+    if journal is not None:
+        journal.write(zone_id, ret['ChangeInfo']['Id'], change_batch['Changes'],
+                      previous)
+    return ret
+
+
+# a single CNAME UPSERT, as it sits in a ChangeBatch
+def cname_change(record, cname_target, ttl=60, action='UPSERT'):
+    return {
+        'Action': action,
+        'ResourceRecordSet': {
+            'Name': record,
+            'Type': 'CNAME',
+            'TTL': ttl,
+            'ResourceRecords': [{'Value': cname_target}]
+        }
+    }
+
+
+def alias_change(record, dns_name, alias_zone_id, rtype='A'):
+    return {
+        'Action': 'UPSERT',
+        'ResourceRecordSet': {
+            'Name': record,
+            'Type': rtype,
+            'AliasTarget': {
+                'HostedZoneId': alias_zone_id,
+                'DNSName': dns_name,
+                'EvaluateTargetHealth': False
+            }
+        }
+    }
+
+
+# ALIAS UPSERTs for a record, a CNAME of the same name can't coexist with
+# them so when get_r53_cname_rec() found one it's deleted in the same batch
+def alias_changes(dns_rec, dns_name, alias_zone_id, rtypes):
+    record = dns_rec.name + '.'
+    changes = []
+
+    if dns_rec._cname_target is not None:
+        changes.append(cname_change(record, dns_rec._cname_target,
+                                    dns_rec.ttl, action='DELETE'))
+    for rtype in rtypes:
+        changes.append(alias_change(record, dns_name, alias_zone_id, rtype))
+
+    return changes
+
+
+def update_r53_alias(dns_rec, dns_name, alias_zone_id, rtypes):
+    info('updating DNS ALIAS(' + ','.join(rtypes) + '):' + dns_rec.name
+         + ' to point to:' + dns_name)
+
+    CB = {
+        'Comment': 'PublishDNS.py',
+        'Changes': alias_changes(dns_rec, dns_name, alias_zone_id, rtypes)
+    }
+
+    ret = send_change_batch(dns_rec.zoneid, CB, journal=dns_rec.journal)
+    info("AWS requestid:" + str(ret['ResponseMetadata']['RequestId']))
+
+    # update object, it's not a CNAME any more
+    dns_rec._cname_target = None
+    dns_rec.alias_zoneid = alias_zone_id
+    dns_rec.change_id = ret['ChangeInfo']['Id']
+    return 0
+
+
+def weighted_cname_change(record, cname_target, set_id, weight, ttl=60,
+                          action='UPSERT'):
+    change = cname_change(record, cname_target, ttl, action)
+    change['ResourceRecordSet']['SetIdentifier'] = set_id
+    change['ResourceRecordSet']['Weight'] = weight
+    return change
+
+
+# send the changes and wait until they are INSYNC
+def apply_r53_changes(dns_rec, changes):
+    change_ids = update_r53_batch(dns_rec.zoneid, changes,
+                                  journal=dns_rec.journal)
+    dns_rec.change_id = change_ids[-1]
+    return R53ChangeTracker(change_ids).wait_insync(MAX_WAIT)
+
+
+# Move a CNAME from its current (blue) target to green_target a step at a
+# time, with a weighted record for each. After every step and dwell secs
+# the healthcheck command is run, if it fails traffic goes back to blue.
+# Ends as a plain CNAME on whichever side won
+def weighted_shift(dns_rec, green_target, green_id, blue_target, blue_id,
+                   weights, dwell, healthcheck=None):
+    record = dns_rec.name + '.'
+    ttl = dns_rec.ttl or 60
+    weight = 0
+
+    def weighted_pair(green_weight, action='UPSERT'):
+        return [weighted_cname_change(record, blue_target, blue_id,
+                                      100 - green_weight, ttl, action),
+                weighted_cname_change(record, green_target, green_id,
+                                      green_weight, ttl, action)]
+
+    # a plain and a weighted CNAME can't share a name, swap in one batch
+    changes = []
+    if dns_rec._cname_target is not None:
+        changes.append(cname_change(record, dns_rec._cname_target,
+                                    dns_rec.ttl, action='DELETE'))
+    if apply_r53_changes(dns_rec, changes + weighted_pair(0)) == -1:
+        bail('Route53 has not synced the weighted records for:' + dns_rec.name,
+             Route53Error)
+
+    for weight in weights:
+        progress('shifting ' + dns_rec.name + ': ' + str(weight) + '% to '
+                 + green_id + ', ' + str(100 - weight) + '% to ' + blue_id)
+        if apply_r53_changes(dns_rec, weighted_pair(weight)) == -1:
+            bail('Route53 has not synced the weights for:' + dns_rec.name,
+                 Route53Error)
+
+        wait_until(time.time() + dwell, 'the dwell at ' + str(weight) + '%')
+        if healthcheck is not None and run_os_command(healthcheck) == -1:
+            warning('health check failed at ' + str(weight) + '%, '
+                    'rolling ' + dns_rec.name + ' back to ' + blue_id)
+            changes = weighted_pair(weight, 'DELETE') + \
+                [cname_change(record, blue_target, ttl)]
+            if apply_r53_changes(dns_rec, changes) == -1:
+                bail('Route53 has not synced the rollback for:' + dns_rec.name,
+                     Route53Error)
+            dns_rec._cname_target = blue_target
+            return -1
+
+    changes = weighted_pair(weight, 'DELETE') + \
+        [cname_change(record, green_target, ttl)]
+    if apply_r53_changes(dns_rec, changes) == -1:
+        bail('Route53 has not synced the change to:' + dns_rec.name, Route53Error)
+    dns_rec._cname_target = green_target
+    return 0
+
+
+def update_r53(dns_rec, updated_cname, ttl=60):
     record = dns_rec.name + "."
     _cname_target = updated_cname + '.'
     info('updating DNS CNAME:' + record + ' to point to:' + _cname_target)
 
     CB = {
         'Comment': 'PublishDNS.py',
-        'Changes': [{
-            'Action': 'UPSERT',
-            'ResourceRecordSet': {
-                'Name': record,
-                'Type': 'CNAME',
-                'TTL': 60,
-                'ResourceRecords': [{'Value': updated_cname}]
-            }
-        }]
+        'Changes': [cname_change(record, updated_cname, ttl)]
     }
 
-    ret = _boto_r53.change_resource_record_sets(HostedZoneId=dns_rec.zoneid,
-                                                ChangeBatch=CB)
-    if ret['ResponseMetadata']['HTTPStatusCode'] != 200 or ret['ChangeInfo']['Status'] != "PENDING":
-        bail("AWS rejected update:" + str(ret))
-
+    ret = send_change_batch(dns_rec.zoneid, CB, journal=dns_rec.journal)
     info("AWS requestid:" + str(ret['ResponseMetadata']['RequestId']))
 
     # update object
     dns_rec._cname_target = _cname_target
+    dns_rec.change_id = ret['ChangeInfo']['Id']
     return 0
 
 
-# TODO: The loop can be too short (TTL things)
-def poll_for_resolve(host, max_loop):
+async def tcp_connectable(addr, port, timeout):
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(addr, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    return True
+
+
+# resolve host through the DNS backend with backoff until max_wait secs,
+# and with a port until every address it resolves to takes a TCP
+# connection. Returns the addresses, or None
+async def probe_ready(host, max_wait, port=None):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max_wait
+    attempt = 0
+
+    while True:
+        addrs = await dns_backend().resolve(host, port)
+
+        if addrs and port is None:
+            return addrs
+        if addrs:
+            timeout = min(DNS_QUERY_TIMEOUT, max(deadline - loop.time(), 0.1))
+            up = await asyncio.gather(*[tcp_connectable(a, port, timeout)
+                                        for a in addrs])
+            if all(up):
+                return addrs
+            debug(host + ' not reachable on port ' + str(port) + ':'
+                  + ', '.join(a for a, ok in zip(addrs, up) if not ok))
+
+        if loop.time() >= deadline:
+            return None
+        delay = min(backoff_delay(attempt), deadline - loop.time())
+        attempt += 1
+        progress('polling for resolution on:' + host + " #" + str(attempt))
+        await asyncio.sleep(max(delay, 0))
+
+
+# hosts that weren't ready inside max_wait secs, [] when they all were
+def poll_for_resolve_many(hosts, max_wait, port=None):
+    async def probe_all():
+        return await asyncio.gather(*[probe_ready(h, max_wait, port)
+                                      for h in hosts])
+
+    failed = []
+    for host, addrs in zip(hosts, asyncio.run(probe_all())):
+        if addrs is None:
+            warning('Timeout waiting for resolution on hostname:' + host)
+            failed.append(host)
+        else:
+            info('confirm: ' + host + ' now resolvable'
+                 + ('' if port is None else ' and reachable on ' + str(port))
+                 + ': ' + ', '.join(addrs))
+
+    return failed
+
+
+# wait up to max_wait secs for host to resolve, and take connections on
+# port if one is given
+def poll_for_resolve(host, max_wait, port=None):
     progress('polling for resolution on:' + host)
-    if sys.platform == "darwin":
-        command = "/usr/bin/dscacheutil -q host -a name"
-    else:
-        command = "getent hosts"
+    if poll_for_resolve_many([host], max_wait, port):
+        return -1
+    return 0
 
-    for i in range(0, int(max_loop)):
-        ret = run_os_command(command + " " + host + " | grep -i " + host)
-        if ret != -1:
-            info('confirm: ' + host + ' now resolvable')
-            return 0
 
-        progress('polling for resolution on:' + host + " #" + str(i))
-        time.sleep(10)
+# one request on an open connection, returns (status, keep alive). The body
+# is read and dropped, by Content-Length, chunks, or to the end
+async def http_exchange(reader, writer, request):
+    writer.write(request)
+    await writer.drain()
+
+    status_line = await reader.readline()
+    parts = status_line.split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith(b'HTTP/') or not parts[1].isdigit():
+        raise ValueError('bad HTTP status line: ' + repr(status_line))
+    status = int(parts[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip().lower()
+    keep_alive = parts[0] != b'HTTP/1.0' and headers.get('connection') != 'close'
+
+    if headers.get('transfer-encoding') == 'chunked':
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            await reader.readexactly(size + 2)
+    elif 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+    elif status >= 200 and status not in (204, 304):
+        await reader.read()
+        keep_alive = False
+
+    return status, keep_alive
+
+
+# GET url requests times, concurrency at once over kept alive connections
+# spread across addrs. url's host goes in the Host header and SNI, so the
+# load balancer is asked just as it will be once it's live
+async def drive_load(url, addrs, requests, concurrency, timeout=HTTP_TIMEOUT):
+    parts = urllib.parse.urlsplit(url)
+    https = parts.scheme == 'https'
+    port = parts.port or (443 if https else 80)
+    path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+    request = ('GET ' + path + ' HTTP/1.1\r\n'
+               'Host: ' + parts.netloc.rpartition('@')[2] + '\r\n'
+               'User-Agent: PublishDNS-warmup\r\n'
+               'Accept: */*\r\n\r\n').encode('latin-1')
+    ssl_context = ssl.create_default_context() if https else None
+    histogram = LatencyHistogram()
+    loop = asyncio.get_running_loop()
+    remaining = [requests]
+
+    async def worker(addr):
+        conn = None
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            start = loop.time()
+            try:
+                if conn is None:
+                    conn = await asyncio.wait_for(asyncio.open_connection(
+                        addr, port, ssl=ssl_context,
+                        server_hostname=parts.hostname if https else None),
+                        timeout)
+                status, keep_alive = await asyncio.wait_for(
+                    http_exchange(conn[0], conn[1], request), timeout)
+                histogram.record(loop.time() - start, status < 400)
+            except (OSError, EOFError, ValueError, asyncio.TimeoutError) as e:
+                debug('warmup ' + addr + ': ' + repr(e))
+                histogram.record(loop.time() - start, False)
+                keep_alive = False
+            if not keep_alive and conn is not None:
+                conn[1].close()
+                conn = None
+        if conn is not None:
+            conn[1].close()
+
+    await asyncio.gather(*[worker(addrs[i % len(addrs)])
+                           for i in range(concurrency)])
+    return histogram
+
+
+# why green doesn't meet the SLO against live, [] when it does. Without a
+# live baseline only the error rate is checked
+def slo_failures(green, live, slo=LATENCY_SLO, max_error_rate=MAX_ERROR_RATE,
+                 floor=LATENCY_SLO_FLOOR):
+    failed = []
+    if green.error_rate() > max_error_rate:
+        failed.append('%.1f%% of requests failed' % (green.error_rate() * 100))
+
+    green_p99 = green.percentile(99)
+    live_p99 = live.percentile(99) if live is not None else None
+    if green_p99 is not None and live_p99 is not None \
+            and green_p99 > max(live_p99 * slo, floor):
+        failed.append('p99 %.1fms, over %s times live\'s %.1fms'
+                      % (green_p99 * 1000, slo, live_p99 * 1000))
+    return failed
+
+
+# load green_host (and live_host, once, for the baseline) with url until
+# green meets the SLO, up to rounds times. Returns [] if it did, or why not
+def warmup_gate(url, green_host, live_host=None, requests=WARMUP_REQUESTS,
+                concurrency=WARMUP_CONCURRENCY, slo=LATENCY_SLO,
+                max_error_rate=MAX_ERROR_RATE, rounds=WARMUP_ROUNDS):
+    parts = urllib.parse.urlsplit(url)
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+
+    async def run():
+        green_addrs = await dns_backend().resolve(green_host, port)
+        if not green_addrs:
+            return [green_host + ' does not resolve']
+
+        live = None
+        live_addrs = []
+        if live_host is not None:
+            live_addrs = await dns_backend().resolve(live_host.rstrip('.'), port)
+        if live_addrs:
+            live = await drive_load(url, live_addrs, requests, concurrency)
+            info('warmup live  ' + live_host.rstrip('.') + ': ' + live.summary())
+            emit_event('warmup', target='live', requests=live.count,
+                       errors=live.errors, p50=live.percentile(50),
+                       p99=live.percentile(99))
+        else:
+            warning('no live target to compare latency with, checking '
+                    'errors only')
+
+        for attempt in range(1, rounds + 1):
+            green = await drive_load(url, green_addrs, requests, concurrency)
+            info('warmup green ' + green_host + ' #' + str(attempt) + ': '
+                 + green.summary())
+            emit_event('warmup', target='green', round=attempt,
+                       requests=green.count, errors=green.errors,
+                       p50=green.percentile(50), p99=green.percentile(99))
+            failed = slo_failures(green, live, slo, max_error_rate)
+            if not failed:
+                return []
+            warning('warmup #' + str(attempt) + ': ' + '; '.join(failed))
+        return failed
+
+    return asyncio.run(run())
+
+
+# a DNS question on the wire, RD set only when asking a recursive resolver
+def dns_query_packet(qid, name, rtype, recurse=False):
+    flags = 0x0100 if recurse else 0
+    packet = struct.pack('>HHHHHH', qid, flags, 1, 0, 0, 0)
+    for label in name.rstrip('.').split('.'):
+        packet += struct.pack('B', len(label)) + label.encode('ascii')
+    return packet + struct.pack('>BHH', 0, DNS_TYPES[rtype], 1)
+
+
+# read a (possibly compressed) name at offset, returns (name, next offset).
+# ValueError if it runs off the end of the packet
+def dns_read_name(data, offset):
+    labels = []
+    next_offset = None
+
+    for _ in range(0, 128):
+        if offset >= len(data):
+            raise ValueError('truncated DNS name')
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            if offset + 2 > len(data):
+                raise ValueError('truncated DNS name')
+            if next_offset is None:
+                next_offset = offset + 2
+            offset = struct.unpack('>H', data[offset:offset + 2])[0] & 0x3FFF
+        elif length == 0:
+            name = '.'.join(labels) + '.'
+            return name, (offset + 1 if next_offset is None else next_offset)
+        else:
+            if offset + 1 + length > len(data):
+                raise ValueError('truncated DNS name')
+            labels.append(data[offset + 1:offset + 1 + length].decode('ascii'))
+            offset += 1 + length
+
+    raise ValueError('DNS name compression loop')
+
+
+# the answer section as [(type, value)], [] for NXDOMAIN or no data.
+# ValueError for a failure or a reply that's truncated, TC bit set or not
+def dns_parse_response(data):
+    qid, flags, qdcount, ancount = struct.unpack('>HHHH', data[:8])
+    if flags & 0x000F not in (0, 3):
+        raise ValueError('DNS server failure, rcode:' + str(flags & 0x000F))
+    if flags & 0x0200:
+        raise ValueError('DNS reply truncated')
+
+    offset = 12
+    for _ in range(0, qdcount):
+        offset = dns_read_name(data, offset)[1] + 4
+
+    type_names = dict((v, k) for k, v in DNS_TYPES.items())
+    answers = []
+    for _ in range(0, ancount):
+        offset = dns_read_name(data, offset)[1]
+        rtype, rclass, ttl, rdlength = struct.unpack('>HHIH', data[offset:offset + 10])
+        offset += 10
+        if offset + rdlength > len(data):
+            raise ValueError('truncated DNS answer')
+        rdata = data[offset:offset + rdlength]
+        if rtype in (DNS_TYPES['CNAME'], DNS_TYPES['NS']):
+            value = dns_read_name(data, offset)[0]
+        elif rtype == DNS_TYPES['A']:
+            value = socket.inet_ntop(socket.AF_INET, rdata)
+        elif rtype == DNS_TYPES['AAAA']:
+            value = socket.inet_ntop(socket.AF_INET6, rdata)
+        else:
+            value = None
+        if rtype in type_names:
+            answers.append((type_names[rtype], value))
+        offset += rdlength
 
-    warning('Timeout waiting for resolution on hostname:' + host)
-    return -1
+    return answers
 
 
-def poll_for_cname_update(host, match, max_wait):
-    progress('polling for CNAME resolution :' + host)
+class DNSProbeProtocol(asyncio.DatagramProtocol):
+    """Waits for the one UDP reply that matches our query id"""
+    def __init__(self, qid, future):
+        self.qid = qid
+        self.future = future
 
-    for i in range(0, int(max_wait)):
-        ret = run_os_command('dig +short -t CNAME ' + host)
-        if ret == -1:
-            bail("internal error failure with dig command in"
-                 " poll_for_cname_update")
+    def datagram_received(self, data, addr):
+        if len(data) >= 12 and struct.unpack('>H', data[:2])[0] == self.qid \
+                and not self.future.done():
+            self.future.set_result(data)
 
-        if ret.rstrip().lower() == match.lower() + '.':
-            debug('CNAME match:' + host + '  => ' + match)
-            return 0
+    def error_received(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc)
 
-        time.sleep(10)
-        info('polling for CNAME resolution:' + host + " #" + str(i))
 
-    info('Timeout waiting for resolution on CNAME:' + host)
-    return -1
+# ask one server (ip, port) directly, None if it didn't give a usable answer
+async def dns_query(server, name, rtype, timeout, recurse=False):
+    loop = asyncio.get_running_loop()
+    qid = random.randint(0, 0xFFFF)
+    future = loop.create_future()
+
+    try:
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: DNSProbeProtocol(qid, future), remote_addr=server)
+    except OSError as e:
+        debug('DNS query to ' + str(server) + ' failed:' + str(e))
+        return None
 
+    try:
+        transport.sendto(dns_query_packet(qid, name, rtype, recurse))
+        return dns_parse_response(await asyncio.wait_for(future, timeout))
+    except (asyncio.TimeoutError, OSError, ValueError, struct.error) as e:
+        debug('DNS query to ' + str(server) + ' for ' + name + ' failed:' + repr(e))
+        return None
+    finally:
+        transport.close()
+
+
+class InProcessDNS:
+    """The default DNS backend: getaddrinfo and our own UDP queries, nothing
+    is forked and nothing needs to be installed"""
+    name = 'inprocess'
+
+    # the addresses host resolves to, [] if it doesn't
+    async def resolve(self, host, port=None):
+        loop = asyncio.get_running_loop()
+        try:
+            infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        except (socket.gaierror, UnicodeError):
+            return []
+        return sorted(set(i[4][0] for i in infos))
+
+    # one server's answers as [(type, value)], None if it didn't answer
+    async def query(self, server, name, rtype, timeout, recurse=False):
+        return await dns_query(server, name, rtype, timeout, recurse)
+
+    # what a resolver has for host, CNAME chain and addresses, for people
+    async def show(self, host):
+        lines = []
+        for server in system_nameservers():
+            for rtype in ('A', 'AAAA'):
+                answers = await self.query(server, host, rtype,
+                                           DNS_QUERY_TIMEOUT, recurse=True)
+                for answer in answers or []:
+                    line = '%-6s %s' % answer
+                    if line not in lines:
+                        lines.append(line)
+            if lines:
+                return ';; SERVER: ' + server[0] + '\n' + '\n'.join(lines)
+        return ';; no answer for ' + host
+
+
+class DigDNS(InProcessDNS):
+    """Fallback DNS backend that runs getent and dig, argument lists only,
+    never through a shell"""
+    name = 'dig'
+
+    async def run(self, args):
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            debug(args[0] + ' failed:' + str(e))
+            return None
+        out, _ = await proc.communicate()
+        if proc.returncode != 0:
+            return None
+        return out.decode('utf-8', 'replace')
+
+    async def resolve(self, host, port=None):
+        out = await self.run(['getent', 'ahosts', host])
+        return sorted(set(line.split()[0] for line in (out or '').splitlines()
+                          if line.strip()))
+
+    async def query(self, server, name, rtype, timeout, recurse=False):
+        args = ['dig', '+noall', '+answer', '+tries=1',
+                '+time=' + str(max(int(timeout), 1)),
+                '+recurse' if recurse else '+norecurse',
+                '-p', str(server[1]), '@' + server[0], '-t', rtype, name]
+        out = await self.run(args)
+        if out is None:
+            return None
+
+        answers = []
+        # name ttl class type value
+        for fields in (line.split() for line in out.splitlines()):
+            if len(fields) >= 5 and fields[3] in DNS_TYPES:
+                answers.append((fields[3], fields[4]))
+        return answers
+
+    async def show(self, host):
+        return await self.run(['dig', host]) or ';; dig failed for ' + host
+
+
+DNS_BACKENDS = dict((b.name, b) for b in (InProcessDNS, DigDNS))
+
+
+def dns_backend():
+    global _dns_backend
+
+    if _dns_backend is None:
+        _dns_backend = InProcessDNS()
+    return _dns_backend
+
+
+# exponential backoff with jitter, attempt counts from 0
+def backoff_delay(attempt, base=DNS_BACKOFF_BASE, cap=DNS_BACKOFF_CAP):
+    delay = min(cap, base * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def cname_matches(answers, match):
+    if not answers:
+        return False
+    return any(rtype == 'CNAME' and value.rstrip('.').lower() == match
+               for rtype, value in answers)
+
+
+# query every server each round until matches() accepts all their answers,
+# returns the servers still not agreeing when max_wait (secs) ran out,
+# [] is success
+async def probe_record(host, rtype, matches, nameservers, max_wait,
+                       recurse=False):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max_wait
+    pending = list(nameservers)
+    attempt = 0
+
+    while True:
+        timeout = min(DNS_QUERY_TIMEOUT, max(deadline - loop.time(), 0.1))
+        answers = await asyncio.gather(*[
+            dns_backend().query(ns, host, rtype, timeout, recurse)
+            for ns in pending])
+        pending = [ns for ns, ans in zip(pending, answers) if not matches(ans)]
+        if not pending or loop.time() >= deadline:
+            return pending
+
+        delay = min(backoff_delay(attempt), deadline - loop.time())
+        attempt += 1
+        debug(rtype + ' ' + host + ' not yet on ' + str(len(pending))
+              + ' server(s), next probe in ' + '%.2f' % delay + 's')
+        await asyncio.sleep(max(delay, 0))
+
+
+# the recursive resolvers this host uses
+def system_nameservers():
+    servers = []
+    try:
+        with open('/etc/resolv.conf', 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == 'nameserver':
+                    servers.append((fields[1], 53))
+    except (IOError, OSError):
+        pass
 
-# parse and validate the dns suffix (aka hosted_zone_name)
-def parse_dns_suffix(_DNS_target):
-    global _boto_r53
+    return servers
 
-    hosted_zone_name = ".".join(_DNS_target.split(".")[1:])
 
-    if get_r53_zoneid(hosted_zone_name) == -1:
-        warning("Not a hosted zone for this AWS account")
+# the Route53 name servers (ip, 53) for a public hosted zone
+def get_r53_nameservers(zone_id):
+    zone = route53_client().get_hosted_zone(Id=zone_id)
+    servers = []
+    for ns in zone.get('DelegationSet', {}).get('NameServers', []):
+        try:
+            servers.append((socket.gethostbyname(ns), 53))
+        except socket.gaierror:
+            warning('unable to resolve Route53 name server:' + ns)
+
+    return servers
+
+
+# poll until every nameserver answers host with CNAME match, max_wait is
+# in seconds. With no nameservers given the local resolvers are asked
+def poll_for_cname_update(host, match, max_wait, nameservers=None):
+    progress('polling for CNAME resolution :' + host)
+
+    recurse = nameservers is None
+    if nameservers is None:
+        nameservers = system_nameservers()
+    if not nameservers:
+        warning('no DNS servers to poll for CNAME:' + host)
         return -1
 
-    return hosted_zone_name
+    match = match.rstrip('.').lower()
+    pending = asyncio.run(probe_record(host, 'CNAME',
+                                       lambda ans: cname_matches(ans, match),
+                                       nameservers, max_wait, recurse))
+    if not pending:
+        debug('CNAME match:' + host + '  => ' + match)
+        return 0
+
+    info('Timeout waiting for resolution on CNAME:' + host + ' from '
+         + ', '.join(ns[0] for ns in pending))
+    return -1
 
 
-def get_first_elb_from_stack(stack_name):
-    global _boto_cfn
-    sr = _boto_cfn.list_stack_resources(StackName=stack_name)
+# an ALIAS answers with the load balancer's own addresses, so poll until
+# every nameserver gives host an rtype (A or AAAA) address elb_dns also has
+def poll_for_alias_update(host, rtype, elb_dns, max_wait, nameservers=None):
+    progress('polling for ALIAS resolution :' + host)
 
-    for i in sr['StackResourceSummaries']:
-        if i['LogicalResourceId'] == "LoadBalancer":
-            return i['PhysicalResourceId']
+    elb_addrs = set(a for a in asyncio.run(dns_backend().resolve(elb_dns))
+                    if (':' in a) == (rtype == 'AAAA'))
+    if not elb_addrs:
+        warning('unable to resolve ' + rtype + ' for:' + elb_dns)
+        return -1
 
+    recurse = nameservers is None
+    if nameservers is None:
+        nameservers = system_nameservers()
+    if not nameservers:
+        warning('no DNS servers to poll for ALIAS:' + host)
+        return -1
+
+    def matches(answers):
+        return bool(answers) and any(t == rtype and v in elb_addrs
+                                     for t, v in answers)
+
+    pending = asyncio.run(probe_record(host, rtype, matches, nameservers,
+                                       max_wait, recurse))
+    if not pending:
+        debug('ALIAS match:' + host + '  => ' + elb_dns)
+        return 0
+
+    info('Timeout waiting for resolution on ALIAS:' + host + ' from '
+         + ', '.join(ns[0] for ns in pending))
     return -1
 
 
-def GetELBDNS(elb):
-    global _boto_ELB
-    # TODO what if there isn't an ELB (or there is two)
+# parse and validate the dns suffix (aka hosted_zone_name). Only an ALIAS
+# can sit at the apex, so for a CNAME the zone is looked for from the parent
+def parse_dns_suffix(_DNS_target, apex=False):
+    parent = _DNS_target if apex else ".".join(_DNS_target.split(".")[1:])
 
-    ret = _boto_ELB.describe_load_balancers(
-        LoadBalancerNames=[elb])['LoadBalancerDescriptions'][-1]['DNSName']
-    return ret
+    zone = find_r53_zone(parent) if parent else -1
+    if zone == -1:
+        warning("Not a hosted zone for this AWS account")
+        return -1
 
+    return zone[0]
+
+
+# every endpoint in a stack that one of ENDPOINT_RESOLVERS can publish, from
+# a single pass over the resource pages. kind names the resolver
+def list_stack_endpoints(stack_name, cfn):
+    kinds = dict((t, r) for r in ENDPOINT_RESOLVERS.values()
+                 for t in r.resource_types)
+    endpoints = []
+
+    pages = cfn.get_paginator('list_stack_resources').paginate(StackName=stack_name)
+    for page in pages:
+        for i in page['StackResourceSummaries']:
+            resolver = kinds.get(i['ResourceType'])
+            if resolver is not None and i.get('PhysicalResourceId'):
+                physical_id = i['PhysicalResourceId']
+                endpoints.append({'logical_id': i['LogicalResourceId'],
+                                  'physical_id': physical_id,
+                                  'name': resolver.short_name(physical_id),
+                                  'kind': resolver.name,
+                                  'type': i['ResourceType']})
+
+    return endpoints
+
+
+# every classic ELB, ALB and NLB in a stack, across all resource pages
+def list_stack_lbs(stack_name, cfn):
+    return [e for e in list_stack_endpoints(stack_name, cfn)
+            if e['kind'] == LoadBalancerEndpoints.name]
+
+
+# pick one endpoint by logical id, name or ARN. With no selector the only
+# one of the first kind in ENDPOINT_RESOLVERS the stack has, or the one
+# called "LoadBalancer", is picked. So a stack's load balancer still wins
+# over the listeners and services behind it
+def select_lb(lbs, selector=None):
+    if selector:
+        lbs = [lb for lb in lbs
+               if selector in (lb['logical_id'], lb['name'], lb['physical_id'])]
+    elif lbs:
+        kinds = list(ENDPOINT_RESOLVERS)
+        first = min(kinds.index(lb.get('kind', 'elb')) for lb in lbs)
+        lbs = [lb for lb in lbs if kinds.index(lb.get('kind', 'elb')) == first]
+        if len(lbs) > 1:
+            lbs = [lb for lb in lbs if lb['logical_id'] == 'LoadBalancer']
+
+    if len(lbs) != 1:
+        return -1
+    return lbs[0]
 
-def main():
-    parsecommandline()
-    do_boto_setup()
 
-    ret = get_stack_status(_stack_name)
-    if ret == -1:
-        bail('stack not found, cant find stack with name:' + str(_stack_name))
-    if 'COMPLETE' not in ret:
-        bail('stack not in COMPLETE state. Stack:'
-             + str(_stack_name)
-             + ' :' + str(ret))
-
-    elb = get_first_elb_from_stack(_stack_name)
-    if elb == -1:
-        bail('ELB not found, cannot find ELB for stack(' + _stack_name)
-    else:
-        info('Stack(' + _stack_name + '), found ELB:' + elb)
-        _cname_target = GetELBDNS(elb)
+def get_first_elb_from_stack(stack_name, cfn, selector=None):
+    lbs = list_stack_lbs(stack_name, cfn)
 
-    if _cname_target == -1:
-        bail('internal error, the DNS _cname_target is invalid')
+    lb = select_lb(lbs, selector)
+    if lb == -1:
+        if len(lbs) > 1:
+            warning('stack ' + stack_name + ' has ' + str(len(lbs))
+                    + ' load balancers, pick one with --elb: '
+                    + ', '.join(lb['logical_id'] for lb in lbs))
+        return -1
 
-    # For new stacks; ELB name won't be resolvable yet, so poll...
-    ret = poll_for_resolve(_cname_target, MAX_WAIT)
+    return lb['physical_id']
+
+
+# name or ARN -> (DNSName, canonical hosted zone id) for many load balancers,
+# one describe_load_balancers per LB_DESCRIBE_BATCH of each kind
+def describe_lbs(region, elbs):
+    classic = sorted(set(e for e in elbs if not e.startswith('arn:')))
+    v2 = sorted(set(e for e in elbs if e.startswith('arn:')))
+    endpoints = {}
+
+    for i in range(0, len(classic), LB_DESCRIBE_BATCH):
+        ret = get_boto_client('elb', region).describe_load_balancers(
+            LoadBalancerNames=classic[i:i + LB_DESCRIBE_BATCH])
+        for lb in ret['LoadBalancerDescriptions']:
+            endpoints[lb['LoadBalancerName']] = (
+                lb['DNSName'], lb.get('CanonicalHostedZoneNameID'))
+
+    for i in range(0, len(v2), LB_DESCRIBE_BATCH):
+        ret = get_boto_client('elbv2', region).describe_load_balancers(
+            LoadBalancerArns=v2[i:i + LB_DESCRIBE_BATCH])
+        for lb in ret['LoadBalancers']:
+            endpoints[lb['LoadBalancerArn']] = (
+                lb['DNSName'], lb.get('CanonicalHostedZoneId'))
+
+    return endpoints
+
+
+# id -> load balancer name or ARN, to id -> that load balancer's
+# (DNSName, hosted zone id), for endpoints published as the LB in front
+def behind_lbs(region, lbs):
+    endpoints = describe_lbs(region, [lb for lb in lbs.values() if lb])
+    return dict((i, endpoints[lb]) for i, lb in lbs.items() if lb in endpoints)
+
+
+class LoadBalancerEndpoints:
+    """Classic ELBs, ALBs and NLBs. The other kinds of endpoint a stack can
+    publish are classes like this one, registered in ENDPOINT_RESOLVERS"""
+    name = 'elb'
+    resource_types = LB_RESOURCE_TYPES
+
+    # how people and --elb name it, arn:...:loadbalancer/net/<name>/<id>
+    @staticmethod
+    def short_name(physical_id):
+        if physical_id.startswith('arn:'):
+            return physical_id.split('/')[-2]
+        return physical_id
+
+    # physical id -> (DNSName, hosted zone id), for many in one region
+    @staticmethod
+    def describe(region, physical_ids):
+        return describe_lbs(region, physical_ids)
+
+
+class ApiGatewayDomainEndpoints(LoadBalancerEndpoints):
+    """API Gateway custom domain names, the regional name and zone if it
+    has one, else the edge (CloudFront) ones"""
+    name = 'apigateway-domain'
+    resource_types = ('AWS::ApiGateway::DomainName',)
+
+    @staticmethod
+    def short_name(physical_id):
+        return physical_id
+
+    @staticmethod
+    def describe(region, physical_ids):
+        apigateway = get_boto_client('apigateway', region)
+        endpoints = {}
+        for domain in physical_ids:
+            ret = apigateway.get_domain_name(domainName=domain)
+            if ret.get('regionalDomainName'):
+                endpoints[domain] = (ret['regionalDomainName'],
+                                     ret.get('regionalHostedZoneId'))
+            elif ret.get('distributionDomainName'):
+                endpoints[domain] = (ret['distributionDomainName'],
+                                     ret.get('distributionHostedZoneId'))
+        return endpoints
+
+
+class ApiGatewayV2DomainEndpoints(ApiGatewayDomainEndpoints):
+    """API Gateway v2 (HTTP and WebSocket API) custom domain names"""
+    name = 'apigatewayv2-domain'
+    resource_types = ('AWS::ApiGatewayV2::DomainName',)
+
+    @staticmethod
+    def describe(region, physical_ids):
+        apigatewayv2 = get_boto_client('apigatewayv2', region)
+        endpoints = {}
+        for domain in physical_ids:
+            ret = apigatewayv2.get_domain_name(DomainName=domain)
+            configs = ret.get('DomainNameConfigurations') or []
+            if configs:
+                endpoints[domain] = (configs[0]['ApiGatewayDomainName'],
+                                     configs[0].get('HostedZoneId'))
+        return endpoints
+
+
+class ECSServiceEndpoints(LoadBalancerEndpoints):
+    """ECS services, published as the load balancer in front of their
+    target group, or the classic ELB they register with"""
+    name = 'ecs'
+    resource_types = ('AWS::ECS::Service',)
+
+    # arn:...:service/<cluster>/<name>, or the older arn:...:service/<name>
+    @staticmethod
+    def short_name(physical_id):
+        return physical_id.split('/')[-1]
+
+    # as LoadBalancerEndpoints.describe(), but a service with no load
+    # balancer maps to a string saying so, as it can't be published
+    @staticmethod
+    def describe(region, physical_ids):
+        clusters = {}
+        for arn in physical_ids:
+            parts = arn.split(':')[-1].split('/')
+            clusters.setdefault(parts[1] if len(parts) == 3 else 'default',
+                                []).append(arn)
+
+        ecs = get_boto_client('ecs', region)
+        targets = {}
+        no_lb = []
+        for cluster, arns in sorted(clusters.items()):
+            for i in range(0, len(arns), ECS_DESCRIBE_BATCH):
+                batch = arns[i:i + ECS_DESCRIBE_BATCH]
+                names = dict((ECSServiceEndpoints.short_name(a), a) for a in batch)
+                ret = ecs.describe_services(cluster=cluster, services=batch)
+                for service in ret['services']:
+                    lbs = service.get('loadBalancers') or []
+                    if service['serviceName'] not in names:
+                        continue
+                    if not lbs:
+                        no_lb.append(names[service['serviceName']])
+                        continue
+                    targets[names[service['serviceName']]] = \
+                        lbs[0].get('targetGroupArn') or lbs[0].get('loadBalancerName')
+
+        groups = sorted(set(t for t in targets.values() if t and t.startswith('arn:')))
+        group_lbs = {}
+        for i in range(0, len(groups), LB_DESCRIBE_BATCH):
+            ret = get_boto_client('elbv2', region).describe_target_groups(
+                TargetGroupArns=groups[i:i + LB_DESCRIBE_BATCH])
+            for group in ret['TargetGroups']:
+                if group.get('LoadBalancerArns'):
+                    group_lbs[group['TargetGroupArn']] = group['LoadBalancerArns'][0]
+
+        endpoints = behind_lbs(region, dict(
+            (arn, group_lbs.get(t) if t and t.startswith('arn:') else t)
+            for arn, t in targets.items()))
+        for arn in no_lb:
+            endpoints[arn] = 'service has no load balancer'
+        return endpoints
+
+
+class ListenerEndpoints(LoadBalancerEndpoints):
+    """ALB/NLB listeners, published as their load balancer. For stacks that
+    only add a listener to a load balancer made elsewhere"""
+    name = 'listener'
+    resource_types = ('AWS::ElasticLoadBalancingV2::Listener',)
+
+    # arn:...:listener/net/<name>/<lb id>/<listener id>
+    @staticmethod
+    def short_name(physical_id):
+        return physical_id.split('/')[-3]
+
+    @staticmethod
+    def describe(region, physical_ids):
+        lbs = {}
+        for i in range(0, len(physical_ids), LB_DESCRIBE_BATCH):
+            ret = get_boto_client('elbv2', region).describe_listeners(
+                ListenerArns=physical_ids[i:i + LB_DESCRIBE_BATCH])
+            for listener in ret['Listeners']:
+                lbs[listener['ListenerArn']] = listener['LoadBalancerArn']
+        return behind_lbs(region, lbs)
+
+
+# kinds of endpoint, in the order select_lb() prefers them
+ENDPOINT_RESOLVERS = dict(
+    (r.name, r) for r in (LoadBalancerEndpoints, ApiGatewayDomainEndpoints,
+                          ApiGatewayV2DomainEndpoints, ECSServiceEndpoints,
+                          ListenerEndpoints))
+
+
+# (kind, physical id) -> (DNSName, hosted zone id), or why it has none, for
+# many endpoints in one region, each kind's resolver running at the same time
+def resolve_endpoints(region, endpoints):
+    by_kind = {}
+    for kind, physical_id in endpoints:
+        by_kind.setdefault(kind, set()).add(physical_id)
+    kinds = sorted(by_kind)
+    if not kinds:
+        return {}
+
+    resolved = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(kinds)) as pool:
+        found = pool.map(lambda k: ENDPOINT_RESOLVERS[k].describe(region, sorted(by_kind[k])),
+                         kinds)
+        for kind, described in zip(kinds, found):
+            for physical_id, endpoint in described.items():
+                resolved[(kind, physical_id)] = endpoint
+    return resolved
+
+
+# (DNSName, canonical hosted zone id) of a classic ELB name or ALB/NLB ARN
+def get_elb_endpoint(elb, region):
+    return describe_lbs(region, [elb]).get(elb, -1)
+
+
+def GetELBDNS(elb, region):
+    ret = get_elb_endpoint(elb, region)
     if ret == -1:
-        bail('Timeout on resolution of the ELB DNS name. '
-             + str(_cname_target)
-             + ' does not resolve')
+        return -1
+    return ret[0]
+
+
+# (key, DNSName, zone id) of the load balancer in a stack's outputs, or -1.
+# Picked as select_lb() does, by selector, the only one, or LoadBalancer's
+def lb_from_outputs(outputs, selector=None):
+    found = []
+    for key, value in outputs.items():
+        if not key.lower().endswith(OUTPUT_DNS_NAME):
+            continue
+        prefix = key[:-len(OUTPUT_DNS_NAME)]
+        zone_keys = [prefix.lower() + z for z in OUTPUT_ZONE_IDS]
+        zone_ids = [v for k, v in outputs.items() if k.lower() in zone_keys]
+        if zone_ids:
+            found.append((prefix, key, value, zone_ids[0]))
+
+    if selector:
+        found = [f for f in found if f[0].lower() == selector.lower()]
+    elif len(found) > 1:
+        found = [f for f in found if f[0] in ('', 'LoadBalancer')]
+
+    if len(found) != 1:
+        return -1
+    return found[0][1:]
+
+
+# export name -> (value, exporting stack id) for every export in a region,
+# listed once per run. None listed if that's not allowed, stacks' resources
+# are used instead
+def region_exports(region):
+    with _exports_lock:
+        lock = _exports_locks.setdefault(region, threading.Lock())
+
+    with lock:
+        if region not in _exports:
+            exports = {}
+            cfn = get_boto_client('cloudformation', region)
+            try:
+                for page in cfn.get_paginator('list_exports').paginate():
+                    for i in page['Exports']:
+                        exports[i['Name']] = (i['Value'], i.get('ExportingStackId'))
+            except cfn.exceptions.ClientError as e:
+                warning('unable to list exports in ' + region + ': '
+                        + e.response['Error']['Message'])
+            debug(region + ' has ' + str(len(exports)) + ' exports')
+            _exports[region] = exports
+        return _exports[region]
+
+
+# exports named <stackname>-<key> as outputs of the stack, for stacks whose
+# output keys don't follow <prefix>DNSName but export names do. Only the
+# stack's own, so "app" never picks up what "app-v2" exports
+def stack_exports(region, stack_name, stack_id):
+    prefix = stack_name + '-'
+    return dict((name[len(prefix):], value)
+                for name, (value, exporter) in region_exports(region).items()
+                if name.startswith(prefix) and exporter == stack_id)
+
+
+# a --stackcache file, read once per run
+def read_stack_cache(cache_file):
+    with _stack_cache_lock:
+        if cache_file not in _stack_caches:
+            try:
+                with open(cache_file, 'r') as f:
+                    cache = json.load(f)
+            except (IOError, OSError, ValueError):
+                cache = {}
+            _stack_caches[cache_file] = cache if isinstance(cache, dict) else {}
+        return _stack_caches[cache_file]
+
+
+# --stackcache, the load balancer found last time if the stack hasn't been
+# updated since. Keyed by stack id, so a deleted and remade stack misses
+def cached_stack_lb(cache_file, stack_id, updated, selector=None):
+    if cache_file is None or stack_id is None:
+        return None
+    entry = read_stack_cache(cache_file).get(stack_id)
+    if not isinstance(entry, dict) or entry.get('updated') != updated:
+        return None
+    return entry.get('lbs', {}).get(selector or '')
+
+
+# remember what discover_stacks() found, replacing what was kept for an
+# earlier version of each stack
+def save_stack_lbs(cache_file, stacks, results):
+    cache = read_stack_cache(cache_file)
+    changed = False
+
+    with _stack_cache_lock:
+        for stack, result in zip(stacks, results):
+            if result['error'] is not None or result['source'] == 'cache' \
+                    or result['stack_id'] is None:
+                continue
+            entry = cache.get(result['stack_id'])
+            if not isinstance(entry, dict) or entry.get('updated') != result['updated']:
+                entry = cache[result['stack_id']] = {'updated': result['updated'],
+                                                     'lbs': {}}
+            selector = stack[2] if len(stack) > 2 else None
+            entry['lbs'][selector or ''] = dict(
+                (k, result[k]) for k in ('elb', 'kind', 'dns_name', 'zone_id', 'source'))
+            changed = True
+        if changed:
+            write_json_file(cache_file, cache)
+
+
+# status and chosen endpoint of one stack, errors are reported in the
+# result not bailed. From, in order, the --stackcache, the stack's Outputs,
+# the Exports it makes named after it (elb is the output's key then), or
+# its resources, when discover_stacks() fills in dns_name and zone_id.
+# source says which, kind which of ENDPOINT_RESOLVERS resolves a resource
+def discover_stack(region, stack_name, selector=None, cache_file=None):
+    result = {'region': region, 'stackname': stack_name, 'status': None,
+              'stack_id': None, 'updated': None, 'source': None, 'kind': None,
+              'elb': None, 'dns_name': None, 'zone_id': None, 'error': None}
+    cfn = get_boto_client('cloudformation', region)
 
-    # just print elb dns name and exit...
-    if _print_elb_dns is True:
-        print(_cname_target)
-        sys.exit(0)
+    try:
+        stack = cfn.describe_stacks(StackName=stack_name)['Stacks'][-1]
+        result['status'] = stack['StackStatus']
+        if 'COMPLETE' not in result['status']:
+            result['error'] = 'stack not in COMPLETE state'
+            return result
+        result['stack_id'] = stack.get('StackId')
+        result['updated'] = str(stack.get('LastUpdatedTime')
+                                or stack.get('CreationTime'))
+
+        cached = cached_stack_lb(cache_file, result['stack_id'], result['updated'],
+                                 selector)
+        if cached is not None:
+            result.update(cached, source='cache')
+            return result
+
+        result['source'] = 'outputs'
+        lb = lb_from_outputs(dict((o['OutputKey'], o['OutputValue'])
+                                  for o in stack.get('Outputs', [])), selector)
+        if lb == -1:
+            result['source'] = 'exports'
+            lb = lb_from_outputs(stack_exports(region, stack_name, result['stack_id']),
+                                 selector)
+        if lb != -1:
+            result['elb'], result['dns_name'], result['zone_id'] = lb
+            return result
+
+        result['source'] = 'resources'
+        lbs = list_stack_endpoints(stack_name, cfn)
+        lb = select_lb(lbs, selector)
+        if lb == -1:
+            names = ', '.join(lb['logical_id'] for lb in lbs)
+            if selector:
+                result['error'] = 'ELB not found, ' + selector + ' is not one of: ' + names
+            elif len(lbs) > 1:
+                result['error'] = 'stack has ' + str(len(lbs)) \
+                    + ' load balancers, pick one with --elb: ' + names
+            else:
+                result['error'] = 'ELB not found'
+            return result
+        result['elb'], result['kind'] = lb['physical_id'], lb['kind']
+    except cfn.exceptions.ClientError as e:
+        result['error'] = e.response['Error']['Message']
+
+    return result
+
+
+# discover many (region, stackname[, selector]) at once, results in the same
+# order. Stacks are read concurrently, then endpoints are described in
+# bulk, per region and kind
+def discover_stacks(stacks, workers=DISCOVERY_WORKERS, cache_file=None):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(
+            lambda s: discover_stack(*s, cache_file=cache_file), stacks))
+
+        by_region = {}
+        for result in results:
+            if result['error'] is None and result['dns_name'] is None:
+                by_region.setdefault(result['region'], []).append(result)
+
+        def describe_region(region):
+            import botocore.exceptions
+            try:
+                return resolve_endpoints(region, [(r['kind'], r['elb'])
+                                                  for r in by_region[region]])
+            except botocore.exceptions.ClientError as e:
+                return e.response['Error']['Message']
+
+        regions = list(by_region)
+        for region, endpoints in zip(regions, pool.map(describe_region, regions)):
+            for result in by_region[region]:
+                if not isinstance(endpoints, dict):
+                    result['error'] = endpoints
+                elif (result['kind'], result['elb']) not in endpoints:
+                    result['error'] = 'ELB not found:' + result['elb']
+                elif not isinstance(endpoints[(result['kind'], result['elb'])], tuple):
+                    result['error'] = endpoints[(result['kind'], result['elb'])] \
+                        + ':' + result['elb']
+                else:
+                    result['dns_name'], result['zone_id'] = \
+                        endpoints[(result['kind'], result['elb'])]
+
+    if cache_file is not None:
+        save_stack_lbs(cache_file, stacks, results)
+    return results
+
+
+# every endpoint in one stack that could be published, with its dns_name
+# and zone_id, None for those that didn't resolve. For --listEndpoints
+def describe_stack_endpoints(region, stack_name):
+    import botocore.exceptions
+    try:
+        endpoints = list_stack_endpoints(stack_name,
+                                         get_boto_client('cloudformation', region))
+        resolved = resolve_endpoints(region, [(e['kind'], e['physical_id'])
+                                              for e in endpoints])
+    except botocore.exceptions.ClientError as e:
+        bail('Stack(' + stack_name + ') in ' + region + ': '
+             + e.response['Error']['Message'], StackError)
+
+    for endpoint in endpoints:
+        found = resolved.get((endpoint['kind'], endpoint['physical_id']))
+        if not isinstance(found, tuple):
+            found = (None, None)
+        endpoint['dns_name'], endpoint['zone_id'] = found
+    return endpoints
+
+
+# read a manifest of stackname/DNSTarget pairs, format is picked by extension
+def load_manifest(path, region=None):
+    ext = os.path.splitext(path)[1].lower()
+    try:
+        with open(path, 'r') as f:
+            if ext in ('.yaml', '.yml'):
+                try:
+                    import yaml
+                except ImportError:
+                    bail('PyYAML is needed for YAML manifests: pip install pyyaml',
+                         ManifestError)
+                entries = yaml.safe_load(f)
+            elif ext == '.json':
+                entries = json.load(f)
+            elif ext == '.csv':
+                entries = list(csv.DictReader(f))
+            else:
+                bail('unknown manifest type (want .yaml, .json or .csv):' + path,
+                     ManifestError)
+    except ManifestError:
+        raise
+    except Exception as e:
+        bail('unable to read manifest:' + path + ' ' + str(e), ManifestError)
+
+    if not isinstance(entries, list):
+        bail('manifest must be a list of stackname/DNSTarget entries:' + path,
+             ManifestError)
+
+    manifest = []
+    seen = set()
+    for i, entry in enumerate(entries):
+        if not isinstance(entry, dict) or not entry.get('stackname') \
+                or not entry.get('DNSTarget'):
+            bail('manifest entry #' + str(i) + ' needs a stackname and a '
+                 'DNSTarget:' + str(entry), ManifestError)
+        target = str(entry['DNSTarget']).strip().rstrip('.')
+        # Route53 rejects a ChangeBatch that touches the same record twice
+        if target.lower() in seen:
+            bail('manifest has ' + target + ' more than once', ManifestError)
+        seen.add(target.lower())
+        manifest.append({'stackname': str(entry['stackname']).strip(),
+                         'DNSTarget': target,
+                         'AWSRegion': entry.get('AWSRegion') or region,
+                         'elb': entry.get('elb') or None})
+
+    return manifest
+
+
+# (region, stack, elb) -> discover_stack() result for every manifest entry
+def resolve_manifest_elbs(manifest, cache_file=None):
+    stacks = []
+    for entry in manifest:
+        stack = (entry['AWSRegion'], entry['stackname'], entry['elb'])
+        if stack not in stacks:
+            stacks.append(stack)
+
+    elbs = {}
+    for stack, result in zip(stacks, discover_stacks(stacks, cache_file=cache_file)):
+        if result['error'] is not None:
+            bail('Stack(' + result['stackname'] + ') in ' + str(result['region'])
+                 + ': ' + result['error'] + ' ' + str(result['status']), StackError)
+        info('Stack(' + result['stackname'] + '), found ELB:' + result['elb']
+             + ' ' + result['dns_name'])
+        elbs[stack] = result
+
+    return elbs
+
+
+# zoneid -> [DNSCNameRecord], one list per hosted zone. apex for ALIASes
+def group_records_by_zone(manifest, elbs, apex=False):
+    zones = {}
+
+    for entry in manifest:
+        dns_suffix = parse_dns_suffix(entry['DNSTarget'], apex=apex)
+        if dns_suffix == -1:
+            bail('invalid _DNS_suffix:' + entry['DNSTarget'], ZoneError)
+
+        elb = elbs[(entry['AWSRegion'], entry['stackname'], entry['elb'])]
+        dns_rec = DNSCNameRecord(entry['DNSTarget'])
+        dns_rec.zoneid = get_r53_zoneid(dns_suffix)
+        dns_rec.cname = elb['dns_name']
+        dns_rec.alias_zoneid = elb['zone_id']
+        zones.setdefault(dns_rec.zoneid, []).append(dns_rec)
+
+    return zones
+
+
+# split changes into ChangeBatches that fit Route53's per request limits
+def build_change_batches(changes):
+    batches = []
+    current = []
+    records = 0
+    chars = 0
+
+    for change in changes:
+        rrs = change['ResourceRecordSet']
+        weight = 2 if change['Action'] == 'UPSERT' else 1
+        values = [r['Value'] for r in rrs.get('ResourceRecords', [])]
+        change_records = max(len(values), 1) * weight
+        change_chars = sum(len(v) for v in values) * weight
+
+        if current and (records + change_records > R53_MAX_RECORDS_PER_BATCH
+                        or chars + change_chars > R53_MAX_CHARS_PER_BATCH):
+            batches.append(current)
+            current = []
+            records = 0
+            chars = 0
+
+        current.append(change)
+        records += change_records
+        chars += change_chars
+
+    if current:
+        batches.append(current)
+
+    return batches
+
+
+# send changes for one zone, as few ChangeBatches as possible, return change
+# ids. previous and journal are passed on to send_change_batch()
+def update_r53_batch(zone_id, changes, previous=None, comment='PublishDNS.py batch',
+                     journal=None):
+    change_ids = []
+
+    for batch in build_change_batches(changes):
+        ret = send_change_batch(zone_id, {'Comment': comment,
+                                          'Changes': batch}, previous, journal)
+        info('zone ' + zone_id + ': ' + str(len(batch)) + ' change(s), '
+             'AWS requestid:' + str(ret['ResponseMetadata']['RequestId']))
+        change_ids.append(ret['ChangeInfo']['Id'])
+
+    return change_ids
+
+
+# discover, publish and wait on a list of load_manifest() entries. ALIASes
+# of alias_types if given, else CNAMEs. print_only is --GetELBDNS, the
+# files are --journal and --stackcache
+def publish_entries(manifest, alias_types=None, ready_port=None,
+                    print_only=False, journal_file=None, stack_cache_file=None):
+    with span('elb_lookup', stacks=len(manifest)):
+        elbs = resolve_manifest_elbs(manifest, stack_cache_file)
+
+    # For new stacks; ELB names won't be resolvable yet, so poll...
+    with span('resolve_poll'):
+        failed = poll_for_resolve_many(
+            sorted(set(r['dns_name'] for r in elbs.values())),
+            MAX_WAIT, ready_port)
+    if failed:
+        bail('Timeout on resolution of the ELB DNS name(s). '
+             + ', '.join(failed) + ' not ready', DNSTimeoutError)
+
+    # just print what was found, one JSON object per stack, and exit...
+    if print_only:
+        for result in elbs.values():
+            print(json.dumps(result, sort_keys=True))
+        return 0
 
-    ret = parse_dns_suffix(_DNS_target)
+    with span('zone_lookup'):
+        zones = group_records_by_zone(manifest, elbs,
+                                      apex=alias_types is not None)
+
+    change_ids = []
+    journal = new_journal_run(journal_file)
+    with span('upsert', zones=len(zones)):
+        for zone_id, dns_recs in zones.items():
+            if alias_types is None:
+                changes = [cname_change(r.name + '.', r.cname) for r in dns_recs]
+            else:
+                changes = []
+                prefetch_zone_records(zone_id, len(dns_recs))
+                for dns_rec in dns_recs:
+                    get_r53_cname_rec(dns_rec)
+                    changes += alias_changes(dns_rec, dns_rec.cname,
+                                             dns_rec.alias_zoneid, alias_types)
+            change_ids += update_r53_batch(zone_id, changes, journal=journal)
+
+    tracker = R53ChangeTracker(change_ids)
+    ret = tracker.wait_insync(MAX_WAIT)
+    tracker.report()
     if ret == -1:
-        bail('invalid _DNS_suffix:' + str(_DNS_target))
+        bail('DNS CNAME update fail, Route53 has not synced the change(s)',
+             Route53Error)
+
+    for dns_recs in zones.values():
+        for dns_rec in dns_recs:
+            info(dns_rec.name + ' -> ' + dns_rec.cname)
+    if journal is not None:
+        journal.report()
+
+    return 0
+
+
+# events newer than cursor (an EventId), oldest first, and the new cursor.
+# cursor None is a stack not seen yet, '' one that didn't exist last time
+def new_stack_events(region, stack_name, cursor):
+    import botocore.exceptions
+    cfn = get_boto_client('cloudformation', region)
+    events = []
+
+    try:
+        pages = cfn.get_paginator('describe_stack_events').paginate(
+            StackName=stack_name)
+        for page in pages:
+            for event in page['StackEvents']:
+                if event['EventId'] == cursor:
+                    return list(reversed(events)), events[0]['EventId'] if events else cursor
+                events.append(event)
+            # first look, only the newest event id is needed
+            if cursor is None:
+                break
+    except cfn.exceptions.ClientError as e:
+        if 'does not exist' in e.response['Error']['Message']:
+            return [], ''
+        warning('unable to read events for stack ' + stack_name + ': '
+                + e.response['Error']['Message'])
+        return [], cursor
+    # connection errors and timeouts, tried again next poll
+    except botocore.exceptions.BotoCoreError as e:
+        warning('unable to read events for stack ' + stack_name + ': ' + str(e))
+        return [], cursor
+
+    return list(reversed(events)), events[0]['EventId'] if events else cursor
+
+
+def stack_ready_event(event, stack_name):
+    return event['LogicalResourceId'] == stack_name \
+        and event['ResourceType'] == 'AWS::CloudFormation::Stack' \
+        and event['ResourceStatus'] in ('CREATE_COMPLETE', 'UPDATE_COMPLETE')
+
+
+# one publish at a time per record, a failure of any kind (AWS errors
+# included) is logged not fatal. Each is its own journal run
+def publish_locked(entry, lock, publisher):
+    with lock:
+        try:
+            with span('watch_publish', record=entry['DNSTarget']):
+                publisher.publish_entries([entry])
+        except Exception as e:
+            warning(str(e) if isinstance(e, PublishError)
+                    else type(e).__name__ + ': ' + str(e))
+            warning('publish of ' + entry['DNSTarget'] + ' -> '
+                    + entry['stackname'] + ' failed, waiting for the next event')
+
+
+# Daemon: poll the events of every stack in the manifest, only fetching
+# those newer than the last seen, and publish a stack's records when it
+# reaches CREATE_COMPLETE or UPDATE_COMPLETE. Events from before the
+# daemon started are skipped. Publishes run in a pool of their own, so
+# their INSYNC and resolve waits never hold up polling. max_polls is for
+# testing
+def watch_stacks(manifest_file, publisher, interval=WATCH_INTERVAL,
+                 max_polls=None):
+    manifest = load_manifest(manifest_file, publisher.region)
+    stacks = sorted(set((e['AWSRegion'], e['stackname']) for e in manifest))
+    record_locks = dict((e['DNSTarget'], threading.Lock()) for e in manifest)
+    cursors = {}
+    polls = 0
+    info('watching ' + str(len(stacks)) + ' stack(s) for ' + str(len(manifest))
+         + ' record(s), every ' + str(interval) + 'secs')
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=DISCOVERY_WORKERS) as pool, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=DISCOVERY_WORKERS) as publishes:
+        while max_polls is None or polls < max_polls:
+            with span('watch_poll', stacks=len(stacks)):
+                results = list(pool.map(
+                    lambda s: new_stack_events(s[0], s[1], cursors.get(s)),
+                    stacks))
+
+            for stack, (events, cursor) in zip(stacks, results):
+                # a first look that failed, look again next poll
+                if cursor is None:
+                    continue
+                first_look = stack not in cursors
+                cursors[stack] = cursor
+                if first_look:
+                    continue
+
+                if any(stack_ready_event(e, stack[1]) for e in events):
+                    info('stack ' + stack[1] + ' in ' + str(stack[0]) + ' is ready')
+                    emit_event('stack_ready', region=stack[0], stack=stack[1])
+                    for entry in manifest:
+                        if (entry['AWSRegion'], entry['stackname']) == stack:
+                            publishes.submit(publish_locked, entry,
+                                             record_locks[entry['DNSTarget']],
+                                             publisher)
+
+            polls += 1
+            if max_polls is None or polls < max_polls:
+                time.sleep(interval)
+
+    return 0
+
+
+# (hostname, region) of an ELB DNS name, None if it isn't one. Classic
+# and ALBs are <name>.<region>.elb.amazonaws.com, NLBs are
+# <name>.elb.<region>.amazonaws.com, aliases may have dualstack. in front
+def elb_hostname(target):
+    name = target.rstrip('.').lower()
+    if name.startswith('dualstack.'):
+        name = name[len('dualstack.'):]
+    labels = name.split('.')
+    if len(labels) < 5 or labels[-2:] != ['amazonaws', 'com']:
+        return None
+    if labels[-3] == 'elb':
+        return name, labels[-4]
+    if labels[-4] == 'elb':
+        return name, labels[-3]
+    return None
+
+
+# every record set in every hosted zone that points at an ELB, read a page
+# at a time. stats['records'] counts all record sets seen
+def iter_elb_records(stats):
+    for zone_name, zone_id in sorted(load_zone_index().items()):
+        stats['zones'] += 1
+        pages = route53_client().get_paginator('list_resource_record_sets').paginate(
+            HostedZoneId=zone_id)
+        for page in pages:
+            for rrs in page['ResourceRecordSets']:
+                stats['records'] += 1
+                ttl, values, alias, weight, extra = compact_record(rrs)
+                if alias is not None:
+                    targets = [alias[1]]
+                elif rrs['Type'] == 'CNAME':
+                    targets = values
+                else:
+                    continue
+                for target in targets:
+                    elb = elb_hostname(target)
+                    if elb is None:
+                        continue
+                    yield {'zone': zone_name.rstrip('.'),
+                           'name': rrs['Name'].rstrip('.').lower(),
+                           'type': rrs['Type'],
+                           'set_id': rrs.get('SetIdentifier'),
+                           'target': elb[0],
+                           'region': elb[1],
+                           'alias_zone_id': alias[0] if alias else None}
+
+
+def stack_tag(tags):
+    for tag in tags:
+        if tag['Key'] == 'aws:cloudformation:stack-name':
+            return tag['Value']
+    return None
+
+
+# every load balancer in a region, a page at a time, as (DNS name, details).
+# The stack that made it comes from its CloudFormation tag
+def iter_region_lbs(region):
+    kinds = (('elb', 'LoadBalancerDescriptions', 'LoadBalancerName',
+              'LoadBalancerNames', 'CanonicalHostedZoneNameID'),
+             ('elbv2', 'LoadBalancers', 'LoadBalancerArn',
+              'ResourceArns', 'CanonicalHostedZoneId'))
+
+    for service, key, id_key, tags_arg, zone_key in kinds:
+        client = get_boto_client(service, region)
+        for page in client.get_paginator('describe_load_balancers').paginate():
+            ids = [lb[id_key] for lb in page[key]]
+            stacks = {}
+            for i in range(0, len(ids), LB_DESCRIBE_BATCH):
+                ret = client.describe_tags(**{tags_arg: ids[i:i + LB_DESCRIBE_BATCH]})
+                for tags in ret['TagDescriptions']:
+                    stacks[tags.get('LoadBalancerName') or tags.get('ResourceArn')] = \
+                        stack_tag(tags['Tags'])
+            for lb in page[key]:
+                yield lb['DNSName'].rstrip('.').lower(), {
+                    'elb': lb[id_key], 'zone_id': lb.get(zone_key),
+                    'stackname': stacks.get(lb[id_key])}
+
+
+# stack name -> status for a region. A name can be reused, the stack that
+# isn't DELETE_COMPLETE wins
+def region_stack_statuses(region):
+    statuses = {}
+    cfn = get_boto_client('cloudformation', region)
+
+    for page in cfn.get_paginator('list_stacks').paginate():
+        for stack in page['StackSummaries']:
+            if stack['StackStatus'] != 'DELETE_COMPLETE' \
+                    or stack['StackName'] not in statuses:
+                statuses[stack['StackName']] = stack['StackStatus']
+
+    return statuses
+
+
+def index_region(region):
+    return dict(iter_region_lbs(region)), region_stack_statuses(region)
+
+
+# join every ELB record in Route53 to the load balancers and stacks of
+# regions by DNS name. Only the load balancers and stacks are held in
+# memory, records stream through and only the bad ones are kept
+def drift_scan(regions, manifest=None):
+    with span('drift_index', regions=','.join(regions)):
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(len(regions), DISCOVERY_WORKERS)) as pool:
+            indexes = list(pool.map(index_region, regions))
+    lbs = {}
+    statuses = {}
+    for region, (region_lbs, region_stacks) in zip(regions, indexes):
+        lbs.update(region_lbs)
+        statuses[region] = region_stacks
+
+    expected = dict((e['DNSTarget'].lower(), e) for e in manifest or [])
+    report = {'regions': list(regions), 'zones': 0, 'records': 0,
+              'elb_records': 0, 'load_balancers': len(lbs), 'ok': 0,
+              'unscanned': 0, 'dangling': [], 'stale': [], 'mismatched': []}
+
+    with span('drift_scan'):
+        for record in iter_elb_records(report):
+            report['elb_records'] += 1
+            if record['region'] not in statuses:
+                report['unscanned'] += 1
+                continue
+
+            lb = lbs.get(record['target'])
+            if lb is None:
+                record['reason'] = 'no such load balancer'
+                report['dangling'].append(record)
+                continue
+
+            record['elb'] = lb['elb']
+            record['stackname'] = lb['stackname']
+            status = statuses[record['region']].get(lb['stackname'])
+            record['stack_status'] = status
+            entry = expected.get(record['name'])
+
+            if lb['stackname'] is None:
+                record['reason'] = 'load balancer was not made by CloudFormation'
+                report['stale'].append(record)
+            elif status is None or status in GONE_STACK_STATUSES:
+                record['reason'] = 'stack is ' + (status or 'gone')
+                report['stale'].append(record)
+            elif record['alias_zone_id'] is not None \
+                    and record['alias_zone_id'] != lb['zone_id']:
+                record['reason'] = 'alias hosted zone is ' \
+                    + record['alias_zone_id'] + ', the load balancer is in ' \
+                    + str(lb['zone_id'])
+                report['mismatched'].append(record)
+            elif entry is not None and (entry['stackname'], entry['AWSRegion']) \
+                    != (lb['stackname'], record['region']):
+                record['reason'] = 'manifest has stack ' + entry['stackname'] \
+                    + ' in ' + str(entry['AWSRegion'])
+                report['mismatched'].append(record)
+            else:
+                report['ok'] += 1
+
+    return report
+
+
+# the report to path, - for stdout. 1 if anything needs looking at
+def write_drift_report(report, path):
+    problems = len(report['dangling']) + len(report['stale']) \
+        + len(report['mismatched'])
+    if path == '-':
+        print(json.dumps(report, indent=2, sort_keys=True))
+        return 1 if problems else 0
+
+    write_json_file(path, report)
+    info('drift: ' + str(report['records']) + ' records in '
+         + str(report['zones']) + ' zones, ' + str(report['elb_records'])
+         + ' point at ELBs, ' + str(report['ok']) + ' ok, '
+         + str(len(report['dangling'])) + ' dangling, '
+         + str(len(report['stale'])) + ' stale, '
+         + str(len(report['mismatched'])) + ' mismatched, '
+         + str(report['unscanned']) + ' in other regions')
+    if problems:
+        warning(str(problems) + ' record(s) need looking at')
+        return 1
+    return 0
+
+
+# the --journal's lines, oldest first. Lines that don't parse, from a run
+# that was killed part way through a write, are skipped
+def read_journal(path):
+    entries = []
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+    except (IOError, OSError) as e:
+        bail('unable to read the journal:' + path + ' ' + str(e))
+    return entries
+
+
+# zone id -> (changes, previous) that put back what entries changed, as it
+# was before the first of them. name limits it to one record. A record
+# that didn't exist is deleted, so what the run left must still be there
+def rollback_changes(entries, name=None):
+    before = {}
+    after = {}
+    zones = {}
+
+    for entry in entries:
+        for change in entry['changes']:
+            key = record_key(change['record'])
+            if name is not None and key[0] != name.lower().rstrip('.') + '.':
+                continue
+            zones[key] = entry['zone_id']
+            before.setdefault(key, change['previous'])
+            after[key] = None if change['action'] == 'DELETE' else change['record']
+
+    rollback = {}
+    for key in sorted(before, key=lambda k: (k[0], k[1], k[2] or '')):
+        if before[key] == after[key]:
+            continue
+        changes, previous = rollback.setdefault(zones[key], ([], {}))
+        previous[key] = after[key]
+        if before[key] is None:
+            changes.insert(0, {'Action': 'DELETE', 'ResourceRecordSet': after[key]})
+        else:
+            changes.append({'Action': 'UPSERT', 'ResourceRecordSet': before[key]})
+    return rollback
+
+
+# --rollback, put back what a run (last for the latest) changed with one
+# ChangeBatch per zone, from the journal alone. No stacks or ELBs are read
+def rollback_run(run, journal_file, name=None):
+    entries = read_journal(journal_file)
+    runs = []
+    for entry in entries:
+        if entry['run'] not in runs:
+            runs.append(entry['run'])
+
+    if run == 'list':
+        for r in runs:
+            records = sorted(set(c['record']['Name'].rstrip('.') for e in entries
+                                 if e['run'] == r for c in e['changes']))
+            info(r + ' ' + ', '.join(records))
+        return 0
+    if run == 'last' and runs:
+        run = runs[-1]
+    if run not in runs:
+        bail('run ' + run + ' is not in the journal')
+
+    zones = rollback_changes([e for e in entries if e['run'] == run], name)
+    if not zones:
+        bail('nothing to roll back in run ' + run
+             + ('' if name is None else ' for ' + name))
+
+    # a rollback is a run too, it can be rolled back in turn
+    journal = JournalRun(journal_file)
+    change_ids = []
+    for zone_id, (changes, previous) in sorted(zones.items()):
+        for change in changes:
+            info('rollback ' + change['Action'] + ' '
+                 + change['ResourceRecordSet']['Name'] + ' '
+                 + change['ResourceRecordSet']['Type'])
+        change_ids += update_r53_batch(zone_id, changes, previous,
+                                       'PublishDNS.py rollback of ' + run,
+                                       journal)
+
+    tracker = R53ChangeTracker(change_ids)
+    if tracker.wait_insync(MAX_WAIT) == -1:
+        bail('rollback sent, Route53 has not synced it', Route53Error)
+    tracker.report()
+    progress('rolled back run ' + run)
+    journal.report()
+    return 0
+
+
+class Publisher:
+    """Points Route53 records at stacks' load balancers, the CLI is a thin
+    wrapper around one. Options live on the Publisher, journal_file and
+    stack_cache_file (--journal and --stackcache) are off unless given. AWS
+    clients are made on first use from the shared session, so any number
+    of publishes can run at once in one process. Failures raise
+    PublishError"""
+    def __init__(self, region, elb_selector=None, alias_types=None,
+                 ready_port=None, confirm=True, ramp_ttl=None,
+                 ramp_soak=RAMP_SOAK, ramp_state_file=None, shift_weights=None,
+                 shift_dwell=SHIFT_DWELL, shift_healthcheck=None,
+                 shift_from=None, warmup_url=None,
+                 warmup_requests=WARMUP_REQUESTS,
+                 warmup_concurrency=WARMUP_CONCURRENCY,
+                 latency_slo=LATENCY_SLO, max_error_rate=MAX_ERROR_RATE,
+                 journal_file=None, stack_cache_file=None):
+        self.region = region
+        self.elb_selector = elb_selector
+        self.alias_types = alias_types
+        self.ready_port = ready_port
+        self.confirm = confirm
+        self.ramp_ttl = ramp_ttl
+        self.ramp_soak = ramp_soak
+        self.ramp_state_file = ramp_state_file
+        self.shift_weights = shift_weights
+        self.shift_dwell = shift_dwell
+        self.shift_healthcheck = shift_healthcheck
+        self.shift_from = shift_from
+        self.warmup_url = warmup_url
+        self.warmup_requests = warmup_requests
+        self.warmup_concurrency = warmup_concurrency
+        self.latency_slo = latency_slo
+        self.max_error_rate = max_error_rate
+        self.journal_file = journal_file
+        self.stack_cache_file = stack_cache_file
+
+    # the stack's load balancer, as a discover_stack() result
+    def find_elb(self, stack_name, selector=None):
+        with span('elb_lookup', stack=stack_name):
+            result = discover_stacks([(self.region, stack_name, selector)],
+                                     cache_file=self.stack_cache_file)[0]
+        if result['error'] is not None:
+            bail('Stack(' + stack_name + ') in ' + str(self.region) + ': '
+                 + result['error'] + ' ' + str(result['status']), StackError)
+        info('Stack(' + stack_name + '), found ELB:' + result['elb'])
+        debug('ELB from the stack ' + result['source'])
+        return result
+
+    # For new stacks; ELB name won't be resolvable yet, so poll...
+    def wait_resolvable(self, dns_name):
+        with span('resolve_poll', host=dns_name):
+            ret = poll_for_resolve(dns_name, MAX_WAIT, self.ready_port)
+        if ret == -1:
+            bail('Timeout on resolution of the ELB DNS name. ' + dns_name
+                 + ' does not resolve', DNSTimeoutError)
+
+    # --warmup, load on the new load balancer until it's as quick as the
+    # live target. Nothing has been changed if this fails
+    def warm_up(self, dns_name, live_target=None):
+        with span('warmup', host=dns_name):
+            failed = warmup_gate(self.warmup_url, dns_name, live_target,
+                                 self.warmup_requests, self.warmup_concurrency,
+                                 self.latency_slo, self.max_error_rate)
+        if failed:
+            bail('warm up of ' + dns_name + ' failed, not publishing: '
+                 + '; '.join(failed), HealthCheckError)
+
+    # --GetELBDNS, the stack's load balancer once it resolves
+    def elb_dns(self, stack_name):
+        elb = self.find_elb(stack_name, self.elb_selector)
+        self.wait_resolvable(elb['dns_name'])
+        return elb['dns_name']
+
+    # point dns_target at stack_name's load balancer and wait until DNS
+    # has it. Returns what was done, raises PublishError if it couldn't be
+    def publish(self, stack_name, dns_target):
+        elb = self.find_elb(stack_name, self.elb_selector)
+        self.wait_resolvable(elb['dns_name'])
+
+        with span('zone_lookup'):
+            dns_suffix = parse_dns_suffix(dns_target,
+                                          apex=self.alias_types is not None)
+            if dns_suffix == -1:
+                bail('invalid _DNS_suffix:' + str(dns_target), ZoneError)
+            zone_id = get_r53_zoneid(dns_suffix + '.')
+        info('Using AWS zoneid:' + zone_id + ' for ' + dns_suffix)
+
+        dns_rec = DNSCNameRecord(dns_target)
+        dns_rec.zoneid = zone_id
+        dns_rec.journal = new_journal_run(self.journal_file)
+
+        # does it exist?  If it does we record the details
+        with span('record_lookup'):
+            ret = get_r53_cname_rec(dns_rec)
+        if ret == 0:
+            info(str(dns_target) + ' already exists, DNS has...')
+            info('--------------------------------------------------------------')
+            info(asyncio.run(dns_backend().show(dns_target)))
+            info('--------------------------------------------------------------')
+            info('TTL = ' + str(dns_rec.ttl) + ' seconds')
+
+        if self.warmup_url is not None:
+            self.warm_up(elb['dns_name'], dns_rec._cname_target)
+
+        with span('upsert', record=dns_target):
+            ret = self.change_record(dns_rec, stack_name, elb)
+        if ret != int(0):
+            warning('warning: Route53 DNS CNAME add/update returned an error '
+                    'and may have failed! Will continue to polling for result')
+
+        tracker = R53ChangeTracker([dns_rec.change_id])
+        if tracker.wait_insync(MAX_WAIT) == -1:
+            bail('DNS CNAME update fail, Route53 has not synced the change',
+                 Route53Error)
+
+        # INSYNC means every Route53 name server has it, this just checks
+        if self.confirm:
+            ret = tracker.confirm(dns_rec.name + '.', elb['dns_name'],
+                                  get_r53_nameservers(zone_id) or None,
+                                  CONFIRM_WAIT,
+                                  self.alias_types[0] if self.alias_types else None)
+            if ret == -1:
+                bail('DNS CNAME update fail, the DNS CNAME update has not '
+                     'propergated', DNSTimeoutError)
+        tracker.report()
+
+        info(dns_rec.name + ' -> ELB(stack = ' + stack_name + ')')
+        if dns_rec.journal is not None:
+            dns_rec.journal.report()
+        return {'name': dns_rec.name, 'target': elb['dns_name'],
+                'zone_id': zone_id, 'change_id': dns_rec.change_id,
+                'journal_run': dns_rec.journal and dns_rec.journal.run,
+                'phases': dict(tracker.phases)}
+
+    # shifted, ramped, ALIAS or plain CNAME, as configured
+    def change_record(self, dns_rec, stack_name, elb):
+        if self.shift_weights is not None and dns_rec._cname_target is not None:
+            blue_target = dns_rec._cname_target.rstrip('.')
+            if self.shift_from is not None:
+                blue_target = self.find_elb(self.shift_from)['dns_name']
+            ret = weighted_shift(dns_rec, elb['dns_name'], stack_name,
+                                 blue_target, self.shift_from or 'previous',
+                                 self.shift_weights, self.shift_dwell,
+                                 self.shift_healthcheck)
+            if ret == -1:
+                bail('health check failed, ' + dns_rec.name + ' rolled back to '
+                     + blue_target, HealthCheckError)
+            return ret
+        if self.ramp_ttl is not None and dns_rec._cname_target is not None:
+            return ttl_ramp_cutover(dns_rec, elb['dns_name'], self.ramp_ttl,
+                                    self.ramp_soak,
+                                    self.ramp_state_file or '.PublishDNS-'
+                                    + dns_rec.name + '.ramp.json')
+        if self.alias_types is None:
+            return update_r53(dns_rec, elb['dns_name'])
+        return update_r53_alias(dns_rec, elb['dns_name'], elb['zone_id'],
+                                self.alias_types)
+
+    def publish_manifest(self, manifest_file, print_only=False):
+        manifest = load_manifest(manifest_file, self.region)
+        info('manifest ' + manifest_file + ': ' + str(len(manifest))
+             + ' record(s)')
+        return self.publish_entries(manifest, print_only)
+
+    def publish_entries(self, manifest, print_only=False):
+        return publish_entries(manifest, self.alias_types, self.ready_port,
+                               print_only, self.journal_file,
+                               self.stack_cache_file)
+
+    # asyncio entry points, the work runs in the loop's executor
+    async def publish_async(self, stack_name, dns_target):
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.publish, stack_name, dns_target)
+
+    async def publish_entries_async(self, manifest):
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.publish_entries, manifest)
+
+
+# whichever mode the command line asked for, returns the exit status
+def run_cli(args, publisher):
+    if args.rollback is not None:
+        return rollback_run(args.rollback, args.journal, args.DNSTarget)
+
+    if args.watch is not None:
+        return watch_stacks(args.watch, publisher)
+
+    if args.drift is not None:
+        manifest = None
+        if args.manifest is not None:
+            manifest = load_manifest(args.manifest, args.AWSRegion)
+        return write_drift_report(drift_scan(args.regions, manifest), args.drift)
+
+    if args.listEndpoints:
+        for endpoint in describe_stack_endpoints(args.AWSRegion, args.stackname):
+            print(json.dumps(endpoint, sort_keys=True))
+        return 0
+
+    if args.manifest is not None:
+        ret = publisher.publish_manifest(args.manifest, args.GetELBDNS)
+    # just print elb dns name and exit...
+    elif args.GetELBDNS:
+        print(publisher.elb_dns(args.stackname))
+        return 0
     else:
-        _DNS_suffix = ret
-
-    zone_id = get_r53_zoneid(_DNS_suffix + '.')
-    info('Using AWS zoneid:'+zone_id + ' for ' + _DNS_suffix)
-
-    _live_dns_record = DNSCNameRecord(_DNS_target)
-    _live_dns_record.zoneid = zone_id
-
-    # does it exist?  If it does we record the details
-    ret = get_r53_cname_rec(_live_dns_record)
-
-    if ret == 0:
-        info(str(_DNS_target) + ' already exists, dig follows...')
-        info('--------------------------------------------------------------')
-        info(str(run_os_command('dig ' + _DNS_target)))
-        info('--------------------------------------------------------------')
-        info('TTL = ' + str(_live_dns_record.ttl) + ' seconds')
-
-    ret = update_r53(_live_dns_record, _cname_target)
-    if ret != int(0):
-        warning('warning: Route53 DNS CNAME add/update returned an error '
-                'and may have failed! Will continue to polling for result')
-
-    if _live_dns_record.ttl is None:
-        _live_dns_record.ttl = 60
-    ret = poll_for_cname_update(_live_dns_record.name
-                                + '.', _cname_target,
-                                (_live_dns_record.ttl*2))
-    if ret == -1:
-        bail('DNS CNAME update fail, the DNS CNAME update has not propergated')
+        publisher.publish(args.stackname, args.DNSTarget)
+        ret = 0
 
-    info(_live_dns_record.name + ' -> ELB(stack = ' + _stack_name + ')')
+    return ret
+
+
+def main():
+    args, publisher = parsecommandline()
+    try:
+        sys.exit(run_cli(args, publisher))
+    except PublishError as e:
+        print(RED + str(e) + ENDC)
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,75 @@
+#!/usr/local/bin/python3
+
+# StubDNS.py
+
+# Test and benchmark helper for PublishDNS.py, a stand-in authoritative
+# name server
+
+import socket
+import struct
+import threading
+
+
+# A tiny authoritative DNS server on 127.0.0.1, answers every question
+# with whatever self.records holds for the name, e.g.
+# {'www.x.': ('CNAME', 'elb.')}. Replies are cut to truncate bytes if it's
+# set, with the TC bit if tc is
+class StubDNSServer(threading.Thread):
+
+    def __init__(self, records):
+        threading.Thread.__init__(self, daemon=True)
+        self.records = records
+        self.queries = 0
+        self.truncate = None
+        self.tc = False
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.address = self.sock.getsockname()
+
+    @staticmethod
+    def encode_name(name):
+        out = b''
+        for label in name.rstrip('.').split('.'):
+            out += struct.pack('B', len(label)) + label.encode('ascii')
+        return out + b'\x00'
+
+    def answer(self, query):
+        qid = struct.unpack('>H', query[:2])[0]
+        offset = 12
+        labels = []
+        while query[offset] != 0:
+            length = query[offset]
+            labels.append(query[offset + 1:offset + 1 + length]
+                          .decode('ascii'))
+            offset += 1 + length
+        question = query[12:offset + 5]
+        name = '.'.join(labels).lower() + '.'
+
+        rtype, value = self.records.get(name, (None, None))
+        if rtype is None:
+            return struct.pack('>HHHHHH', qid, 0x8403, 1, 0, 0, 0) + question
+        if rtype == 'CNAME':
+            rdata = self.encode_name(value)
+            type_code = 5
+        else:
+            rdata = socket.inet_aton(value)
+            type_code = 1
+        rr = struct.pack('>HHHIH', 0xC00C, type_code, 1, 60,
+                         len(rdata)) + rdata
+        return struct.pack('>HHHHHH', qid, 0x8400, 1, 1, 0, 0) + question + rr
+
+    def run(self):
+        while True:
+            try:
+                query, addr = self.sock.recvfrom(512)
+            except OSError:
+                return
+            self.queries += 1
+            reply = self.answer(query)
+            if self.tc:
+                flags = struct.unpack('>H', reply[2:4])[0] | 0x0200
+                reply = reply[:2] + struct.pack('>H', flags) + reply[4:]
+            self.sock.sendto(reply[:self.truncate], addr)
+
+    def stop(self):
+        self.sock.close()
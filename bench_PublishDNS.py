@@ -0,0 +1,455 @@
+#!/usr/local/bin/python3
+
+# bench_PublishDNS.py
+
+# Offline benchmarks for the PublishDNS.py discovery and publish paths.
+# AWS is a local stand-in with injected per call latency. Route53 is a real
+# botocore client answered from it, so injected throttles are real
+# Throttling errors that PublishDNS's limiter and retries have to handle.
+# DNS is StubDNS.py on 127.0.0.1. Nothing is sent to AWS
+
+# examples
+
+# Run everything, write the results as JSON
+# ./bench_PublishDNS.py --output bench.json
+
+# Quicker, smaller sizes, 20ms a call and every 10th Route53 call throttled
+# ./bench_PublishDNS.py --quick --latency 0.02 --throttle 10
+
+import argparse
+import bisect
+import botocore
+import botocore.awsrequest
+import botocore.exceptions
+import json
+import os
+import platform
+import statistics
+import sys
+import threading
+import time
+
+import PublishDNS
+from StubDNS import StubDNSServer
+
+# what Route53 sends back when it throttles a call
+THROTTLED_XML = (b'<?xml version="1.0"?><ErrorResponse '
+                 b'xmlns="https://route53.amazonaws.com/doc/2013-04-01/">'
+                 b'<Error><Type>Sender</Type><Code>Throttling</Code>'
+                 b'<Message>Rate exceeded</Message></Error>'
+                 b'<RequestId>bench</RequestId></ErrorResponse>')
+
+
+class LocalPaginator:
+    """Pages through a LocalAWS list call, like a botocore paginator"""
+    def __init__(self, aws, operation):
+        self.aws = aws
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+        return getattr(self.aws, 'paginate_' + self.operation)(**kwargs)
+
+
+class LocalBody:
+    """The raw body of a made up botocore response"""
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+class LocalAWS:
+    """Route53, CloudFormation and ELB for the benchmarks, in memory.
+    Every call sleeps latency secs. Route53 is reached through a real
+    botocore client (see route53_client()), which has every
+    throttle_every'th HTTP attempt answered with a Throttling error"""
+    exceptions = botocore.exceptions
+
+    def __init__(self, latency=0.0, throttle_every=0):
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.calls = 0
+        self.attempts = 0
+        self.lock = threading.Lock()
+        self.zones = {}
+        self.records = {}
+        self.record_names = {}
+        self.stacks = {}
+        self.changes = 0
+
+    def _call(self):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.latency)
+
+    # botocore hooks on the Route53 client. The call's own arguments are
+    # kept for after-call, which fills the empty reply in from LocalAWS
+    def on_parameters(self, params, context, **kwargs):
+        context['bench_params'] = dict(params)
+
+    def on_send(self, request, **kwargs):
+        with self.lock:
+            self.attempts += 1
+            throttled = self.throttle_every \
+                and self.attempts % self.throttle_every == 0
+        if throttled:
+            time.sleep(self.latency)
+            return botocore.awsrequest.AWSResponse(request.url, 400, {},
+                                                   LocalBody(THROTTLED_XML))
+        return botocore.awsrequest.AWSResponse(request.url, 200, {},
+                                               LocalBody(b''))
+
+    def on_reply(self, http_response, parsed, model, context, **kwargs):
+        if http_response.status_code == 200:
+            operation = getattr(self, botocore.xform_name(model.name))
+            parsed.update(operation(**context['bench_params']))
+
+    # a real Route53 client, made the way PublishDNS makes its own
+    def route53_client(self):
+        client = PublishDNS.get_boto_client('route53', 'us-east-1')
+        client.meta.events.register('before-parameter-build.route53',
+                                    self.on_parameters)
+        client.meta.events.register('before-send.route53', self.on_send)
+        client.meta.events.register('after-call.route53', self.on_reply)
+        return client
+
+    def get_paginator(self, operation):
+        return LocalPaginator(self, operation)
+
+    # setup, not counted as calls
+    def add_zone(self, name, records=0):
+        zone_id = 'Z' + str(len(self.zones))
+        self.zones[zone_id] = name
+        self.records[zone_id] = {}
+        for i in range(0, records):
+            self._put(zone_id, {'Name': 'host' + str(i) + '.' + name,
+                                'Type': 'CNAME', 'TTL': 300,
+                                'ResourceRecords':
+                                [{'Value': 'old.elb.amazonaws.com'}]})
+        return zone_id
+
+    def add_stack(self, stack_name, elb_dns='localhost'):
+        self.stacks[stack_name] = elb_dns
+
+    # where a record set sorts, and what a change to it replaces
+    @staticmethod
+    def _key(rrs):
+        return (rrs['Name'], rrs['Type'], rrs.get('SetIdentifier', ''))
+
+    def _put(self, zone_id, rrs):
+        key = self._key(rrs)
+        if key not in self.records[zone_id]:
+            self.record_names.pop(zone_id, None)
+        self.records[zone_id][key] = rrs
+
+    # route53
+    def list_hosted_zones(self, Marker=None, MaxItems='100'):
+        self._call()
+        zones = sorted(self.zones.items(), key=lambda z: z[0])
+        start = [z[0] for z in zones].index(Marker) if Marker else 0
+        end = start + int(MaxItems)
+        ret = {'HostedZones': [{'Id': '/hostedzone/' + zone_id, 'Name': name,
+                                'CallerReference': zone_id,
+                                'Config': {'PrivateZone': False}}
+                               for zone_id, name in zones[start:end]],
+               'IsTruncated': end < len(zones), 'Marker': Marker or '',
+               'MaxItems': MaxItems}
+        if ret['IsTruncated']:
+            ret['NextMarker'] = zones[end][0]
+        return ret
+
+    def list_resource_record_sets(self, HostedZoneId, StartRecordName=None,
+                                  StartRecordType=None,
+                                  StartRecordIdentifier=None, MaxItems='300'):
+        self._call()
+        records = self.records[HostedZoneId]
+        if HostedZoneId not in self.record_names:
+            self.record_names[HostedZoneId] = sorted(records)
+        keys = self.record_names[HostedZoneId]
+        start = bisect.bisect_left(keys, (StartRecordName or '',
+                                          StartRecordType or '',
+                                          StartRecordIdentifier or ''))
+        page = keys[start:start + int(MaxItems)]
+        ret = {'ResourceRecordSets': [records[k] for k in page],
+               'IsTruncated': start + int(MaxItems) < len(keys)}
+        if ret['IsTruncated']:
+            following = keys[start + int(MaxItems)]
+            ret['NextRecordName'], ret['NextRecordType'] = following[:2]
+            if following[2]:
+                ret['NextRecordIdentifier'] = following[2]
+        return ret
+
+    def change_resource_record_sets(self, HostedZoneId, ChangeBatch):
+        self._call()
+        for change in ChangeBatch['Changes']:
+            rrs = change['ResourceRecordSet']
+            if change['Action'] == 'DELETE':
+                self.records[HostedZoneId].pop(self._key(rrs), None)
+                self.record_names.pop(HostedZoneId, None)
+            else:
+                self._put(HostedZoneId, rrs)
+        self.changes += 1
+        return {'ResponseMetadata': {'HTTPStatusCode': 200,
+                                     'RequestId': 'R' + str(self.changes)},
+                'ChangeInfo': {'Id': '/change/C' + str(self.changes),
+                               'Status': 'PENDING'}}
+
+    def get_hosted_zone(self, Id):
+        self._call()
+        zone_id = Id.split('/')[-1]
+        return {'HostedZone': {'Id': '/hostedzone/' + zone_id,
+                               'Name': self.zones[zone_id],
+                               'ResourceRecordSetCount':
+                               len(self.records[zone_id])}}
+
+    def get_change(self, Id):
+        self._call()
+        return {'ChangeInfo': {'Id': Id, 'Status': 'INSYNC'}}
+
+    # cloudformation and elb
+    def describe_stacks(self, StackName):
+        self._call()
+        return {'Stacks': [{'StackName': StackName,
+                            'StackStatus': 'CREATE_COMPLETE'}]}
+
+    def paginate_list_exports(self):
+        self._call()
+        yield {'Exports': []}
+
+    def paginate_list_stack_resources(self, StackName):
+        self._call()
+        yield {'StackResourceSummaries': [{
+            'LogicalResourceId': 'LoadBalancer',
+            'PhysicalResourceId': StackName + '-elb',
+            'ResourceType': 'AWS::ElasticLoadBalancing::LoadBalancer'}]}
+
+    def describe_load_balancers(self, LoadBalancerNames):
+        self._call()
+        return {'LoadBalancerDescriptions': [{
+            'LoadBalancerName': name,
+            'DNSName': self.stacks[name[:-len('-elb')]],
+            'CanonicalHostedZoneNameID': 'ZELB'}
+            for name in LoadBalancerNames]}
+
+
+# point PublishDNS at aws, with fresh caches and a fresh Route53 limiter
+def use_aws(aws, regions=('ap-southeast-2',)):
+    PublishDNS._boto_clients.clear()
+    PublishDNS._r53_limiter = None
+    PublishDNS._boto_r53 = aws.route53_client()
+    PublishDNS._zone_index = None
+    PublishDNS._zone_cache_file = None
+    PublishDNS._record_cache.clear()
+    PublishDNS._exports.clear()
+    for region in regions:
+        for service in ('cloudformation', 'elb', 'elbv2'):
+            PublishDNS._boto_clients[(service, region)] = aws
+
+
+def bench_zone_lookup(args, zones):
+    aws = LocalAWS(args.latency, args.throttle)
+    for i in range(0, zones):
+        aws.add_zone('zone' + str(i) + '.example.com.')
+    use_aws(aws)
+
+    def run():
+        PublishDNS._zone_index = None
+        for i in range(0, 10):
+            PublishDNS.get_r53_zoneid('zone' + str(zones - 1 - i % zones)
+                                      + '.example.com')
+    return aws, run
+
+
+def bench_record_lookup(args, records):
+    aws = LocalAWS(args.latency, args.throttle)
+    zone_id = aws.add_zone('big.example.com.', records)
+    use_aws(aws)
+
+    def run():
+        for i in range(0, 20):
+            dns_rec = PublishDNS.DNSCNameRecord(
+                'host' + str(i * records // 20) + '.big.example.com')
+            dns_rec.zoneid = zone_id
+            PublishDNS.get_r53_cname_rec(dns_rec)
+    return aws, run
+
+
+# many lookups in one zone, read whole into the record cache first
+def bench_record_lookup_bulk(args, records):
+    aws = LocalAWS(args.latency, args.throttle)
+    zone_id = aws.add_zone('big.example.com.', records)
+    use_aws(aws)
+
+    def run():
+        PublishDNS._record_cache.clear()
+        PublishDNS.prefetch_zone_records(zone_id, 2000)
+        for i in range(0, 2000):
+            dns_rec = PublishDNS.DNSCNameRecord(
+                'host' + str(i * records // 2000) + '.big.example.com')
+            dns_rec.zoneid = zone_id
+            PublishDNS.get_r53_cname_rec(dns_rec)
+    return aws, run
+
+
+def bench_batch_upsert(args, records):
+    aws = LocalAWS(args.latency, args.throttle)
+    zone_id = aws.add_zone('example.com.')
+    use_aws(aws)
+    changes = [PublishDNS.cname_change('host' + str(i) + '.example.com.',
+                                       'green.elb.amazonaws.com')
+               for i in range(0, records)]
+
+    def run():
+        ids = PublishDNS.update_r53_batch(zone_id, changes)
+        PublishDNS.R53ChangeTracker(ids).wait_insync(PublishDNS.MAX_WAIT)
+    return aws, run
+
+
+# manifest in, records INSYNC and one confirmed against 3 stub name servers
+# serving what was published to the zone
+def bench_cutover(args, records):
+    regions = ('ap-southeast-2', 'us-east-1', 'eu-west-1')
+    aws = LocalAWS(args.latency, args.throttle)
+    zone_id = aws.add_zone('example.com.')
+    use_aws(aws, regions)
+    manifest = []
+    for i in range(0, records):
+        aws.add_stack('green-' + str(i))
+        manifest.append({'stackname': 'green-' + str(i),
+                         'DNSTarget': 'host' + str(i) + '.example.com',
+                         'AWSRegion': regions[i % len(regions)],
+                         'elb': None})
+
+    servers = [StubDNSServer({}) for _ in range(3)]
+    for server in servers:
+        server.start()
+
+    def run():
+        PublishDNS._zone_index = None
+        aws.records[zone_id].clear()
+        PublishDNS.Publisher(regions[0]).publish_entries(manifest)
+        for (name, rtype, _), rrs in aws.records[zone_id].items():
+            value = rrs['ResourceRecords'][0]['Value'].rstrip('.') + '.'
+            for server in servers:
+                server.records[name] = (rtype, value)
+        tracker = PublishDNS.R53ChangeTracker([])
+        if tracker.confirm('host0.example.com.', 'localhost',
+                           [s.address for s in servers], 5) != 0:
+            raise RuntimeError('stub name servers did not confirm the cutover')
+    return aws, run
+
+
+# Route53 throttles PublishDNS saw and retries its limiter made, from its
+# own counters, under botocore's service id for it (route-53)
+def r53_throttles():
+    return sum(v for (n, label), v in PublishDNS._counters.items()
+               if n == 'aws_throttles' and label.startswith('route-53.'))
+
+
+def measure(name, params, setup, runs):
+    aws, run = setup()
+    times = []
+    calls = []
+    throttles = []
+    retries = []
+    for _ in range(0, runs):
+        calls_before = aws.calls
+        throttles_before = r53_throttles()
+        retries_before = PublishDNS._r53_limiter.retries
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+        calls.append(aws.calls - calls_before)
+        throttles.append(r53_throttles() - throttles_before)
+        retries.append(PublishDNS._r53_limiter.retries - retries_before)
+
+    return {'name': name,
+            'params': params,
+            'runs': runs,
+            'min_secs': round(min(times), 6),
+            'median_secs': round(statistics.median(times), 6),
+            'aws_calls': calls[-1],
+            'r53_throttles': throttles[-1],
+            'r53_retries': retries[-1]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks for '
+                                     'PublishDNS.py')
+    parser.add_argument('--output',
+                        default=None,
+                        help='write the results here as JSON, default stdout')
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0.005,
+                        help='secs added to every AWS call')
+    parser.add_argument('--throttle',
+                        type=int,
+                        default=0,
+                        help='throttle every Nth Route53 call, 0 for never')
+    parser.add_argument('--R53Rate',
+                        type=float,
+                        default=PublishDNS.R53_RATE,
+                        help='PublishDNS\'s Route53 requests/sec, as its '
+                        '--R53Rate')
+    parser.add_argument('--runs',
+                        type=int,
+                        default=3,
+                        help='runs per benchmark')
+    parser.add_argument('--quick',
+                        action='store_true',
+                        help='smaller sizes, for a smoke test')
+    args = parser.parse_args()
+
+    zone_counts = (1, 100, 500) if args.quick else (1, 100, 5000)
+    record_counts = (1000,) if args.quick else (1000, 20000)
+    batch_sizes = (200,) if args.quick else (200, 1000)
+    cutover_sizes = (20,) if args.quick else (40, 200)
+
+    # the benchmarks measure the work, not the output
+    PublishDNS.info = PublishDNS.progress = PublishDNS.warning = \
+        lambda message: None
+    PublishDNS._r53_rate = args.R53Rate
+    # requests are signed before the stand-in answers them, never sent
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+
+    results = []
+    for zones in zone_counts:
+        results.append(measure('zone_lookup', {'zones': zones},
+                               lambda: bench_zone_lookup(args, zones),
+                               args.runs))
+    for records in record_counts:
+        results.append(measure('record_lookup', {'records': records},
+                               lambda: bench_record_lookup(args, records),
+                               args.runs))
+    for records in record_counts:
+        results.append(measure('record_lookup_bulk',
+                               {'records': records, 'lookups': 2000},
+                               lambda: bench_record_lookup_bulk(args, records),
+                               args.runs))
+    for records in batch_sizes:
+        results.append(measure('batch_upsert', {'records': records},
+                               lambda: bench_batch_upsert(args, records),
+                               args.runs))
+    for records in cutover_sizes:
+        results.append(measure('cutover', {'records': records, 'regions': 3},
+                               lambda: bench_cutover(args, records),
+                               args.runs))
+
+    report = {'python': platform.python_version(),
+              'latency': args.latency,
+              'throttle_every': args.throttle,
+              'r53_rate': args.R53Rate,
+              'benchmarks': results}
+    text = json.dumps(report, indent=2, sort_keys=True) + '\n'
+    if args.output is None:
+        sys.stdout.write(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
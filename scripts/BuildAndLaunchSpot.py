@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 # I used this to launch spot nodes - back in the day, it relies on my puppet3 server (now dead, burried and cremated)
+# superseded by LaunchStacks.py (python3, boto3, launches stacks concurrently)
 
 import sys
 import os
@@ -0,0 +1,429 @@
+#!/usr/local/bin/python3
+
+# CFNTemplates.py
+
+# Parse, index and diff CloudFormation templates locally, no API calls
+#   JSON or YAML (with the !Ref, !GetAtt, !Sub.. short forms). Each
+#   template's index is kept in a cache keyed by a hash of its content,
+#   so only templates that have changed are parsed again
+
+# examples
+
+# What's in them, resources, parameters, outputs, and anything that
+# refers to something the template doesn't have
+# ./CFNTemplates.py ../cloudformation/*.json ../cloudformation/*.yaml
+
+# The logical ids of the load balancers in a template
+# ./CFNTemplates.py --lbs ../cloudformation/NetworkLoadBalancerSandpit.yaml
+
+# What refers to a resource or parameter, directly or not
+# ./CFNTemplates.py --refs EcsSecurityGroup ../cloudformation/SandpitECS.yaml
+
+# What changed between two versions of a template
+# ./CFNTemplates.py --diff old/SandpitECS.yaml ../cloudformation/SandpitECS.yaml
+
+# From Python, LaunchStacks.py --offline does this
+#   indexes, errors = CFNTemplates.analyse_templates(paths, CFNTemplates.INDEX_CACHE)
+#   indexes[path]['parameters'], indexes[path]['capabilities']
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+
+# template content hash -> index, relative to where it's run
+INDEX_CACHE = '.CFNTemplates-index.json'
+
+LB_RESOURCE_TYPES = ('AWS::ElasticLoadBalancing::LoadBalancer',
+                     'AWS::ElasticLoadBalancingV2::LoadBalancer')
+
+# IAM resources need CAPABILITY_IAM, or CAPABILITY_NAMED_IAM when named
+IAM_RESOURCE_NAMES = {'AWS::IAM::AccessKey': None,
+                      'AWS::IAM::Group': 'GroupName',
+                      'AWS::IAM::InstanceProfile': 'InstanceProfileName',
+                      'AWS::IAM::ManagedPolicy': 'ManagedPolicyName',
+                      'AWS::IAM::Policy': None,
+                      'AWS::IAM::Role': 'RoleName',
+                      'AWS::IAM::User': 'UserName',
+                      'AWS::IAM::UserToGroupAddition': None}
+
+# ${Name} or ${Resource.Attr} in a Fn::Sub, ${!Literal} isn't one
+SUB_VARIABLE = re.compile(r'\$\{([^!}][^}]*)\}')
+
+# Pretty Colours
+RED = '\033[91m'
+GREEN = '\033[92m'
+YELLOW = '\033[93m'
+ENDC = '\033[0m'
+
+# globals
+_show_debug = False
+_yaml_loader = None
+
+
+class TemplateError(Exception):
+    """A template that can't be read or parsed"""
+
+
+def bail(message):
+    print(RED + message + ENDC)
+    sys.exit(1)
+
+
+def warning(message):
+    print(YELLOW + message + ENDC)
+
+
+def info(message):
+    print(message)
+
+
+def progress(message):
+    print(GREEN + message + ENDC)
+
+
+def debug(message):
+    if _show_debug:
+        print(GREEN + 'debug::' + str(message) + ENDC)
+
+
+def parsecommandline():
+    global _show_debug
+
+    parser = argparse.ArgumentParser(description='Index, query and diff '
+                                     'CloudFormation templates locally')
+    parser.add_argument('templates',
+                        nargs='*',
+                        help='Templates, JSON or YAML')
+    parser.add_argument('--debug',
+                        action='store_const',
+                        const=True,
+                        default=False,
+                        required=False,
+                        help='Enable debug, also lists every reference')
+    parser.add_argument('--lbs',
+                        action='store_const',
+                        const=True,
+                        default=False,
+                        required=False,
+                        help='Just the load balancer logical ids')
+    parser.add_argument('--refs',
+                        default=None,
+                        required=False,
+                        help='What refers to this resource or parameter')
+    parser.add_argument('--diff',
+                        nargs=2,
+                        default=None,
+                        required=False,
+                        metavar=('OLD', 'NEW'),
+                        help='What changed between two templates')
+    parser.add_argument('--cache',
+                        default=INDEX_CACHE,
+                        required=False,
+                        help='File to keep the indexes in, default '
+                        + INDEX_CACHE)
+    parser.add_argument('--nocache',
+                        action='store_const',
+                        const=True,
+                        default=False,
+                        required=False,
+                        help='Parse every template, keep nothing')
+
+    args = parser.parse_args()
+    if args.diff is None and not args.templates:
+        parser.error('templates, or --diff OLD NEW, are required')
+    if args.nocache:
+        args.cache = None
+    _show_debug = args.debug
+
+    return args
+
+
+# a yaml SafeLoader that turns the short forms into the long ones, so
+# !Ref X is {'Ref': 'X'} and !GetAtt A.B is {'Fn::GetAtt': ['A', 'B']},
+# same as the JSON. yaml imported on the first YAML template
+def yaml_loader():
+    global _yaml_loader
+
+    if _yaml_loader is None:
+        import yaml
+
+        class CFNLoader(yaml.SafeLoader):
+            pass
+
+        def construct_tag(loader, suffix, node):
+            if isinstance(node, yaml.ScalarNode):
+                value = loader.construct_scalar(node)
+            elif isinstance(node, yaml.SequenceNode):
+                value = loader.construct_sequence(node, deep=True)
+            else:
+                value = loader.construct_mapping(node, deep=True)
+            if suffix in ('Ref', 'Condition'):
+                return {suffix: value}
+            if suffix == 'GetAtt' and isinstance(value, str):
+                value = value.split('.', 1)
+            return {'Fn::' + suffix: value}
+
+        CFNLoader.add_multi_constructor('!', construct_tag)
+        _yaml_loader = CFNLoader
+    return _yaml_loader
+
+
+def content_hash(body):
+    return hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+
+# template body -> dict, JSON if it looks like JSON, otherwise YAML
+def parse_template(body, path='-'):
+    try:
+        if path.endswith('.json') or body.lstrip().startswith('{'):
+            doc = json.loads(body)
+        else:
+            import yaml
+            doc = yaml.load(body, Loader=yaml_loader())
+    except ImportError:
+        raise TemplateError(path + ': PyYAML is needed for YAML templates')
+    except Exception as e:
+        # json's ValueError or any of yaml's YAMLErrors
+        raise TemplateError(path + ': ' + ' '.join(str(e).split()))
+    if not isinstance(doc, dict) or not isinstance(doc.get('Resources'), dict):
+        raise TemplateError(path + ': no Resources, not a template')
+    return doc
+
+
+# what a piece of template refers to, (name, how) for every Ref, GetAtt
+# and ${} in a Sub, pseudo parameters (AWS::Region..) included
+def references(node):
+    if isinstance(node, list):
+        for item in node:
+            yield from references(item)
+        return
+    if not isinstance(node, dict):
+        return
+
+    for key, value in node.items():
+        if key == 'Ref' and isinstance(value, str):
+            yield value, 'Ref'
+        elif key == 'Fn::GetAtt':
+            if isinstance(value, str):
+                value = value.split('.', 1)
+            if isinstance(value, list) and value and isinstance(value[0], str):
+                yield value[0], 'GetAtt'
+                value = value[1:]
+            yield from references(value)
+        elif key == 'Fn::Sub':
+            # 'text', or ['text', {local variables}]
+            text, local = value, {}
+            if isinstance(value, list):
+                text, local = (value + [None, None])[:2]
+            local = local if isinstance(local, dict) else {}
+            if isinstance(text, str):
+                for name in SUB_VARIABLE.findall(text):
+                    name = name.split('.', 1)[0].strip()
+                    if name not in local:
+                        yield name, 'Sub'
+            yield from references(local)
+        else:
+            yield from references(value)
+
+
+def part_hash(node):
+    return content_hash(json.dumps(node, sort_keys=True, default=str))
+
+
+# everything the queries need from a parsed template, JSON-able so it can
+# go in the cache. edges are [from, to, how], from an Outputs.<name> for
+# the outputs. dangling are the edges to names the template doesn't have
+def index_template(doc):
+    resources = {}
+    parameters = {}
+    outputs = {}
+    edges = set()
+    capabilities = set()
+
+    for name, param in (doc.get('Parameters') or {}).items():
+        param = param if isinstance(param, dict) else {}
+        parameters[name] = {'type': param.get('Type'),
+                            'default': param.get('Default')}
+
+    for logical_id, resource in doc['Resources'].items():
+        resource = resource if isinstance(resource, dict) else {}
+        rtype = resource.get('Type')
+        resources[logical_id] = {'type': rtype, 'hash': part_hash(resource)}
+        for target, how in references(resource.get('Properties')):
+            edges.add((logical_id, target, how))
+        depends_on = resource.get('DependsOn') or []
+        for target in [depends_on] if isinstance(depends_on, str) else depends_on:
+            edges.add((logical_id, target, 'DependsOn'))
+        if rtype in IAM_RESOURCE_NAMES:
+            capabilities.add('CAPABILITY_IAM')
+            if (resource.get('Properties') or {}).get(IAM_RESOURCE_NAMES[rtype]):
+                capabilities.add('CAPABILITY_NAMED_IAM')
+
+    for name, output in (doc.get('Outputs') or {}).items():
+        output = output if isinstance(output, dict) else {}
+        export = (output.get('Export') or {}).get('Name')
+        outputs[name] = {'hash': part_hash(output),
+                         'export': export if isinstance(export, str) else None}
+        for target, how in references(output.get('Value')):
+            edges.add(('Outputs.' + name, target, how))
+
+    if doc.get('Transform'):
+        capabilities.add('CAPABILITY_AUTO_EXPAND')
+
+    edges = sorted(list(e) for e in edges if not e[1].startswith('AWS::'))
+    return {'resources': resources,
+            'parameters': parameters,
+            'outputs': outputs,
+            'edges': edges,
+            'dangling': [e for e in edges
+                         if e[1] not in resources and e[1] not in parameters],
+            'capabilities': sorted(capabilities)}
+
+
+def read_cache(cache_file):
+    try:
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+        return cache if isinstance(cache, dict) else {}
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def write_cache(cache_file, cache):
+    tmp_file = cache_file + '.tmp'
+    try:
+        with open(tmp_file, 'w') as f:
+            json.dump(cache, f, sort_keys=True)
+        os.replace(tmp_file, cache_file)
+    except (IOError, OSError) as e:
+        warning('unable to write:' + cache_file + ' ' + str(e))
+
+
+# index each template, from the cache when its content has been indexed
+# before. Returns (path -> index, path -> error) for those that couldn't
+# be read or parsed
+def analyse_templates(paths, cache_file=INDEX_CACHE):
+    cache = read_cache(cache_file) if cache_file else {}
+    indexes = {}
+    errors = {}
+    changed = False
+
+    for path in paths:
+        try:
+            with open(path, 'r') as f:
+                body = f.read()
+        except (IOError, OSError) as e:
+            errors[path] = 'unable to read template:' + path + ' ' + str(e)
+            continue
+
+        digest = content_hash(body)
+        if digest not in cache:
+            try:
+                cache[digest] = index_template(parse_template(body, path))
+            except TemplateError as e:
+                errors[path] = str(e)
+                continue
+            changed = True
+            debug('indexed:' + path)
+        else:
+            debug('unchanged since indexed:' + path)
+        indexes[path] = dict(cache[digest], hash=digest)
+
+    if changed and cache_file:
+        write_cache(cache_file, cache)
+    return indexes, errors
+
+
+def lb_logical_ids(index):
+    return sorted(logical_id for logical_id, r in index['resources'].items()
+                  if r['type'] in LB_RESOURCE_TYPES)
+
+
+# everything that refers to name, directly or through something else
+def referrers(index, name):
+    found = set()
+    todo = [name]
+    while todo:
+        target = todo.pop()
+        for source, to, how in index['edges']:
+            if to == target and source not in found:
+                found.add(source)
+                todo.append(source)
+    found.discard(name)
+    return sorted(found)
+
+
+def diff_section(old, new):
+    return {'added': sorted(set(new) - set(old)),
+            'removed': sorted(set(old) - set(new)),
+            'changed': sorted(k for k in set(old) & set(new) if old[k] != new[k])}
+
+
+# what changed from one index to the other. A resource whose type
+# changed is in retyped as well as changed, CloudFormation replaces those
+def diff_templates(old, new):
+    resources = diff_section(old['resources'], new['resources'])
+    resources['retyped'] = [k for k in resources['changed']
+                            if old['resources'][k]['type'] != new['resources'][k]['type']]
+    return {'resources': resources,
+            'parameters': diff_section(old['parameters'], new['parameters']),
+            'outputs': diff_section(old['outputs'], new['outputs']),
+            'capabilities': diff_section(dict.fromkeys(old['capabilities']),
+                                         dict.fromkeys(new['capabilities']))}
+
+
+def show_index(path, index):
+    progress(path)
+    info('  resources:    ' + str(len(index['resources'])))
+    info('  parameters:   ' + ', '.join(sorted(index['parameters'])))
+    info('  outputs:      ' + ', '.join(sorted(index['outputs'])))
+    info('  lbs:          ' + ', '.join(lb_logical_ids(index)))
+    info('  capabilities: ' + ', '.join(index['capabilities']))
+    for source, target, how in index['edges']:
+        debug('  ' + source + ' -> ' + target + ' (' + how + ')')
+    for source, target, how in index['dangling']:
+        warning('  ' + source + ' refers to ' + target + ', not in the template')
+
+
+def show_diff(old_path, new_path, diff):
+    progress(old_path + ' -> ' + new_path)
+    for section in ('resources', 'parameters', 'outputs', 'capabilities'):
+        for change, names in sorted(diff[section].items()):
+            if names:
+                info('  %-12s %-8s %s' % (section, change, ', '.join(names)))
+
+
+def main():
+    args = parsecommandline()
+    paths = list(args.diff or args.templates)
+    indexes, errors = analyse_templates(paths, args.cache)
+    for path in paths:
+        if path in errors:
+            warning(errors[path])
+
+    if args.diff is not None:
+        if errors:
+            sys.exit(1)
+        show_diff(args.diff[0], args.diff[1],
+                  diff_templates(indexes[args.diff[0]], indexes[args.diff[1]]))
+        sys.exit(0)
+
+    for path in paths:
+        if path not in indexes:
+            continue
+        if args.lbs:
+            info(path + ': ' + ' '.join(lb_logical_ids(indexes[path])))
+        elif args.refs is not None:
+            info(path + ': ' + ' '.join(referrers(indexes[path], args.refs)))
+        else:
+            show_index(path, indexes[path])
+
+    dangling = [p for p in indexes if indexes[p]['dangling']]
+    sys.exit(1 if errors or (dangling and not args.lbs and args.refs is None) else 0)
+
+
+if __name__ == "__main__":
+    main()
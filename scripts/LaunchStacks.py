@@ -0,0 +1,669 @@
+#!/usr/local/bin/python3
+
+# LaunchStacks.py
+
+# Create or update many CloudFormation stacks at once, waiting for them all
+#   Replaces BuildAndLaunchSpot.py, same puppet site.pp/cert checks, but
+#   boto3 instead of the aws cli, stacks launched concurrently
+
+# examples
+
+# One stack, two puppet nodes (as BuildAndLaunchSpot.py did)
+# ./LaunchStacks.py --AWSRegion ap-southeast-2 \
+#                   --stackname spot-web-v1 \
+#                   --template ../cloudformation/GeneralPurposeSpotStack003.json \
+#                   --nodes demowebserver01,demowebserver02
+
+# Nodes fill the template's Server1.., Server<N> parameters in the order
+# given, their certs written to <stackname>inparms.json as before
+
+# A fleet, 8 at a time, no puppet
+# ./LaunchStacks.py --AWSRegion ap-southeast-2 \
+#                   --stacks fleet.json --workers 8 --nopuppet
+#
+#   fleet.json:
+#     [{"stackname": "spot-web-v1",
+#       "template": "GeneralPurposeSpotStack003.json",
+#       "nodes": ["demowebserver01", "demowebserver02"]},
+#      {"stackname": "spot-api-v1",
+#       "template": "GeneralPurposeSpotStack003.json",
+#       "parameters": {"InstanceType": "t2.nano"}}]
+
+# Check the templates here, with CFNTemplates.py, rather than asking
+# CloudFormation to validate them (references, parameters, capabilities)
+# ./LaunchStacks.py --AWSRegion ap-southeast-2 \
+#                   --stacks fleet.json --offline
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+import CFNTemplates
+
+# puppet cert files (YMMV)
+PUPPETCERTPK = "/var/lib/puppet/ssl/private_keys/<NODENAME>.pem"
+PUPPETCERTME = "/var/lib/puppet/ssl/certs/<NODENAME>.pem"
+PUPPETCERTPM = "/var/lib/puppet/ssl/certs/ca.pem"
+
+# puppet site.pp file - I expect to find the nodes in here
+PUPPETSITEPP = "/etc/puppet/manifests/site.pp"
+
+# stacks launched at once
+LAUNCH_WORKERS = 8
+
+# secs between waiter polls, and the most to wait for any one stack
+WAIT_DELAY = 15
+WAIT_TIMEOUT = 3600
+
+# validate_template takes a template body up to this many bytes
+MAX_TEMPLATE_BODY = 51200
+
+# where validate_template results are kept, by template content hash
+VALIDATE_CACHE = '.LaunchStacks-validate.json'
+
+# what each stack's <stackname>inparms.json was rendered from, so an
+# unchanged one isn't rendered again. No cert material goes in here
+RENDER_CACHE = '.LaunchStacks-render.json'
+
+# templates as sent, JSON ones minified if that gets them under
+# MAX_TEMPLATE_BODY, so big templates don't need staging in S3
+STAGING_DIR = '.LaunchStacks-staged'
+
+# node parameters a template can have, for any number of Server<N>s
+NODE_PARAMETER = re.compile(r'^Server(\d+)(Name|PuppetCertMyPrivateKey|PuppetCertMyCert)$')
+
+# newlines in cert material, the template's cfn-init sed puts them back
+CERT_NEWLINE = '<%%%>'
+
+# Pretty Colours
+RED = '\033[91m'
+GREEN = '\033[92m'
+YELLOW = '\033[93m'
+ENDC = '\033[0m'
+
+# globals
+_AWS_region = None
+_boto_clients = {}
+_boto_clients_lock = threading.Lock()
+_boto_session = None
+_show_debug = False
+
+
+class ANode:
+    """A node - it will be an EC2 instance"""
+    def __init__(self, name):
+        self.name = name
+        self.privatekey = ""
+        self.cert = ""
+        self.privatekeyfn = PUPPETCERTPK.replace('<NODENAME>', name)
+        self.certfn = PUPPETCERTME.replace('<NODENAME>', name)
+
+
+class LaunchError(Exception):
+    """A stack that can't be launched, the others carry on"""
+
+
+def bail(message):
+    print(RED + message + ENDC)
+    sys.exit(1)
+
+
+def warning(message):
+    print(YELLOW + message + ENDC)
+
+
+def info(message):
+    print(message)
+
+
+def progress(message):
+    print(GREEN + message + ENDC)
+
+
+def debug(message):
+    if _show_debug:
+        print(GREEN + 'debug::' + str(message) + ENDC)
+
+
+def parsecommandline():
+    global _AWS_region
+    global _show_debug
+
+    parser = argparse.ArgumentParser(description='Create or update '
+                                     'CloudFormation stacks concurrently, '
+                                     'bootstrapping their nodes from puppet')
+    parser.add_argument('--AWSRegion',
+                        default='ap-southeast-2',
+                        required=False,
+                        help='AWS Region, default ap-southeast-2')
+    parser.add_argument('--debug',
+                        action='store_const',
+                        const=True,
+                        default=False,
+                        required=False,
+                        help='Enable debug')
+    parser.add_argument('--stackname',
+                        default=None,
+                        required=False,
+                        help='Stack to create or update')
+    parser.add_argument('--template',
+                        default=None,
+                        required=False,
+                        help='Its CloudFormation template, JSON or YAML')
+    parser.add_argument('--nodes',
+                        default=None,
+                        required=False,
+                        help='Comma separated puppet node names for the stack')
+    parser.add_argument('--stacks',
+                        default=None,
+                        required=False,
+                        help='JSON list of stacks to launch, each with a '
+                        'stackname, template, and optionally nodes, '
+                        'parameters and AWSRegion')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=LAUNCH_WORKERS,
+                        required=False,
+                        help='Stacks to launch at once')
+    parser.add_argument('--timeout',
+                        type=int,
+                        default=WAIT_TIMEOUT,
+                        required=False,
+                        help='Secs to wait for each stack to complete')
+    parser.add_argument('--sitepp',
+                        default=PUPPETSITEPP,
+                        required=False,
+                        help='Puppet site.pp the nodes must be in')
+    parser.add_argument('--validatecache',
+                        default=VALIDATE_CACHE,
+                        required=False,
+                        help='File to keep template validations in')
+    parser.add_argument('--rendercache',
+                        default=RENDER_CACHE,
+                        required=False,
+                        help='File to keep what each parameter file was '
+                        'rendered from in')
+    parser.add_argument('--offline',
+                        action='store_const',
+                        const=True,
+                        default=False,
+                        required=False,
+                        help='Check the templates locally, no validate '
+                        'calls, indexes kept in ' + CFNTemplates.INDEX_CACHE)
+    parser.add_argument('--nopuppet',
+                        action='store_const',
+                        const=True,
+                        default=False,
+                        required=False,
+                        help='Skip the site.pp and puppet cert steps')
+    parser.add_argument('--nowait',
+                        action='store_const',
+                        const=True,
+                        default=False,
+                        required=False,
+                        help='Start the creates/updates and exit')
+
+    args = parser.parse_args()
+    if (args.stacks is None) == (args.stackname is None):
+        parser.error('one of --stacks or --stackname is required')
+    if args.stackname is not None and args.template is None:
+        parser.error('--stackname needs a --template')
+    if args.workers < 1:
+        parser.error('--workers is at least 1')
+    _AWS_region = args.AWSRegion
+    _show_debug = args.debug
+
+    return args
+
+
+# one client per (service, region) from one session, boto3 imported on use
+def get_boto_client(service, region):
+    global _boto_session
+
+    with _boto_clients_lock:
+        if (service, region) not in _boto_clients:
+            if _boto_session is None:
+                import boto3
+                _boto_session = boto3.session.Session()
+            _boto_clients[(service, region)] = _boto_session.client(
+                service, region_name=region)
+        return _boto_clients[(service, region)]
+
+
+# the stacks to launch, from --stacks or the single stack flags
+def load_stacks(args):
+    if args.stacks is None:
+        entries = [{'stackname': args.stackname, 'template': args.template,
+                    'nodes': args.nodes.split(',') if args.nodes else []}]
+    else:
+        try:
+            with open(args.stacks, 'r') as f:
+                entries = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            bail('unable to read stacks file:' + args.stacks + ' ' + str(e))
+        if not isinstance(entries, list):
+            bail('stacks file must be a list:' + args.stacks)
+
+    stacks = []
+    seen = set()
+    base = os.path.dirname(os.path.abspath(args.stacks)) if args.stacks else os.getcwd()
+    for i, entry in enumerate(entries):
+        if not isinstance(entry, dict) or not entry.get('stackname') \
+                or not entry.get('template'):
+            bail('stack #' + str(i) + ' needs a stackname and a template:'
+                 + str(entry))
+        if entry['stackname'] in seen:
+            bail('stack ' + entry['stackname'] + ' is in there more than once')
+        seen.add(entry['stackname'])
+        stacks.append({'stackname': entry['stackname'],
+                       'template': os.path.join(base, entry['template']),
+                       'nodes': [n.strip() for n in entry.get('nodes') or []
+                                 if n.strip()],
+                       'parameters': dict(entry.get('parameters') or {}),
+                       'AWSRegion': entry.get('AWSRegion') or _AWS_region})
+
+    return stacks
+
+
+# every node name site.pp has, and its node /regex/ definitions, in one
+# pass. node 'a', "b" { and node /^web\d+/ { are both understood
+def index_sitepp(sitepp):
+    names = set()
+    patterns = []
+
+    with open(sitepp, 'r') as f:
+        for line in f:
+            m = re.match(r'^\s*node\s+(.+?)\s*(inherits\s+\S+\s*)?\{', line)
+            if m is None:
+                continue
+            for name in re.findall(r'[\'"]([^\'"]+)[\'"]', m.group(1)):
+                names.add(name)
+            for pattern in re.findall(r'/(.+?)/', m.group(1)):
+                patterns.append(re.compile(pattern))
+            if re.match(r'^[\w.-]+$', m.group(1)):
+                names.add(m.group(1))
+
+    return names, patterns
+
+
+# is it (pre) setup in puppet - I like each node clearly in site.pp (YMMV)
+def check_sitepp(sitepp, nodes):
+    if not os.path.isfile(sitepp):
+        bail('cannot open puppet site.pp to check the nodes are configured '
+             'in it. expected: ' + sitepp)
+
+    names, patterns = index_sitepp(sitepp)
+    missing = [n for n in nodes
+               if n not in names and not any(p.search(n) for p in patterns)]
+    if missing:
+        bail('could not find node(s) (' + ', '.join(missing) + ') in site.pp '
+             'file (' + sitepp + ') - please update the manifest and rerun')
+    return 0
+
+
+def run_command(args):
+    debug('executing: ' + ' '.join(args))
+    try:
+        p = subprocess.Popen(args, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        out, err = p.communicate()
+    except OSError as e:
+        bail(' '.join(args) + ' failed: ' + str(e))
+    if p.returncode != 0:
+        bail(' '.join(args) + ' returned an error: ' + str(p.returncode)
+             + ' ' + err.decode('utf-8', 'replace'))
+    return out.decode('utf-8', 'replace')
+
+
+# check/generate if required the puppet certs
+def do_puppet_certs(nodes):
+    if not os.path.isfile(PUPPETCERTPM):
+        bail('I cannot find the PuppetMaster ca.pem file. expecting==' + PUPPETCERTPM)
+
+    for node in nodes:
+        if os.path.isfile(node.privatekeyfn) and os.path.isfile(node.certfn):
+            debug('puppet certs already exist for node:' + node.name)
+            continue
+        info('No puppet cert(s) found for node:' + node.name)
+        run_command(['/usr/bin/puppet', 'ca', 'generate', node.name])
+        if not (os.path.isfile(node.privatekeyfn) and os.path.isfile(node.certfn)):
+            bail('failed to generate puppet certs for node:' + node.name)
+    return 0
+
+
+# a cert or key file as one parameter value, read a line at a time
+def encode_cert(path):
+    with open(path, 'r') as f:
+        return ''.join(line[:-1] + CERT_NEWLINE if line.endswith('\n') else line
+                       for line in f)
+
+
+# path -> encode_cert(path) for many files at once, each read only once
+def encode_certs(paths, workers=LAUNCH_WORKERS):
+    paths = sorted(set(paths))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        return dict(zip(paths, pool.map(encode_cert, paths)))
+
+
+# the template's node parameters as [{'Name': key, ...}], Server1 first
+def node_slots(parameters):
+    slots = {}
+    for key in parameters:
+        m = NODE_PARAMETER.match(key)
+        if m is not None:
+            slots.setdefault(int(m.group(1)), {})[m.group(2)] = key
+    return [slots[n] for n in sorted(slots)]
+
+
+# the node parameters for a stack, its nodes in order into Server1, 2...
+def render_parameters(parameters, nodes, certs):
+    slots = node_slots(parameters)
+    if len(nodes) > len(slots):
+        raise LaunchError('template has room for ' + str(len(slots))
+                          + ' node(s), ' + str(len(nodes)) + ' given')
+    if len(nodes) < len(slots):
+        warning(str(len(slots) - len(nodes)) + ' Server slot(s) in the '
+                'template left to their defaults')
+
+    params = {}
+    for node, slot in zip(nodes, slots):
+        values = {'Name': node.name,
+                  'PuppetCertMyPrivateKey': certs.get(node.privatekeyfn),
+                  'PuppetCertMyCert': certs.get(node.certfn)}
+        for field, key in slot.items():
+            params[key] = values[field]
+    return params
+
+
+# changes when the template, the nodes or any of their cert files do
+def render_fingerprint(template, nodes):
+    digest = hashlib.sha256(template['hash'].encode('utf-8'))
+    for node in nodes:
+        digest.update(node.name.encode('utf-8'))
+        for path in (node.privatekeyfn, node.certfn):
+            st = os.stat(path)
+            digest.update(('%s %d %d' % (path, st.st_mtime_ns, st.st_size)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def parms_file(stack):
+    return stack['stackname'] + 'inparms.json'
+
+
+# the node parameters of every stack, from <stackname>inparms.json if it
+# was rendered from the same inputs, else rendered with all the cert
+# files needed read at once. Those rendered are written back out
+def render_stacks(stacks, templates, nodes, cache_file, workers=LAUNCH_WORKERS):
+    cache = read_json_file(cache_file) if cache_file else {}
+    rendered = {}
+    todo = []
+
+    for stack in stacks:
+        stack_nodes = [nodes[n] for n in stack['nodes']]
+        fingerprint = render_fingerprint(templates[stack['template']], stack_nodes)
+        if cache.get(stack['stackname']) == fingerprint \
+                and os.path.isfile(parms_file(stack)):
+            with open(parms_file(stack), 'r') as f:
+                rendered[stack['stackname']] = dict(
+                    (p['ParameterKey'], p['ParameterValue']) for p in json.load(f))
+            debug('parameters unchanged for:' + stack['stackname'])
+        else:
+            todo.append((stack, stack_nodes, fingerprint))
+
+    certs = encode_certs([path for _, stack_nodes, _ in todo for n in stack_nodes
+                          for path in (n.privatekeyfn, n.certfn)], workers)
+    for stack, stack_nodes, fingerprint in todo:
+        try:
+            params = render_parameters(templates[stack['template']]['parameters'],
+                                       stack_nodes, certs)
+        except LaunchError as e:
+            bail(stack['stackname'] + ': ' + str(e))
+        info('writing out json param file: ' + parms_file(stack))
+        fd = os.open(parms_file(stack), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump([{'ParameterKey': k, 'ParameterValue': v}
+                       for k, v in sorted(params.items())], f, sort_keys=True, indent=4)
+        cache[stack['stackname']] = fingerprint
+        rendered[stack['stackname']] = params
+
+    if todo and cache_file:
+        write_json_file(cache_file, cache)
+    return rendered
+
+
+# the template body to send. A JSON one over MAX_TEMPLATE_BODY is
+# minified, and kept in STAGING_DIR as sent
+def stage_template(path, body):
+    if len(body.encode('utf-8')) <= MAX_TEMPLATE_BODY:
+        return body
+
+    try:
+        staged = json.dumps(json.loads(body), separators=(',', ':'))
+    except ValueError:
+        staged = body
+    if len(staged.encode('utf-8')) > MAX_TEMPLATE_BODY:
+        bail(path + ' is over ' + str(MAX_TEMPLATE_BODY) + ' bytes, even '
+             'minified, too big to send as a template body')
+
+    os.makedirs(STAGING_DIR, exist_ok=True)
+    staged_file = os.path.join(STAGING_DIR, template_hash(staged) + '.json')
+    with open(staged_file, 'w') as f:
+        f.write(staged)
+    progress('staged ' + path + ' minified, ' + str(len(body)) + ' -> '
+             + str(len(staged)) + ' bytes: ' + staged_file)
+    return staged
+
+
+def template_hash(body):
+    return hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+
+def read_json_file(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def write_json_file(path, data):
+    tmp_file = path + '.tmp'
+    try:
+        with open(tmp_file, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(tmp_file, path)
+    except (IOError, OSError) as e:
+        warning('unable to write:' + path + ' ' + str(e))
+
+
+# validate each distinct template once. A template whose content has been
+# validated before isn't sent again. path -> {'hash', 'parameters',
+# 'capabilities'}, or bails on the first invalid one
+def validate_templates(paths, region, cache_file):
+    cache = read_json_file(cache_file) if cache_file else {}
+    validated = {}
+    changed = False
+
+    for path in sorted(set(paths)):
+        try:
+            with open(path, 'r') as f:
+                body = f.read()
+        except (IOError, OSError) as e:
+            bail('unable to read template:' + path + ' ' + str(e))
+        body = stage_template(path, body)
+
+        digest = template_hash(body)
+        if digest not in cache:
+            cfn = get_boto_client('cloudformation', region)
+            try:
+                ret = cfn.validate_template(TemplateBody=body)
+            except cfn.exceptions.ClientError as e:
+                bail(path + ' failed validation: ' + e.response['Error']['Message'])
+            cache[digest] = {'parameters': [p['ParameterKey']
+                                            for p in ret.get('Parameters', [])],
+                             'capabilities': ret.get('Capabilities', [])}
+            changed = True
+            progress('validated template:' + path)
+        else:
+            debug('template unchanged since validated:' + path)
+        validated[path] = dict(cache[digest], hash=digest, body=body)
+
+    if changed and cache_file:
+        write_json_file(cache_file, cache)
+    return validated
+
+
+# same as validate_templates, without the API. Parameters and capabilities
+# come from the template's index, a Ref/GetAtt/Sub to something the
+# template doesn't have fails it
+def check_templates(paths, cache_file=CFNTemplates.INDEX_CACHE):
+    indexes, errors = CFNTemplates.analyse_templates(sorted(set(paths)), cache_file)
+    if errors:
+        bail('\n'.join(errors[p] for p in sorted(errors)))
+    checked = {}
+
+    for path, index in sorted(indexes.items()):
+        if index['dangling']:
+            bail(path + ' failed validation: '
+                 + ', '.join(source + ' refers to ' + target
+                             for source, target, how in index['dangling']))
+        with open(path, 'r') as f:
+            body = stage_template(path, f.read())
+        checked[path] = {'parameters': sorted(index['parameters']),
+                         'capabilities': index['capabilities'],
+                         'hash': template_hash(body), 'body': body}
+        progress('checked template:' + path)
+    return checked
+
+
+def get_stack_status(cfn, stack_name):
+    try:
+        return cfn.describe_stacks(StackName=stack_name)['Stacks'][0]['StackStatus']
+    except cfn.exceptions.ClientError as e:
+        if 'does not exist' in e.response['Error']['Message']:
+            return None
+        raise
+
+
+# create the stack, or update it if it's there. Returns the waiter to use,
+# None when there is nothing to wait for
+def create_or_update(cfn, stack, template):
+    args = {'StackName': stack['stackname'],
+            'TemplateBody': template['body'],
+            'Parameters': [{'ParameterKey': k, 'ParameterValue': str(v)}
+                           for k, v in sorted(stack['parameters'].items())],
+            'Capabilities': template['capabilities']}
+
+    unknown = sorted(set(stack['parameters']) - set(template['parameters']))
+    if unknown:
+        raise LaunchError('template has no parameter(s): ' + ', '.join(unknown))
+
+    status = get_stack_status(cfn, stack['stackname'])
+    if status is None:
+        cfn.create_stack(**args)
+        return 'create', 'stack_create_complete'
+    if status == 'ROLLBACK_COMPLETE':
+        raise LaunchError('stack is ROLLBACK_COMPLETE, delete it first')
+    if status.endswith('_IN_PROGRESS'):
+        raise LaunchError('stack is ' + status)
+
+    try:
+        cfn.update_stack(**args)
+    except cfn.exceptions.ClientError as e:
+        if 'No updates are to be performed' in e.response['Error']['Message']:
+            return 'unchanged', None
+        raise
+    return 'update', 'stack_update_complete'
+
+
+# launch one stack and wait for it, timings and errors go in the result
+def launch_stack(stack, template, wait=True, timeout=WAIT_TIMEOUT):
+    result = {'stackname': stack['stackname'], 'region': stack['AWSRegion'],
+              'action': None, 'status': None, 'launch_secs': None,
+              'wait_secs': None, 'error': None}
+    cfn = get_boto_client('cloudformation', stack['AWSRegion'])
+    start = time.time()
+
+    try:
+        result['action'], waiter = create_or_update(cfn, stack, template)
+        result['launch_secs'] = round(time.time() - start, 2)
+        progress(stack['stackname'] + ': ' + result['action'])
+        if waiter is not None and wait:
+            cfn.get_waiter(waiter).wait(
+                StackName=stack['stackname'],
+                WaiterConfig={'Delay': WAIT_DELAY,
+                              'MaxAttempts': max(timeout // WAIT_DELAY, 1)})
+            result['wait_secs'] = round(time.time() - start - result['launch_secs'], 2)
+        result['status'] = get_stack_status(cfn, stack['stackname'])
+    except LaunchError as e:
+        result['error'] = str(e)
+    except Exception as e:
+        # botocore's ClientError and WaiterError, without importing botocore
+        result['error'] = str(e)
+        warning(stack['stackname'] + ': ' + str(e))
+
+    return result
+
+
+# launch every stack, workers at a time, results in the same order
+def launch_stacks(stacks, templates, workers=LAUNCH_WORKERS, wait=True,
+                  timeout=WAIT_TIMEOUT):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda s: launch_stack(s, templates[s['template']],
+                                                    wait, timeout),
+                             stacks))
+
+
+def report(results, total_secs):
+    info('%-32s %-9s %-24s %8s %8s' % ('stack', 'action', 'status',
+                                       'launch', 'wait'))
+    for r in results:
+        info('%-32s %-9s %-24s %8s %8s' % (r['stackname'], r['action'] or '-',
+                                           r['status'] or '-',
+                                           r['launch_secs'] or '-',
+                                           r['wait_secs'] or '-'))
+        if r['error'] is not None:
+            warning('  ' + r['error'])
+    info('%d stack(s) in %.1fs' % (len(results), total_secs))
+
+
+def main():
+    args = parsecommandline()
+    stacks = load_stacks(args)
+    start = time.time()
+
+    if args.offline:
+        templates = check_templates([s['template'] for s in stacks])
+    else:
+        templates = validate_templates([s['template'] for s in stacks],
+                                       _AWS_region, args.validatecache)
+
+    if not args.nopuppet:
+        all_nodes = sorted(set(n for s in stacks for n in s['nodes']))
+        check_sitepp(args.sitepp, all_nodes)
+        nodes = dict((n, ANode(n)) for n in all_nodes)
+        do_puppet_certs(nodes.values())
+        rendered = render_stacks(stacks, templates, nodes, args.rendercache,
+                                 args.workers)
+        for stack in stacks:
+            params = rendered[stack['stackname']]
+            params.update(stack['parameters'])
+            stack['parameters'] = params
+    results = launch_stacks(stacks, templates, args.workers,
+                            not args.nowait, args.timeout)
+    report(results, time.time() - start)
+
+    failed = [r for r in results if r['error'] is not None
+              or (r['status'] or '').endswith(('FAILED', 'ROLLBACK_COMPLETE'))]
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
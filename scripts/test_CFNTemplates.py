@@ -0,0 +1,114 @@
+#!/usr/local/bin/python3
+
+import os
+import shutil
+import tempfile
+import unittest
+import CFNTemplates
+from CFNTemplates import analyse_templates
+from CFNTemplates import diff_templates
+from CFNTemplates import lb_logical_ids
+from CFNTemplates import referrers
+
+TEMPLATES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cloudformation')
+
+SHORT_FORMS = """
+Parameters:
+  Port: {Type: Number, Default: 80}
+Resources:
+  LB:
+    Type: AWS::ElasticLoadBalancingV2::LoadBalancer
+    Properties:
+      Name: !Sub '${AWS::StackName}-lb'
+  Listener:
+    Type: AWS::ElasticLoadBalancingV2::Listener
+    Properties:
+      LoadBalancerArn: !Ref LB
+      Port: !Ref Port
+  Role:
+    Type: AWS::IAM::Role
+    Properties:
+      RoleName: !Join ['-', [!Ref 'AWS::StackName', role]]
+  Alarm:
+    Type: AWS::CloudWatch::Alarm
+    DependsOn: Listener
+    Properties:
+      AlarmName: !Sub
+        - '${Name} ${!Literal} ${Gone.Arn}'
+        - Name: !GetAtt LB.LoadBalancerName
+Outputs:
+  Url:
+    Value: !GetAtt [LB, DNSName]
+    Export: {Name: lb-url}
+"""
+
+
+class CFNTemplatesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+
+    def write(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_short_forms(self):
+        path = self.write('lb.yaml', SHORT_FORMS)
+        indexes, errors = analyse_templates([path], None)
+        index = indexes[path]
+        self.assertEqual(errors, {})
+        self.assertEqual(lb_logical_ids(index), ['LB'])
+        self.assertEqual(index['capabilities'], ['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM'])
+        self.assertEqual(index['outputs']['Url']['export'], 'lb-url')
+        self.assertIn(['Outputs.Url', 'LB', 'GetAtt'], index['edges'])
+        self.assertIn(['Alarm', 'Listener', 'DependsOn'], index['edges'])
+        self.assertEqual(index['dangling'], [['Alarm', 'Gone', 'Sub']])
+        self.assertEqual(referrers(index, 'LB'), ['Alarm', 'Listener', 'Outputs.Url'])
+        self.assertEqual(referrers(index, 'Port'), ['Alarm', 'Listener'])
+
+    def test_repo_templates(self):
+        paths = [os.path.join(TEMPLATES, name) for name in sorted(os.listdir(TEMPLATES))]
+        indexes, errors = analyse_templates(paths, None)
+        self.assertEqual([os.path.basename(p) for p in errors], ['UbrSpotVPNSecurePuppet.json'])
+        self.assertEqual(lb_logical_ids(indexes[os.path.join(TEMPLATES, 'NetworkLoadBalancerSandpit.yaml')]),
+                         ['NetworkLoadBalancer'])
+        ecs = indexes[os.path.join(TEMPLATES, 'SandpitECS.yaml')]
+        self.assertIn(['ContainerInstances', 'ECSCluster', 'Sub'], ecs['edges'])
+        self.assertEqual(ecs['capabilities'], ['CAPABILITY_IAM'])
+        self.assertEqual([p for p in indexes if indexes[p]['dangling']], [])
+
+    def test_cache(self):
+        cache_file = os.path.join(self.dir, 'index.json')
+        path = self.write('lb.yaml', SHORT_FORMS)
+        first, errors = analyse_templates([path], cache_file)
+        parsed = []
+        parse_template = CFNTemplates.parse_template
+        CFNTemplates.parse_template = lambda body, path: parsed.append(path) or parse_template(body, path)
+        self.addCleanup(setattr, CFNTemplates, 'parse_template', parse_template)
+
+        again, errors = analyse_templates([path], cache_file)
+        self.assertEqual(parsed, [])
+        self.assertEqual(again, first)
+        self.write('lb.yaml', SHORT_FORMS.replace('Default: 80', 'Default: 443'))
+        analyse_templates([path], cache_file)
+        self.assertEqual(parsed, [path])
+
+    def test_diff(self):
+        old = self.write('old.yaml', SHORT_FORMS)
+        new = self.write('new.yaml', SHORT_FORMS.replace('Port: !Ref Port', 'Port: 443')
+                         .replace('Type: AWS::CloudWatch::Alarm', 'Type: AWS::SNS::Topic')
+                         .replace('  Role:', '  Queue:\n    Type: AWS::SQS::Queue\n  Role:')
+                         .replace("Default: 80}", "Default: 80}\n  Env: {Type: String}"))
+        indexes, errors = analyse_templates([old, new], None)
+        diff = diff_templates(indexes[old], indexes[new])
+        self.assertEqual(diff['resources'], {'added': ['Queue'], 'removed': [],
+                                             'changed': ['Alarm', 'Listener'], 'retyped': ['Alarm']})
+        self.assertEqual(diff['parameters']['added'], ['Env'])
+        self.assertEqual(diff['outputs']['changed'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
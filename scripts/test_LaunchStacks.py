@@ -0,0 +1,189 @@
+#!/usr/local/bin/python3
+
+import botocore.exceptions
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import LaunchStacks
+from LaunchStacks import index_sitepp
+from LaunchStacks import validate_templates
+from LaunchStacks import launch_stacks
+from LaunchStacks import render_stacks
+from LaunchStacks import stage_template
+
+
+# plays cloudformation for one region, waiters take latency secs
+class FakeCloudFormation:
+
+    exceptions = botocore.exceptions
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.stacks = {}
+        self.validations = 0
+        self.lock = threading.Lock()
+
+    def validate_template(self, TemplateBody):
+        self.validations += 1
+        body = json.loads(TemplateBody)
+        return {'Parameters': [{'ParameterKey': k} for k in body.get('Parameters', {})],
+                'Capabilities': ['CAPABILITY_IAM'] if 'Role' in body['Resources'] else []}
+
+    def describe_stacks(self, StackName):
+        if StackName not in self.stacks:
+            raise botocore.exceptions.ClientError(
+                {'Error': {'Code': 'ValidationError',
+                           'Message': 'Stack with id ' + StackName + ' does not exist'}},
+                'DescribeStacks')
+        return {'Stacks': [{'StackName': StackName, 'StackStatus': self.stacks[StackName][0]}]}
+
+    def create_stack(self, StackName, TemplateBody, Parameters, Capabilities):
+        with self.lock:
+            self.stacks[StackName] = ('CREATE_IN_PROGRESS', TemplateBody, Parameters)
+
+    def update_stack(self, StackName, TemplateBody, Parameters, Capabilities):
+        with self.lock:
+            if self.stacks[StackName][1:] == (TemplateBody, Parameters):
+                raise botocore.exceptions.ClientError(
+                    {'Error': {'Code': 'ValidationError', 'Message': 'No updates are to be performed.'}},
+                    'UpdateStack')
+            self.stacks[StackName] = ('UPDATE_IN_PROGRESS', TemplateBody, Parameters)
+
+    def get_waiter(self, name):
+        fake = self
+
+        class Waiter:
+            def wait(self, StackName, WaiterConfig):
+                time.sleep(fake.latency)
+                status = fake.stacks[StackName][0].replace('IN_PROGRESS', 'COMPLETE')
+                fake.stacks[StackName] = (status,) + fake.stacks[StackName][1:]
+        return Waiter()
+
+
+class LaunchStacksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        self.cfn = FakeCloudFormation(0.3)
+        LaunchStacks._boto_clients[('cloudformation', 'ap-southeast-2')] = self.cfn
+        self.addCleanup(LaunchStacks._boto_clients.clear)
+        self.template = self.write('spot.json', json.dumps({'Parameters': {'InstanceType': {}},
+                                                            'Resources': {'Role': {}}}))
+
+    def write(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_index_sitepp(self):
+        sitepp = self.write('site.pp', "# node 'commented' {\n"
+                            "node 'demowebserver01', \"demowebserver02\" {\n  include web\n}\n"
+                            "node /^spot\\d+$/ inherits base {\n}\n"
+                            "node default {\n}\n")
+        names, patterns = index_sitepp(sitepp)
+        self.assertEqual(names, set(['demowebserver01', 'demowebserver02', 'default']))
+        self.assertTrue(patterns[0].search('spot42'))
+        self.assertEqual(LaunchStacks.check_sitepp(sitepp, ['demowebserver02', 'spot7']), 0)
+        with self.assertRaises(SystemExit):
+            LaunchStacks.check_sitepp(sitepp, ['commented'])
+
+    def test_validate_cache(self):
+        cache_file = os.path.join(self.dir, 'validate.json')
+        self.addCleanup(os.remove, cache_file)
+        templates = validate_templates([self.template, self.template], 'ap-southeast-2', cache_file)
+        self.assertEqual(templates[self.template]['capabilities'], ['CAPABILITY_IAM'])
+        self.assertEqual(templates[self.template]['parameters'], ['InstanceType'])
+        validate_templates([self.template], 'ap-southeast-2', cache_file)
+        self.assertEqual(self.cfn.validations, 1)
+
+    def test_launch_stacks(self):
+        templates = validate_templates([self.template], 'ap-southeast-2', None)
+        stacks = [{'stackname': 'spot-' + str(i), 'template': self.template, 'AWSRegion': 'ap-southeast-2',
+                   'parameters': {'InstanceType': 't2.nano'}, 'nodes': []} for i in range(6)]
+        start = time.time()
+        results = launch_stacks(stacks, templates, workers=6)
+        # as long as the slowest stack, not the sum
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(set((r['action'], r['status']) for r in results), set([('create', 'CREATE_COMPLETE')]))
+
+        stacks[0]['parameters']['InstanceType'] = 't2.micro'
+        stacks[1]['parameters']['SSHKey'] = 'Nov2017'
+        results = launch_stacks(stacks[:3], templates)
+        self.assertEqual([(r['action'], r['status']) for r in results],
+                         [('update', 'UPDATE_COMPLETE'), (None, None), ('unchanged', 'CREATE_COMPLETE')])
+        self.assertEqual(results[1]['error'], 'template has no parameter(s): SSHKey')
+
+
+    def test_render_stacks(self):
+        params = dict(('Server' + str(n) + field, {'Type': 'String'}) for n in range(1, 4)
+                      for field in ('Name', 'PuppetCertMyPrivateKey', 'PuppetCertMyCert'))
+        template = self.write('fleet.json', json.dumps({'Parameters': params, 'Resources': {}}))
+        templates = validate_templates([template], 'ap-southeast-2', None)
+
+        nodes = {}
+        for name in ('spot01', 'spot02', 'spot03'):
+            nodes[name] = LaunchStacks.ANode(name)
+            nodes[name].privatekeyfn = self.write(name + '.key', 'KEY ' + name + '\nline 2\n')
+            nodes[name].certfn = self.write(name + '.pem', 'CERT ' + name + '\n')
+        stacks = [{'stackname': os.path.join(self.dir, 'fleet-1'), 'template': template,
+                   'nodes': ['spot03', 'spot01', 'spot02']}]
+        cache_file = os.path.join(self.dir, 'render.json')
+        self.addCleanup(os.remove, cache_file)
+        self.addCleanup(os.remove, stacks[0]['stackname'] + 'inparms.json')
+
+        rendered = render_stacks(stacks, templates, nodes, cache_file)[stacks[0]['stackname']]
+        self.assertEqual(rendered['Server1Name'], 'spot03')
+        self.assertEqual(rendered['Server1PuppetCertMyPrivateKey'], 'KEY spot03<%%%>line 2<%%%>')
+        self.assertEqual(rendered['Server3PuppetCertMyCert'], 'CERT spot02<%%%>')
+
+        # unchanged inputs come back from the parameter file, a changed cert is re-read
+        encode_cert = LaunchStacks.encode_cert
+        self.addCleanup(setattr, LaunchStacks, 'encode_cert', encode_cert)
+        LaunchStacks.encode_cert = None
+        self.assertEqual(render_stacks(stacks, templates, nodes, cache_file)[stacks[0]['stackname']], rendered)
+        LaunchStacks.encode_cert = encode_cert
+        with open(nodes['spot02'].certfn, 'w') as f:
+            f.write('NEW CERT\n')
+        rendered = render_stacks(stacks, templates, nodes, cache_file)[stacks[0]['stackname']]
+        self.assertEqual(rendered['Server3PuppetCertMyCert'], 'NEW CERT<%%%>')
+
+        stacks[0]['nodes'].append('spot04')
+        nodes['spot04'] = nodes['spot01']
+        with self.assertRaises(SystemExit):
+            render_stacks(stacks, templates, nodes, None)
+
+    def test_stage_template(self):
+        body = json.dumps({'Resources': dict(('R' + str(i), {'Type': 'AWS::SNS::Topic'})
+                                              for i in range(1000))}, indent=8)
+        self.assertGreater(len(body), LaunchStacks.MAX_TEMPLATE_BODY)
+        cwd = os.getcwd()
+        self.addCleanup(os.chdir, cwd)
+        os.chdir(self.dir)
+        staged = stage_template('big.json', body)
+        self.assertLessEqual(len(staged), LaunchStacks.MAX_TEMPLATE_BODY)
+        self.assertEqual(json.loads(staged), json.loads(body))
+        self.assertEqual(stage_template('small.json', '{}'), '{}')
+
+    def test_check_templates(self):
+        template = self.write('role.json', json.dumps({'Parameters': {'InstanceType': {}},
+                                                       'Resources': {'Role': {'Type': 'AWS::IAM::Role'}}}))
+        templates = LaunchStacks.check_templates([template], None)
+        self.assertEqual(templates[template]['capabilities'], ['CAPABILITY_IAM'])
+        self.assertEqual(templates[template]['parameters'], ['InstanceType'])
+        self.assertEqual(self.cfn.validations, 0)
+
+        broken = self.write('broken.json', json.dumps({'Resources': {'Role': {'Type': 'AWS::IAM::Role',
+                                                                              'DependsOn': 'Policy'}}}))
+        with self.assertRaises(SystemExit):
+            LaunchStacks.check_templates([broken], None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,59 @@
 #!/usr/local/bin/python3
 
+import asyncio
+import boto3
+import botocore.awsrequest
+import botocore.exceptions
+import datetime
+import http.server
+import json
+import os
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import PublishDNS
 from PublishDNS import run_os_command
+from PublishDNS import load_manifest
+from PublishDNS import cname_change
+from PublishDNS import build_change_batches
+from PublishDNS import get_r53_zoneid
+from PublishDNS import parse_dns_suffix
+from PublishDNS import dns_query
+from PublishDNS import dns_query_packet
+from PublishDNS import dns_parse_response
+from PublishDNS import poll_for_alias_update
+from PublishDNS import alias_changes
+from PublishDNS import DNSCNameRecord
+from PublishDNS import ttl_ramp_cutover
+from PublishDNS import weighted_shift
+from PublishDNS import span
+from PublishDNS import count_aws_call
+from PublishDNS import count_aws_throttle
+from PublishDNS import write_metrics_file
+from PublishDNS import new_stack_events
+from PublishDNS import watch_stacks
+from PublishDNS import get_r53_cname_rec
+from PublishDNS import lookup_r53_records
+from PublishDNS import prefetch_zone_records
+from PublishDNS import R53ChangeTracker
+from PublishDNS import R53RateLimiter
+from PublishDNS import drift_scan
+from PublishDNS import elb_hostname
+from PublishDNS import InProcessDNS
+from PublishDNS import Publisher
+from PublishDNS import DigDNS
+from PublishDNS import discover_stacks
+from PublishDNS import drive_load
+from PublishDNS import LatencyHistogram
+from PublishDNS import warmup_gate
 from PublishDNS import poll_for_resolve
 from PublishDNS import poll_for_cname_update
+from StubDNS import StubDNSServer
 
 
 class SimpleTest(unittest.TestCase):
@@ -23,5 +73,1672 @@ class SimpleTest(unittest.TestCase):
         self.assertEqual(poll_for_cname_update("www.microsoft.com", "www.microsoft.com-c-3.edgekey.net", 1), 0)
         self.assertEqual(poll_for_cname_update("www.microsoft.com", "notthis", 1), -1)
 
+
+class BatchTest(unittest.TestCase):
+
+    def write_manifest(self, suffix, text):
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_load_manifest(self):
+        want = [{'stackname': 'blue-v2', 'DNSTarget': 'www.example.com',
+                 'AWSRegion': None, 'elb': None},
+                {'stackname': 'api-v2', 'DNSTarget': 'api.example.com',
+                 'AWSRegion': None, 'elb': None}]
+        csv_file = self.write_manifest('.csv', "stackname,DNSTarget\n"
+                                       "blue-v2,www.example.com\n"
+                                       "api-v2,api.example.com.\n")
+        json_file = self.write_manifest(
+            '.json',
+            '[{"stackname": "blue-v2", "DNSTarget": "www.example.com"},'
+            '{"stackname": "api-v2", "DNSTarget": "api.example.com"}]')
+        yaml_file = self.write_manifest(
+            '.yaml',
+            "- stackname: blue-v2\n  DNSTarget: www.example.com\n"
+            "- stackname: api-v2\n  DNSTarget: api.example.com\n")
+        self.assertEqual(load_manifest(csv_file), want)
+        self.assertEqual(load_manifest(json_file), want)
+        self.assertEqual(load_manifest(yaml_file), want)
+
+        dupe = self.write_manifest('.csv', "stackname,DNSTarget\n"
+                                   "a,www.example.com\nb,WWW.example.com\n")
+        with self.assertRaises(PublishDNS.ManifestError):
+            load_manifest(dupe)
+
+    def test_build_change_batches(self):
+        changes = [cname_change('host' + str(i) + '.example.com.',
+                                'elb.amazonaws.com') for i in range(1200)]
+        batches = build_change_batches(changes)
+        # an UPSERT counts twice, 500 a batch against the 1000 record limit
+        self.assertEqual([len(b) for b in batches], [500, 500, 200])
+        self.assertEqual(sum(batches, []), changes)
+
+        long_target = 'x' * 200
+        changes = [cname_change('host' + str(i) + '.example.com.', long_target)
+                   for i in range(100)]
+        self.assertEqual([len(b) for b in build_change_batches(changes)],
+                         [80, 20])
+
+
+# stands in for the route53 client, hands out hosted zones a page at a time
+class FakeRoute53:
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.scans = 0
+
+    def get_paginator(self, operation):
+        assert operation == 'list_hosted_zones'
+        return self
+
+    def paginate(self):
+        self.scans += 1
+        return [{'HostedZones': page} for page in self.pages]
+
+
+class ZoneIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.r53 = FakeRoute53([
+            [{'Name': 'example.com.', 'Id': '/hostedzone/Z1'}],
+            [{'Name': 'b.example.com.', 'Id': '/hostedzone/Z2',
+              'Config': {'PrivateZone': True}},
+             {'Name': 'b.example.com.', 'Id': '/hostedzone/Z3',
+              'Config': {'PrivateZone': False}}]])
+        self.addCleanup(setattr, PublishDNS, '_boto_r53',
+                        PublishDNS._boto_r53)
+        PublishDNS._boto_r53 = self.r53
+        PublishDNS._zone_index = None
+        self.addCleanup(setattr, PublishDNS, '_zone_cache_file',
+                        PublishDNS._zone_cache_file)
+        PublishDNS._zone_cache_file = None
+        self.addCleanup(setattr, PublishDNS, '_zone_index', None)
+
+    def test_longest_suffix(self):
+        self.assertEqual(parse_dns_suffix('www.a.b.example.com'),
+                         'b.example.com')
+        self.assertEqual(parse_dns_suffix('www.example.com'), 'example.com')
+        self.assertEqual(parse_dns_suffix('www.example.org'), -1)
+        self.assertEqual(get_r53_zoneid('b.example.com'), 'Z3')
+        self.assertEqual(get_r53_zoneid('example.com.'), 'Z1')
+        self.assertEqual(self.r53.scans, 1)
+
+    def test_zone_cache_file(self):
+        fd, cache_file = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        os.remove(cache_file)
+        self.addCleanup(os.remove, cache_file)
+        self.addCleanup(setattr, PublishDNS, '_zone_cache_file',
+                        PublishDNS._zone_cache_file)
+        PublishDNS._zone_cache_file = cache_file
+
+        self.assertEqual(get_r53_zoneid('example.com'), 'Z1')
+        PublishDNS._zone_index = None
+        self.assertEqual(get_r53_zoneid('b.example.com'), 'Z3')
+        self.assertEqual(self.r53.scans, 1)
+
+
+class DNSProbeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = [StubDNSServer({'www.example.com.':
+                                       ('CNAME', 'green-elb.amazonaws.com.')})
+                        for _ in range(3)]
+        for server in self.servers:
+            server.start()
+            self.addCleanup(server.stop)
+        self.nameservers = [server.address for server in self.servers]
+
+    def test_packet_roundtrip(self):
+        query = dns_query_packet(4242, 'www.example.com', 'CNAME')
+        self.assertEqual(dns_parse_response(self.servers[0].answer(query)),
+                         [('CNAME', 'green-elb.amazonaws.com.')])
+        query = dns_query_packet(4242, 'nope.example.com', 'CNAME')
+        self.assertEqual(dns_parse_response(self.servers[0].answer(query)),
+                         [])
+
+    def test_truncated(self):
+        query = dns_query_packet(4242, 'www.example.com', 'CNAME')
+        answer = self.servers[0].answer(query)
+        # cut in the question name, in the answer's name and in its rdata
+        for size in (14, len(query) + 1, len(answer) - 3):
+            self.assertRaises(ValueError, dns_parse_response, answer[:size])
+        self.assertRaises(ValueError, PublishDNS.dns_read_name,
+                          b'\x00' * 12 + b'\x05ab', 12)
+        # a pointer past the end of the packet
+        self.assertRaises(ValueError, dns_parse_response,
+                          struct.pack('>HHHHHH', 1, 0x8400, 1, 0, 0, 0)
+                          + b'\xC0')
+
+        # over UDP, no answer from the server that cut its reply, or said
+        # it did
+        self.servers[0].truncate = len(answer) - 3
+        self.servers[1].tc = True
+        self.assertEqual(
+            [asyncio.run(dns_query(server, 'www.example.com', 'CNAME', 1))
+             for server in self.nameservers],
+            [None, None, [('CNAME', 'green-elb.amazonaws.com.')]])
+        self.assertEqual(poll_for_cname_update('www.example.com.',
+                                               'green-elb.amazonaws.com', 0.5,
+                                               self.nameservers), -1)
+
+    def test_all_servers_agree(self):
+        start = time.time()
+        self.assertEqual(poll_for_cname_update('www.example.com.',
+                                               'green-elb.amazonaws.com', 5,
+                                               self.nameservers), 0)
+        self.assertLess(time.time() - start, 1)
+
+    def test_lagging_server(self):
+        self.servers[1].records = {'www.example.com.':
+                                   ('CNAME', 'blue-elb.amazonaws.com.')}
+        self.assertEqual(poll_for_cname_update('www.example.com.',
+                                               'green-elb.amazonaws.com', 1,
+                                               self.nameservers), -1)
+        self.assertGreater(self.servers[1].queries, 1)
+
+        threading.Timer(0.3, self.servers[1].records.update,
+                        [{'www.example.com.':
+                          ('CNAME', 'green-elb.amazonaws.com.')}]).start()
+        self.assertEqual(poll_for_cname_update('www.example.com.',
+                                               'green-elb.amazonaws.com', 5,
+                                               self.nameservers), 0)
+
+    def test_alias(self):
+        # the load balancer here is localhost
+        for server in self.servers:
+            server.records = {'example.com.': ('A', '127.0.0.1')}
+        self.assertEqual(poll_for_alias_update('example.com.', 'A',
+                                               'localhost', 5,
+                                               self.nameservers), 0)
+        self.servers[2].records = {'example.com.': ('A', '10.9.9.9')}
+        self.assertEqual(poll_for_alias_update('example.com.', 'A',
+                                               'localhost', 0.5,
+                                               self.nameservers), -1)
+
+
+class DNSBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubDNSServer({'www.example.com.':
+                                     ('CNAME', 'green-elb.amazonaws.com.')})
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+    def test_no_shell(self):
+        self.assertEqual(run_os_command('echo $HOME'), '$HOME\n')
+        self.assertEqual(run_os_command(['echo', 'a b']), 'a b\n')
+        # more output than a pipe holds
+        out = run_os_command([sys.executable, '-c', 'print("x" * 1000000)'])
+        self.assertEqual(len(out), 1000001)
+
+    def test_in_process(self):
+        backend = InProcessDNS()
+        self.assertEqual(asyncio.run(backend.query(
+            self.server.address, 'www.example.com', 'CNAME', 1)),
+            [('CNAME', 'green-elb.amazonaws.com.')])
+        self.assertIn('127.0.0.1', asyncio.run(backend.resolve('localhost')))
+
+        nameservers = PublishDNS.system_nameservers
+        self.addCleanup(setattr, PublishDNS, 'system_nameservers',
+                        nameservers)
+        PublishDNS.system_nameservers = lambda: [self.server.address]
+        self.assertEqual(asyncio.run(backend.show('www.example.com')),
+                         ';; SERVER: 127.0.0.1\n'
+                         'CNAME  green-elb.amazonaws.com.')
+
+    @unittest.skipIf(shutil.which('getent') is None, 'needs getent')
+    def test_dig_fallback(self):
+        backend = DigDNS()
+        self.assertIn('127.0.0.1', asyncio.run(backend.resolve('localhost')))
+        self.assertEqual(asyncio.run(backend.resolve('nothere.invalid')), [])
+        answers = asyncio.run(backend.query(self.server.address,
+                                            'www.example.com', 'CNAME', 1))
+        if shutil.which('dig') is None:
+            self.assertIsNone(answers)
+        else:
+            self.assertEqual(answers, [('CNAME', 'green-elb.amazonaws.com.')])
+
+
+class AliasTest(unittest.TestCase):
+
+    def test_alias_changes(self):
+        dns_rec = DNSCNameRecord('www.example.com')
+        changes = alias_changes(dns_rec, 'green.elb.amazonaws.com', 'ZELB',
+                                ['A', 'AAAA'])
+        self.assertEqual([(c['Action'], c['ResourceRecordSet']['Type'])
+                          for c in changes],
+                         [('UPSERT', 'A'), ('UPSERT', 'AAAA')])
+        self.assertEqual(changes[0]['ResourceRecordSet']['AliasTarget'],
+                         {'HostedZoneId': 'ZELB',
+                          'DNSName': 'green.elb.amazonaws.com',
+                          'EvaluateTargetHealth': False})
+
+        # an existing CNAME has to go in the same batch
+        dns_rec._cname_target = 'blue.elb.amazonaws.com'
+        dns_rec.ttl = 300
+        changes = alias_changes(dns_rec, 'green.elb.amazonaws.com', 'ZELB',
+                                ['A'])
+        self.assertEqual(changes[0], cname_change('www.example.com.',
+                                                  'blue.elb.amazonaws.com',
+                                                  300, action='DELETE'))
+        self.assertEqual(changes[1]['ResourceRecordSet']['Type'], 'A')
+
+
+# change ids go INSYNC after a given number of GetChange calls
+class FakeChanges:
+
+    def __init__(self, polls_until_insync):
+        self.polls = dict(polls_until_insync)
+        self.calls = 0
+
+    def get_change(self, Id):
+        self.calls += 1
+        self.polls[Id] -= 1
+        status = 'INSYNC' if self.polls[Id] <= 0 else 'PENDING'
+        return {'ChangeInfo': {'Id': Id, 'Status': status}}
+
+
+class ChangeTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        for name, value in (('R53_CHANGE_BACKOFF_BASE', 0.01),
+                            ('R53_CHANGE_BACKOFF_CAP', 0.05)):
+            self.addCleanup(setattr, PublishDNS, name,
+                            getattr(PublishDNS, name))
+            setattr(PublishDNS, name, value)
+
+    def test_wait_insync(self):
+        self.addCleanup(setattr, PublishDNS, '_boto_r53',
+                        PublishDNS._boto_r53)
+        PublishDNS._boto_r53 = FakeChanges({'/change/C1': 1, '/change/C2': 3})
+        tracker = R53ChangeTracker(['/change/C1', '/change/C2'])
+        self.assertEqual(tracker.wait_insync(5), 0)
+        # C1 is only asked about until it is INSYNC
+        self.assertEqual(PublishDNS._boto_r53.calls, 4)
+        self.assertEqual([name for name, _ in tracker.phases], ['insync'])
+
+    def test_wait_insync_timeout(self):
+        self.addCleanup(setattr, PublishDNS, '_boto_r53',
+                        PublishDNS._boto_r53)
+        PublishDNS._boto_r53 = FakeChanges({'/change/C1': 1000})
+        self.assertEqual(R53ChangeTracker(['/change/C1']).wait_insync(0.2), -1)
+
+
+# a list_stack_resources() summary
+def stack_resource(logical_id, resource_type, physical_id):
+    return {'LogicalResourceId': logical_id, 'ResourceType': resource_type,
+            'PhysicalResourceId': physical_id}
+
+
+class FakePaginator:
+
+    def __init__(self, operation):
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+        return self.operation(**kwargs)
+
+
+# plays cloudformation, elb, elbv2, ecs and apigateway for one region, each
+# call takes latency secs. Stacks called multi-* have a classic ELB and an
+# NLB, two-* too but neither is called LoadBalancer, out-* name theirs in
+# their Outputs, and shared-* in Exports named after them. app-v2 exports
+# its LB as app-v2-..., which app must ignore.
+# ecs-* have an ECS service behind a target group and a listener on a
+# shared NLB, though ecs-nolb-* services have no load balancer, and api-*
+# an API Gateway custom domain
+class FakeRegion:
+
+    exceptions = botocore.exceptions
+
+    def __init__(self, region, latency):
+        self.region = region
+        self.latency = latency
+        self.describe_calls = 0
+        self.calls = []
+        self.updated = {}
+
+    def stack_id(self, name):
+        return ('arn:aws:cloudformation:' + self.region + ':1:stack/' + name
+                + '/1')
+
+    def describe_stacks(self, StackName):
+        time.sleep(self.latency)
+        self.calls.append('describe_stacks')
+        if StackName == 'missing':
+            raise botocore.exceptions.ClientError(
+                {'Error': {'Code': 'ValidationError',
+                           'Message': 'Stack with id missing does not exist'}},
+                'DescribeStacks')
+        stack = {'StackName': StackName, 'StackStatus': 'CREATE_COMPLETE',
+                 'StackId': self.stack_id(StackName),
+                 'CreationTime': datetime.datetime(2017, 11, 1)}
+        if StackName in self.updated:
+            stack['LastUpdatedTime'] = self.updated[StackName]
+        if StackName.startswith('out-'):
+            stack['Outputs'] = [
+                {'OutputKey': 'PublicALBDNSName',
+                 'OutputValue': StackName + '.alb.amazonaws.com'},
+                {'OutputKey': 'PublicALBCanonicalHostedZoneID',
+                 'OutputValue': 'ZALB'},
+                {'OutputKey': 'Url', 'OutputValue': 'http://' + StackName}]
+        return {'Stacks': [stack]}
+
+    def get_paginator(self, operation):
+        return FakePaginator(getattr(self, operation))
+
+    def list_exports(self):
+        time.sleep(self.latency)
+        self.calls.append('list_exports')
+        shared, green = [self.stack_id(name)
+                         for name in ('shared-1', 'app-v2')]
+        return [{'Exports': [
+                    {'Name': 'shared-1-DNSName',
+                     'Value': 'ingress.elb.amazonaws.com',
+                     'ExportingStackId': shared},
+                    {'Name': 'shared-1-CanonicalHostedZoneId',
+                     'Value': 'ZINGRESS', 'ExportingStackId': shared}]},
+                {'Exports': [
+                    {'Name': 'vpc-id', 'Value': 'vpc-1',
+                     'ExportingStackId': self.stack_id('vpc')},
+                    {'Name': 'app-v2-LoadBalancerDNSName',
+                     'Value': 'green.elb.amazonaws.com',
+                     'ExportingStackId': green},
+                    {'Name': 'app-v2-LoadBalancerCanonicalHostedZoneID',
+                     'Value': 'ZG', 'ExportingStackId': green}]}]
+
+    def list_stack_resources(self, StackName):
+        time.sleep(self.latency)
+        self.calls.append('list_stack_resources')
+        arn = ('arn:aws:elasticloadbalancing:' + self.region
+               + ':1:loadbalancer/net/' + StackName + '-nlb/abc')
+        pages = [[stack_resource('WebServerGroup',
+                                 'AWS::AutoScaling::AutoScalingGroup',
+                                 StackName + '-asg')],
+                 [stack_resource('LoadBalancer',
+                                 'AWS::ElasticLoadBalancing::LoadBalancer',
+                                 StackName + '-elb')]]
+        if StackName.startswith('multi-'):
+            pages.append([stack_resource(
+                'PublicNLB', 'AWS::ElasticLoadBalancingV2::LoadBalancer',
+                arn)])
+        elif StackName.startswith('two-'):
+            private = stack_resource(
+                'PrivateELB', 'AWS::ElasticLoadBalancing::LoadBalancer',
+                StackName + '-elb')
+            public = stack_resource(
+                'PublicNLB', 'AWS::ElasticLoadBalancingV2::LoadBalancer', arn)
+            pages = [[private, public]]
+        elif StackName.startswith('ecs-'):
+            listener = arn.replace(':loadbalancer/', ':listener/').replace(
+                StackName + '-nlb', 'shared-nlb') + '/def'
+            service = ('arn:aws:ecs:' + self.region + ':1:service/sandpit/'
+                       + StackName)
+            pages = [[stack_resource('Listener',
+                                     'AWS::ElasticLoadBalancingV2::Listener',
+                                     listener)],
+                     [stack_resource('Service', 'AWS::ECS::Service',
+                                     service)]]
+        elif StackName.startswith('api-'):
+            pages = [[stack_resource('Api', 'AWS::ApiGateway::RestApi',
+                                     'a1b2c3'),
+                      stack_resource('Domain', 'AWS::ApiGateway::DomainName',
+                                     StackName + '.example.com')]]
+        return [{'StackResourceSummaries': page} for page in pages]
+
+    def describe_services(self, cluster, services):
+        time.sleep(self.latency)
+        self.calls.append('describe_services')
+        found = []
+        for s in services:
+            name = s.split('/')[-1]
+            group = ('arn:aws:elasticloadbalancing:' + self.region
+                     + ':1:targetgroup/' + name + '/tg')
+            lbs = [] if 'nolb' in s else [{'targetGroupArn': group}]
+            if cluster == 'sandpit':
+                found.append({'serviceName': name, 'loadBalancers': lbs})
+        return {'services': found}
+
+    def describe_target_groups(self, TargetGroupArns):
+        time.sleep(self.latency)
+        self.calls.append('describe_target_groups')
+        return {'TargetGroups': [
+            {'TargetGroupArn': tg, 'LoadBalancerArns': [
+                tg.replace(':targetgroup/', ':loadbalancer/net/')
+                .replace('/tg', '-nlb/abc')]}
+            for tg in TargetGroupArns]}
+
+    def describe_listeners(self, ListenerArns):
+        time.sleep(self.latency)
+        self.calls.append('describe_listeners')
+        return {'Listeners': [
+            {'ListenerArn': arn, 'LoadBalancerArn':
+             arn.replace(':listener/', ':loadbalancer/')[:-len('/def')]}
+            for arn in ListenerArns]}
+
+    def get_domain_name(self, domainName):
+        time.sleep(self.latency)
+        self.calls.append('get_domain_name')
+        return {'domainName': domainName,
+                'regionalDomainName': 'd-1.execute-api.' + self.region
+                + '.amazonaws.com',
+                'regionalHostedZoneId': 'ZAPI'}
+
+    def describe_load_balancers(self, LoadBalancerNames=None,
+                                LoadBalancerArns=None):
+        time.sleep(self.latency)
+        self.describe_calls += 1
+        self.calls.append('describe_load_balancers')
+        if LoadBalancerArns:
+            return {'LoadBalancers': [{
+                'LoadBalancerArn': arn,
+                'DNSName': arn.split('/')[-2] + '.elb.' + self.region
+                + '.amazonaws.com',
+                'CanonicalHostedZoneId': 'ZNLB'} for arn in LoadBalancerArns]}
+        return {'LoadBalancerDescriptions': [{
+            'LoadBalancerName': name,
+            'DNSName': name + '.' + self.region + '.elb.amazonaws.com',
+            'CanonicalHostedZoneNameID': 'Z' + self.region.upper()}
+            for name in LoadBalancerNames]}
+
+
+class DiscoveryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(PublishDNS._boto_clients.clear)
+        self.addCleanup(PublishDNS._exports.clear)
+        self.regions = {}
+        for region in ('ap-southeast-2', 'us-east-1', 'eu-west-1'):
+            fake = FakeRegion(region, 0.1)
+            self.regions[region] = fake
+            for service in ('cloudformation', 'elb', 'elbv2', 'ecs',
+                            'apigateway'):
+                PublishDNS._boto_clients[(service, region)] = fake
+
+    def test_discover_stacks(self):
+        stacks = [(region, 'web-' + str(i)) for i in range(10)
+                  for region in ('ap-southeast-2', 'us-east-1', 'eu-west-1')]
+        stacks.append(('us-east-1', 'missing'))
+
+        start = time.time()
+        results = discover_stacks(stacks)
+        # 31 stacks, 3 calls of 0.1 secs each, done as about three rounds
+        self.assertLess(time.time() - start, 1.5)
+        # 10 classic ELBs per region, described in one call
+        self.assertEqual([f.describe_calls for f in self.regions.values()],
+                         [1, 1, 1])
+
+        self.assertEqual([(r['region'], r['stackname']) for r in results],
+                         [s[:2] for s in stacks])
+        self.assertEqual(results[1], {
+            'region': 'us-east-1', 'stackname': 'web-0',
+            'status': 'CREATE_COMPLETE', 'source': 'resources',
+            'kind': 'elb',
+            'stack_id': 'arn:aws:cloudformation:us-east-1:1:stack/web-0/1',
+            'updated': '2017-11-01 00:00:00', 'elb': 'web-0-elb',
+            'dns_name': 'web-0-elb.us-east-1.elb.amazonaws.com',
+            'zone_id': 'ZUS-EAST-1', 'error': None})
+        self.assertEqual(results[-1]['error'],
+                         'Stack with id missing does not exist')
+
+    def test_select_lb(self):
+        results = discover_stacks([('us-east-1', 'multi-1'),
+                                   ('us-east-1', 'multi-1', 'PublicNLB'),
+                                   ('us-east-1', 'multi-1', 'multi-1-nlb'),
+                                   ('us-east-1', 'multi-1', 'nope')])
+        self.assertEqual(results[0]['dns_name'],
+                         'multi-1-elb.us-east-1.elb.amazonaws.com')
+        self.assertEqual(results[1]['dns_name'],
+                         'multi-1-nlb.elb.us-east-1.amazonaws.com')
+        self.assertEqual(results[1]['zone_id'], 'ZNLB')
+        self.assertEqual(results[2]['elb'], results[1]['elb'])
+        self.assertEqual(results[3]['error'],
+                         'ELB not found, nope is not one of: '
+                         'LoadBalancer, PublicNLB')
+
+        results = discover_stacks([('us-east-1', 'two-1'),
+                                   ('us-east-1', 'two-1', 'PrivateELB')])
+        self.assertEqual(results[0]['error'],
+                         'stack has 2 load balancers, pick one with --elb: '
+                         'PrivateELB, PublicNLB')
+        self.assertEqual(results[1]['dns_name'],
+                         'two-1-elb.us-east-1.elb.amazonaws.com')
+
+    def test_endpoint_resolvers(self):
+        results = discover_stacks([('us-east-1', 'ecs-1'),
+                                   ('us-east-1', 'ecs-2', 'Listener'),
+                                   ('us-east-1', 'api-1'),
+                                   ('us-east-1', 'web-1')])
+        self.assertEqual(
+            [(r['kind'], r['dns_name'], r['zone_id']) for r in results],
+            [('ecs', 'ecs-1-nlb.elb.us-east-1.amazonaws.com', 'ZNLB'),
+             ('listener', 'shared-nlb.elb.us-east-1.amazonaws.com', 'ZNLB'),
+             ('apigateway-domain', 'd-1.execute-api.us-east-1.amazonaws.com',
+              'ZAPI'),
+             ('elb', 'web-1-elb.us-east-1.elb.amazonaws.com', 'ZUS-EAST-1')])
+        # one resource listing per stack, a region's services in one call
+        calls = self.regions['us-east-1'].calls
+        self.assertEqual(calls.count('list_stack_resources'), 4)
+        self.assertEqual(calls.count('describe_services'), 1)
+
+        results = discover_stacks([('us-east-1', 'ecs-nolb-1', 'Service')])
+        self.assertEqual(results[0]['error'], 'service has no load balancer:'
+                         'arn:aws:ecs:us-east-1:1:service/sandpit/ecs-nolb-1')
+
+        endpoints = PublishDNS.describe_stack_endpoints('us-east-1', 'ecs-3')
+        self.assertEqual(
+            [(e['logical_id'], e['name'], e['kind'], e['dns_name'])
+             for e in endpoints],
+            [('Listener', 'shared-nlb', 'listener',
+              'shared-nlb.elb.us-east-1.amazonaws.com'),
+             ('Service', 'ecs-3', 'ecs',
+              'ecs-3-nlb.elb.us-east-1.amazonaws.com')])
+
+    def test_outputs_and_exports(self):
+        results = discover_stacks([('us-east-1', 'out-1'),
+                                   ('us-east-1', 'out-2', 'PublicALB'),
+                                   ('us-east-1', 'shared-1'),
+                                   ('us-east-1', 'out-3', 'LoadBalancer'),
+                                   ('us-east-1', 'app'),
+                                   ('us-east-1', 'app-v2')])
+        self.assertEqual(
+            [(r['source'], r['elb'], r['dns_name'], r['zone_id'])
+             for r in results],
+            [('outputs', 'PublicALBDNSName', 'out-1.alb.amazonaws.com',
+              'ZALB'),
+             ('outputs', 'PublicALBDNSName', 'out-2.alb.amazonaws.com',
+              'ZALB'),
+             ('exports', 'DNSName', 'ingress.elb.amazonaws.com', 'ZINGRESS'),
+             ('resources', 'out-3-elb',
+              'out-3-elb.us-east-1.elb.amazonaws.com', 'ZUS-EAST-1'),
+             # app-v2's exports start with "app-" but aren't app's
+             ('resources', 'app-elb', 'app-elb.us-east-1.elb.amazonaws.com',
+              'ZUS-EAST-1'),
+             ('exports', 'LoadBalancerDNSName', 'green.elb.amazonaws.com',
+              'ZG')])
+        # the exports are listed once, for all the stacks that needed them
+        self.assertEqual(
+            self.regions['us-east-1'].calls.count('list_exports'), 1)
+
+    def test_stack_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.addCleanup(PublishDNS._stack_caches.clear)
+        cache_file = os.path.join(cache_dir, 'stacks.json')
+        fake = self.regions['us-east-1']
+
+        first = discover_stacks([('us-east-1', 'web-1')],
+                                cache_file=cache_file)[0]
+        self.assertEqual(len(fake.calls), 4)
+        # a new run, same stack, just the describe_stacks
+        PublishDNS._stack_caches.clear()
+        PublishDNS._exports.clear()
+        fake.calls = []
+        again = discover_stacks([('us-east-1', 'web-1')],
+                                cache_file=cache_file)[0]
+        self.assertEqual(fake.calls, ['describe_stacks'])
+        self.assertEqual(again, dict(first, source='cache'))
+
+        # an update to the stack and it's looked up again
+        fake.updated['web-1'] = datetime.datetime(2017, 12, 1)
+        fake.calls = []
+        discover_stacks([('us-east-1', 'web-1')], cache_file=cache_file)
+        self.assertIn('list_stack_resources', fake.calls)
+        with open(cache_file) as f:
+            self.assertEqual(list(json.load(f).values())[0]['updated'],
+                             '2017-12-01 00:00:00')
+
+
+# keeps every ChangeBatch sent, changes are INSYNC straight away
+class FakeChangeBatches:
+
+    def __init__(self):
+        self.batches = []
+
+    def change_resource_record_sets(self, HostedZoneId, ChangeBatch):
+        self.batches.append(ChangeBatch)
+        sent = str(len(self.batches))
+        return {'ResponseMetadata': {'HTTPStatusCode': 200,
+                                     'RequestId': 'R' + sent},
+                'ChangeInfo': {'Id': '/change/C' + sent, 'Status': 'PENDING'}}
+
+    def get_change(self, Id):
+        return {'ChangeInfo': {'Id': Id, 'Status': 'INSYNC'}}
+
+    def sent(self):
+        return [(c['ResourceRecordSet']['ResourceRecords'][0]['Value']
+                 .rstrip('.'), c['ResourceRecordSet']['TTL'])
+                for b in self.batches for c in b['Changes']]
+
+
+class TTLRampTest(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(setattr, PublishDNS, '_boto_r53',
+                        PublishDNS._boto_r53)
+        PublishDNS._boto_r53 = FakeChangeBatches()
+        fd, self.state_file = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        os.remove(self.state_file)
+        self.dns_rec = DNSCNameRecord('www.example.com')
+        self.dns_rec.zoneid = 'Z1'
+        self.dns_rec._cname_target = 'blue.elb.amazonaws.com'
+        self.dns_rec.ttl = 1
+        self.dns_rec.orignalttl = 1
+
+    def test_ramp(self):
+        start = time.time()
+        self.assertEqual(ttl_ramp_cutover(self.dns_rec,
+                                          'green.elb.amazonaws.com', 0, 0,
+                                          self.state_file), 0)
+        # the old 1sec TTL is waited out before the cutover
+        self.assertGreaterEqual(time.time() - start, 1)
+        self.assertEqual(PublishDNS._boto_r53.sent(),
+                         [('blue.elb.amazonaws.com', 0),
+                          ('green.elb.amazonaws.com', 0),
+                          ('green.elb.amazonaws.com', 1)])
+        self.assertFalse(os.path.exists(self.state_file))
+
+    def test_short_already(self):
+        self.dns_rec.ttl = self.dns_rec.orignalttl = 30
+        start = time.time()
+        ttl_ramp_cutover(self.dns_rec, 'green.elb.amazonaws.com', 60, 0,
+                         self.state_file)
+        # not lowered, so there's no old TTL to wait out
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(PublishDNS._boto_r53.sent(),
+                         [('green.elb.amazonaws.com', 60),
+                          ('green.elb.amazonaws.com', 30)])
+
+    def test_interrupted_lowering(self):
+        # the run dies waiting for the lowered TTL to go INSYNC
+        wait_for_change = PublishDNS.wait_for_change
+        self.addCleanup(setattr, PublishDNS, 'wait_for_change',
+                        wait_for_change)
+        PublishDNS.wait_for_change = \
+            lambda dns_rec: PublishDNS.bail('interrupted')
+        with self.assertRaises(PublishDNS.PublishError):
+            ttl_ramp_cutover(self.dns_rec, 'green.elb.amazonaws.com', 0, 0,
+                             self.state_file)
+        PublishDNS.wait_for_change = wait_for_change
+
+        # the rerun finds the short TTL in Route53, the original in the state
+        self.dns_rec.ttl = self.dns_rec.orignalttl = 0
+        with open(self.state_file) as f:
+            self.assertEqual(json.load(f)['original_ttl'], 1)
+        ttl_ramp_cutover(self.dns_rec, 'green.elb.amazonaws.com', 0, 0,
+                         self.state_file)
+        self.assertEqual(PublishDNS._boto_r53.sent()[-1],
+                         ('green.elb.amazonaws.com', 1))
+
+    def test_resume(self):
+        with open(self.state_file, 'w') as f:
+            json.dump({'name': 'www.example.com',
+                       'target': 'green.elb.amazonaws.com',
+                       'old_target': 'blue.elb.amazonaws.com',
+                       'original_ttl': 3600, 'short_ttl': 10,
+                       'phase': 'flipped', 'lowered_at': 0,
+                       'flipped_at': time.time() - 60}, f)
+        self.dns_rec._cname_target = 'green.elb.amazonaws.com'
+        self.dns_rec.ttl = 10
+        self.assertEqual(ttl_ramp_cutover(self.dns_rec,
+                                          'green.elb.amazonaws.com', 10, 30,
+                                          self.state_file), 0)
+        self.assertEqual(PublishDNS._boto_r53.sent(),
+                         [('green.elb.amazonaws.com', 3600)])
+
+
+class WeightedShiftTest(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(setattr, PublishDNS, '_boto_r53',
+                        PublishDNS._boto_r53)
+        PublishDNS._boto_r53 = FakeChangeBatches()
+        self.dns_rec = DNSCNameRecord('www.example.com')
+        self.dns_rec.zoneid = 'Z1'
+        self.dns_rec._cname_target = 'blue.elb.amazonaws.com'
+        self.dns_rec.ttl = 60
+
+    def batches(self):
+        return [[(c['Action'], c['ResourceRecordSet'].get('SetIdentifier'),
+                  c['ResourceRecordSet'].get('Weight')) for c in b['Changes']]
+                for b in PublishDNS._boto_r53.batches]
+
+    def test_shift(self):
+        self.assertEqual(weighted_shift(self.dns_rec,
+                                        'green.elb.amazonaws.com', 'green-v2',
+                                        'blue.elb.amazonaws.com', 'blue-v1',
+                                        [25, 100], 0, 'true'), 0)
+        self.assertEqual(self.batches(), [
+            [('DELETE', None, None), ('UPSERT', 'blue-v1', 100),
+             ('UPSERT', 'green-v2', 0)],
+            [('UPSERT', 'blue-v1', 75), ('UPSERT', 'green-v2', 25)],
+            [('UPSERT', 'blue-v1', 0), ('UPSERT', 'green-v2', 100)],
+            [('DELETE', 'blue-v1', 0), ('DELETE', 'green-v2', 100),
+             ('UPSERT', None, None)]])
+        self.assertEqual(PublishDNS._boto_r53.sent()[-1],
+                         ('green.elb.amazonaws.com', 60))
+
+    def test_rollback(self):
+        self.assertEqual(weighted_shift(self.dns_rec,
+                                        'green.elb.amazonaws.com', 'green-v2',
+                                        'blue.elb.amazonaws.com', 'blue-v1',
+                                        [5, 50, 100], 0, 'false'), -1)
+        self.assertEqual(self.batches()[-1],
+                         [('DELETE', 'blue-v1', 95), ('DELETE', 'green-v2', 5),
+                          ('UPSERT', None, None)])
+        self.assertEqual(PublishDNS._boto_r53.sent()[-1],
+                         ('blue.elb.amazonaws.com', 60))
+
+
+class InstrumentationTest(unittest.TestCase):
+
+    def setUp(self):
+        PublishDNS._span_totals.clear()
+        PublishDNS._counters.clear()
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def test_event_log(self):
+        PublishDNS._event_log = open(self.path, 'w')
+        self.addCleanup(setattr, PublishDNS, '_event_log', None)
+        with span('zone_lookup', zone='example.com'):
+            time.sleep(0.01)
+        with self.assertRaises(PublishDNS.PublishError):
+            with span('upsert'):
+                PublishDNS.bail('AWS rejected update')
+        PublishDNS._event_log.close()
+
+        with open(self.path) as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual([(e['event'], e['span']) for e in events],
+                         [('span_start', 'zone_lookup'),
+                          ('span_end', 'zone_lookup'),
+                          ('span_start', 'upsert'), ('span_end', 'upsert')])
+        self.assertEqual(events[1]['zone'], 'example.com')
+        self.assertGreaterEqual(events[1]['secs'], 0.01)
+        self.assertEqual([e['ok'] for e in events[1::2]], [True, False])
+
+    def test_metrics_file(self):
+        with span('upsert'):
+            pass
+        count_aws_call('after-call.route53.GetChange')
+        count_aws_call('after-call.route53.GetChange')
+        throttled = {'Error': {'Code': 'Throttling'}}
+        count_aws_throttle('needs-retry.route53.GetChange',
+                           response=(None, throttled))
+        count_aws_throttle('needs-retry.route53.GetChange',
+                           response=(None, {}))
+        write_metrics_file(self.path)
+
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        self.assertIn('publishdns_aws_calls_total'
+                      '{operation="route53.GetChange"} 2', lines)
+        self.assertIn('publishdns_aws_throttles_total'
+                      '{operation="route53.GetChange"} 1', lines)
+        self.assertIn('publishdns_phase_count{phase="upsert"} 1', lines)
+
+
+class ReadinessTest(unittest.TestCase):
+
+    def test_resolve(self):
+        self.assertEqual(poll_for_resolve('localhost', 1), 0)
+        start = time.time()
+        self.assertEqual(poll_for_resolve('nothere.invalid', 1), -1)
+        self.assertLess(time.time() - start, 3)
+
+    def test_tcp_ready(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        self.addCleanup(listener.close)
+        self.assertEqual(poll_for_resolve('127.0.0.1', 0.5, port), -1)
+
+        # starts listening while being polled
+        threading.Timer(0.3, listener.listen).start()
+        start = time.time()
+        self.assertEqual(poll_for_resolve('127.0.0.1', 5, port), 0)
+        self.assertLess(time.time() - start, 2)
+
+
+# stack events, newest first, 2 to a page. Every describe of a stack adds
+# the next status scripted for it, a stack is missing until its first event.
+# The (stack, nth describe) in unreachable can't connect
+class FakeStackEvents:
+
+    exceptions = botocore.exceptions
+
+    def __init__(self, script):
+        self.events = {}
+        self.script = script
+        self.pages_read = 0
+        self.unreachable = set()
+        self.describes = {}
+
+    def get_paginator(self, operation):
+        assert operation == 'describe_stack_events'
+        return self
+
+    def add_event(self, stack, status):
+        stack_events = self.events.setdefault(stack, [])
+        stack_events.insert(0, {
+            'EventId': stack + '-' + str(len(stack_events)),
+            'LogicalResourceId': stack, 'StackName': stack,
+            'ResourceType': 'AWS::CloudFormation::Stack',
+            'ResourceStatus': status})
+
+    def paginate(self, StackName):
+        self.describes[StackName] = self.describes.get(StackName, 0) + 1
+        if (StackName, self.describes[StackName]) in self.unreachable:
+            raise botocore.exceptions.EndpointConnectionError(
+                endpoint_url='https://cloudformation.us-east-1.amazonaws.com')
+        if self.script.get(StackName):
+            self.add_event(StackName, self.script[StackName].pop(0))
+        if StackName not in self.events:
+            raise botocore.exceptions.ClientError(
+                {'Error': {'Code': 'ValidationError',
+                           'Message': 'Stack [' + StackName
+                           + '] does not exist'}},
+                'DescribeStackEvents')
+        stack_events = self.events[StackName]
+        for i in range(0, len(stack_events), 2):
+            self.pages_read += 1
+            yield {'StackEvents': stack_events[i:i + 2]}
+
+
+class WatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(PublishDNS._boto_clients.clear)
+
+    # a manifest of (stackname, DNSTarget) in us-east-1
+    def write_manifest(self, entries):
+        fd, manifest = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'w') as f:
+            f.write('stackname,DNSTarget,AWSRegion\n')
+            for stack, target in entries:
+                f.write(stack + ',' + target + ',us-east-1\n')
+        self.addCleanup(os.remove, manifest)
+        return manifest
+
+    def test_new_stack_events(self):
+        fake = FakeStackEvents({'web': ['CREATE_IN_PROGRESS']})
+        PublishDNS._boto_clients[('cloudformation', 'us-east-1')] = fake
+        events, cursor = new_stack_events('us-east-1', 'web', None)
+        self.assertEqual((events[-1]['EventId'], cursor), ('web-0', 'web-0'))
+        for _ in range(4):
+            fake.add_event('web', 'CREATE_IN_PROGRESS')
+        fake.pages_read = 0
+        events, cursor = new_stack_events('us-east-1', 'web', cursor)
+        self.assertEqual([e['EventId'] for e in events],
+                         ['web-1', 'web-2', 'web-3', 'web-4'])
+        self.assertEqual(cursor, 'web-4')
+        self.assertEqual(fake.pages_read, 3)
+        self.assertEqual(new_stack_events('us-east-1', 'nope', None),
+                         ([], ''))
+
+    def test_watch_stacks(self):
+        fake = FakeStackEvents({'green': ['CREATE_IN_PROGRESS',
+                                          'CREATE_COMPLETE']})
+        fake.add_event('blue', 'CREATE_COMPLETE')
+        PublishDNS._boto_clients[('cloudformation', 'us-east-1')] = fake
+        manifest = self.write_manifest([('blue', 'www.example.com'),
+                                        ('green', 'api.example.com')])
+
+        published = []
+
+        class FakePublisher:
+            region = 'us-east-1'
+
+            def publish_entries(self, entries):
+                published.extend(e['DNSTarget'] for e in entries)
+        watch_stacks(manifest, FakePublisher(), interval=0, max_polls=3)
+        # blue was complete before the watch started, green completes
+        # during it
+        self.assertEqual(published, ['api.example.com'])
+
+    def test_watch_unreachable(self):
+        fake = FakeStackEvents({'green': ['CREATE_IN_PROGRESS',
+                                          'CREATE_COMPLETE']})
+        fake.add_event('blue', 'CREATE_COMPLETE')
+        PublishDNS._boto_clients[('cloudformation', 'us-east-1')] = fake
+        manifest = self.write_manifest([('blue', 'www.example.com'),
+                                        ('green', 'api.example.com')])
+
+        published = []
+
+        class FakePublisher:
+            region = 'us-east-1'
+
+            def publish_entries(self, entries):
+                published.extend(e['DNSTarget'] for e in entries)
+        warnings = []
+        self.addCleanup(setattr, PublishDNS, 'warning', PublishDNS.warning)
+        PublishDNS.warning = warnings.append
+
+        # blue's first look and green's second poll can't connect. blue was
+        # complete before the watch, green completes on the third poll
+        fake.unreachable = {('blue', 1), ('green', 2)}
+        watch_stacks(manifest, FakePublisher(), interval=0, max_polls=4)
+        self.assertEqual(published, ['api.example.com'])
+        self.assertEqual(len(warnings), 2)
+        self.assertTrue(warnings[0].startswith(
+            'unable to read events for stack blue: Could not connect'))
+
+    def test_watch_publish_fails(self):
+        fake = FakeStackEvents({'green': ['CREATE_IN_PROGRESS',
+                                          'CREATE_COMPLETE']})
+        PublishDNS._boto_clients[('cloudformation', 'us-east-1')] = fake
+        manifest = self.write_manifest([('green', 'www.example.com'),
+                                        ('green', 'api.example.com')])
+
+        published = []
+
+        # Route53 turns www down, not a PublishError
+        class FakePublisher:
+            region = 'us-east-1'
+
+            def publish_entries(self, entries):
+                if entries[0]['DNSTarget'] == 'www.example.com':
+                    raise botocore.exceptions.ClientError(
+                        {'Error': {'Code': 'InvalidChangeBatch',
+                                   'Message': 'RRSet exists'}},
+                        'ChangeResourceRecordSets')
+                published.extend(e['DNSTarget'] for e in entries)
+        warnings = []
+        self.addCleanup(setattr, PublishDNS, 'warning', PublishDNS.warning)
+        PublishDNS.warning = warnings.append
+        watch_stacks(manifest, FakePublisher(), interval=0, max_polls=3)
+        self.assertEqual(published, ['api.example.com'])
+        self.assertEqual(warnings[0],
+                         'ClientError: An error occurred (InvalidChangeBatch) '
+                         'when calling the ChangeResourceRecordSets '
+                         'operation: RRSet exists')
+
+
+# every name resolves, to localhost
+class FakeDNSBackend(InProcessDNS):
+
+    async def resolve(self, host, port=None):
+        return ['127.0.0.1']
+
+
+# Route53 for whole publishes: one zone, no records yet, changes INSYNC at
+# once
+class FakePublishRoute53(FakeChangeBatches):
+
+    def list_resource_record_sets(self, HostedZoneId, StartRecordName,
+                                  StartRecordType, MaxItems):
+        return {'ResourceRecordSets': [], 'IsTruncated': False}
+
+
+class PublisherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(setattr, PublishDNS, '_boto_r53',
+                        PublishDNS._boto_r53)
+        PublishDNS._boto_r53 = FakePublishRoute53()
+        PublishDNS._zone_index = {'example.com.': 'Z1'}
+        PublishDNS._dns_backend = FakeDNSBackend()
+        PublishDNS._record_cache.clear()
+        for region in ('us-east-1', 'eu-west-1'):
+            fake = FakeRegion(region, 0.1)
+            for service in ('cloudformation', 'elb', 'elbv2'):
+                PublishDNS._boto_clients[(service, region)] = fake
+        self.addCleanup(PublishDNS._boto_clients.clear)
+        self.addCleanup(PublishDNS._exports.clear)
+        self.addCleanup(setattr, PublishDNS, '_zone_index', None)
+        self.addCleanup(setattr, PublishDNS, '_dns_backend', None)
+
+    def test_lazy_boto3(self):
+        out = run_os_command([sys.executable, '-c',
+                              'import sys, PublishDNS; '
+                              'print("boto3" in sys.modules)'])
+        self.assertEqual(out, 'False\n')
+
+    def test_concurrent_publish(self):
+        cname = Publisher('us-east-1', confirm=False)
+        alias = Publisher('eu-west-1', alias_types=['A'], confirm=False)
+
+        async def publish_both():
+            return await asyncio.gather(
+                cname.publish_async('web-v2', 'www.example.com'),
+                alias.publish_async('multi-v2', 'example.com'))
+        start = time.time()
+        www, apex = asyncio.run(publish_both())
+        self.assertLess(time.time() - start, 1.5)
+
+        self.assertEqual((www['name'], www['target'], www['zone_id']),
+                         ('www.example.com',
+                          'web-v2-elb.us-east-1.elb.amazonaws.com', 'Z1'))
+        self.assertEqual(apex['target'],
+                         'multi-v2-elb.eu-west-1.elb.amazonaws.com')
+        changes = dict((c['ResourceRecordSet']['Name'], c['ResourceRecordSet'])
+                       for b in PublishDNS._boto_r53.batches
+                       for c in b['Changes'])
+        self.assertEqual(changes['www.example.com.']['ResourceRecords'],
+                         [{'Value': 'web-v2-elb.us-east-1.elb.amazonaws.com'}])
+        self.assertEqual(
+            changes['example.com.']['AliasTarget']['HostedZoneId'],
+            'ZEU-WEST-1')
+
+    def test_publisher_files(self):
+        files = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, files)
+        self.addCleanup(PublishDNS._stack_caches.clear)
+        journal_file = os.path.join(files, 'journal.jsonl')
+        publisher = Publisher('us-east-1', confirm=False,
+                              journal_file=journal_file,
+                              stack_cache_file=os.path.join(files,
+                                                            'stacks.json'))
+        other = Publisher('us-east-1', confirm=False)
+
+        www = publisher.publish('web-v2', 'www.example.com')
+        self.assertIsNone(
+            other.publish('web-v2', 'api.example.com')['journal_run'])
+        with open(journal_file) as f:
+            self.assertEqual([json.loads(line)['run'] for line in f],
+                             [www['journal_run']])
+        self.assertTrue(os.path.exists(publisher.stack_cache_file))
+
+    def test_errors(self):
+        publisher = Publisher('us-east-1', confirm=False)
+        with self.assertRaises(PublishDNS.StackError):
+            publisher.publish('missing', 'www.example.com')
+        with self.assertRaises(PublishDNS.ZoneError):
+            publisher.publish('web-v2', 'www.example.org')
+        self.assertEqual(PublishDNS._boto_r53.batches, [])
+
+    def test_warmup(self):
+        server = LocalHTTPServer()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://www.example.com:' + str(server.port)
+        publisher = Publisher('us-east-1', confirm=False,
+                              warmup_url=url + '/fail', warmup_requests=20)
+        with self.assertRaises(PublishDNS.HealthCheckError):
+            publisher.publish('web-v2', 'www.example.com')
+        self.assertEqual(PublishDNS._boto_r53.batches, [])
+
+        publisher.warmup_url = url + '/health'
+        www = publisher.publish('web-v2', 'www.example.com')
+        self.assertEqual(www['name'], 'www.example.com')
+        self.assertEqual(server.hosts,
+                         set(['www.example.com:' + str(server.port)]))
+
+
+# keep alive HTTP on every loopback address, requests to 127.0.0.2 take
+# 50ms. /fail is a 500, /chunked is sent in chunks
+class LocalHTTPServer(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 64
+
+    def __init__(self):
+        server = self
+        self.connections = 0
+        self.hosts = set()
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                http.server.BaseHTTPRequestHandler.setup(self)
+                server.connections += 1
+
+            def do_GET(self):
+                server.hosts.add(self.headers['Host'])
+                if self.connection.getsockname()[0] == '127.0.0.2':
+                    time.sleep(0.05)
+                if self.path == '/chunked':
+                    self.send_response(200)
+                    self.send_header('Transfer-Encoding', 'chunked')
+                    self.end_headers()
+                    self.wfile.write(b'3\r\nabc\r\n2\r\nde\r\n0\r\n\r\n')
+                    return
+                body = b'ok\n'
+                self.send_response(500 if self.path == '/fail' else 200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        http.server.ThreadingHTTPServer.__init__(self, ('', 0), Handler)
+        self.port = self.server_address[1]
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+# green is on 127.0.0.2, the slow one, live on 127.0.0.1
+class WarmupDNSBackend(InProcessDNS):
+
+    async def resolve(self, host, port=None):
+        return ['127.0.0.2' if host.startswith('green') else '127.0.0.1']
+
+
+class WarmupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalHTTPServer()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://www.example.com:' + str(self.server.port)
+        PublishDNS._dns_backend = WarmupDNSBackend()
+        self.addCleanup(setattr, PublishDNS, '_dns_backend', None)
+
+    def test_histogram(self):
+        histogram = LatencyHistogram()
+        for ms in range(1, 1001):
+            histogram.record(ms / 1000.0)
+        histogram.record(0.2, ok=False)
+        self.assertAlmostEqual(histogram.percentile(50), 0.5,
+                               delta=0.5 * 0.05)
+        self.assertAlmostEqual(histogram.percentile(99), 0.99,
+                               delta=0.99 * 0.05)
+        self.assertEqual((histogram.count, histogram.errors), (1001, 1))
+        # constant memory, ~150 buckets for 1ms..1s
+        self.assertLess(len(histogram.buckets), 200)
+
+    def test_keep_alive(self):
+        for path in ('/health', '/chunked'):
+            histogram = asyncio.run(drive_load(self.url + path, ['127.0.0.1'],
+                                               100, 5))
+            self.assertEqual((histogram.count, histogram.errors), (100, 0))
+        # 5 connections per run, each used for 20 requests
+        self.assertEqual(self.server.connections, 10)
+        histogram = asyncio.run(drive_load(self.url + '/fail', ['127.0.0.1'],
+                                           10, 2))
+        self.assertEqual(histogram.error_rate(), 1.0)
+
+    def test_gate(self):
+        # green 50ms a request, live ~1ms
+        failed = warmup_gate(self.url + '/health', 'green-elb', 'live-elb.',
+                             requests=20, concurrency=4, rounds=2)
+        self.assertEqual(len(failed), 1)
+        self.assertTrue(failed[0].startswith('p99 '))
+        self.assertEqual(warmup_gate(self.url + '/health', 'green-elb',
+                                     'live-elb.', requests=20, concurrency=4,
+                                     slo=100, rounds=1), [])
+        # no live to compare with, just errors
+        self.assertEqual(warmup_gate(self.url + '/health', 'green-elb',
+                                     requests=20), [])
+        self.assertEqual(warmup_gate(self.url + '/fail', 'green-elb',
+                                     requests=20, rounds=1),
+                         ['100.0% of requests failed'])
+
+
+# a CNAME record set, as Route53 lists it
+def cname_rrs(name, target, **extra):
+    rrs = {'Name': name, 'Type': 'CNAME', 'TTL': 60,
+           'ResourceRecords': [{'Value': target}]}
+    rrs.update(extra)
+    return rrs
+
+
+# one zone's record sets, in Route53's order, served a page at a time
+class FakeRecordSets:
+
+    def __init__(self, record_sets):
+        self.record_sets = sorted(record_sets, key=self.key)
+        self.calls = []
+
+    # where a record set sorts, and what a change to it replaces
+    @staticmethod
+    def key(rrs):
+        return (rrs['Name'], rrs['Type'], rrs.get('SetIdentifier', ''))
+
+    def list_resource_record_sets(self, HostedZoneId, StartRecordName='',
+                                  StartRecordType='',
+                                  StartRecordIdentifier='', MaxItems='300'):
+        self.calls.append(('list', StartRecordName, MaxItems))
+        keys = [self.key(r) for r in self.record_sets]
+        first = (StartRecordName, StartRecordType, StartRecordIdentifier)
+        start = 0
+        while start < len(keys) and keys[start] < first:
+            start += 1
+        end = start + int(MaxItems)
+        ret = {'ResourceRecordSets': self.record_sets[start:end],
+               'IsTruncated': end < len(keys)}
+        if ret['IsTruncated']:
+            ret['NextRecordName'], ret['NextRecordType'], ident = keys[end]
+            if ident:
+                ret['NextRecordIdentifier'] = ident
+        return ret
+
+    def get_paginator(self, operation):
+        assert operation == 'list_resource_record_sets'
+        return self
+
+    def paginate(self, HostedZoneId):
+        args = {}
+        while True:
+            ret = self.list_resource_record_sets(HostedZoneId, **args)
+            yield ret
+            if not ret['IsTruncated']:
+                return
+            args = {'StartRecordName': ret['NextRecordName'],
+                    'StartRecordType': ret['NextRecordType'],
+                    'StartRecordIdentifier':
+                    ret.get('NextRecordIdentifier', '')}
+
+    def get_hosted_zone(self, Id):
+        self.calls.append(('zone', Id, None))
+        return {'HostedZone': {'Id': Id, 'ResourceRecordSetCount':
+                               len(self.record_sets)}}
+
+
+# FakeRecordSets that takes changes, a DELETE must match what's there
+class FakeZone(FakeRecordSets):
+
+    def change_resource_record_sets(self, HostedZoneId, ChangeBatch):
+        self.calls.append(('change', len(ChangeBatch['Changes']), None))
+        records = dict((self.key(r), r) for r in self.record_sets)
+        for change in ChangeBatch['Changes']:
+            rrs = change['ResourceRecordSet']
+            if change['Action'] == 'DELETE':
+                assert records.pop(self.key(rrs)) == rrs, \
+                    'DELETE of a record that has changed'
+            else:
+                records[self.key(rrs)] = rrs
+        calls = self.calls
+        FakeRecordSets.__init__(self, records.values())
+        self.calls = calls
+        return {'ResponseMetadata': {'HTTPStatusCode': 200,
+                                     'RequestId': 'R1'},
+                'ChangeInfo': {'Id': '/change/C' + str(len(self.calls)),
+                               'Status': 'PENDING'}}
+
+    def get_change(self, Id):
+        return {'ChangeInfo': {'Id': Id, 'Status': 'INSYNC'}}
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.original = [
+            cname_rrs('api.example.com.', 'api-v1.elb'),
+            cname_rrs('www.example.com.', 'blue.elb', TTL=300,
+                      SetIdentifier='main', Weight=100, HealthCheckId='hc-1')]
+        self.addCleanup(setattr, PublishDNS, '_boto_r53',
+                        PublishDNS._boto_r53)
+        PublishDNS._boto_r53 = FakeZone(json.loads(json.dumps(self.original)))
+        PublishDNS._record_cache.clear()
+        journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journal_dir)
+        self.journal_file = os.path.join(journal_dir, 'journal.jsonl')
+
+    def publish(self):
+        journal = PublishDNS.new_journal_run(self.journal_file)
+        www = PublishDNS.weighted_cname_change('www.example.com.',
+                                               'green.elb', 'main', 100)
+        new = cname_change('new.example.com.', 'green.elb')
+        PublishDNS.update_r53_batch('Z1', [www, new], journal=journal)
+        api = DNSCNameRecord('api.example.com')
+        api.zoneid = 'Z1'
+        api.journal = journal
+        get_r53_cname_rec(api)
+        PublishDNS.update_r53_alias(api, 'api-v2.elb', 'ZELB', ['A'])
+        return journal.run
+
+    def runs(self):
+        with open(self.journal_file) as f:
+            return [json.loads(line)['run'] for line in f]
+
+    def test_rollback_run(self):
+        first = self.publish()
+        with open(self.journal_file) as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEqual([len(e['changes']) for e in entries], [2, 2])
+        self.assertEqual(entries[0]['changes'][0]['previous'],
+                         self.original[1])
+        self.assertIsNone(entries[0]['changes'][1]['previous'])
+
+        calls = len(PublishDNS._boto_r53.calls)
+        self.assertEqual(PublishDNS.rollback_run('last', self.journal_file),
+                         0)
+        # one ChangeBatch, nothing read
+        self.assertEqual(PublishDNS._boto_r53.calls[calls:],
+                         [('change', 4, None)])
+        self.assertEqual(PublishDNS._boto_r53.record_sets, self.original)
+
+        # a rollback is a run too, rolling it back publishes again
+        self.assertNotEqual(self.runs()[-1], first)
+        PublishDNS.rollback_run('last', self.journal_file)
+        self.assertEqual([(r['Name'], r['Type'])
+                          for r in PublishDNS._boto_r53.record_sets],
+                         [('api.example.com.', 'A'),
+                          ('new.example.com.', 'CNAME'),
+                          ('www.example.com.', 'CNAME')])
+
+    def test_rollback_record(self):
+        run = self.publish()
+        PublishDNS.rollback_run(run, self.journal_file, 'api.example.com')
+        names = sorted((r['Name'], r['Type'])
+                       for r in PublishDNS._boto_r53.record_sets)
+        self.assertEqual(names, [('api.example.com.', 'CNAME'),
+                                 ('new.example.com.', 'CNAME'),
+                                 ('www.example.com.', 'CNAME')])
+        with self.assertRaises(PublishDNS.PublishError):
+            PublishDNS.rollback_run('20170101T000000.000-1',
+                                    self.journal_file)
+
+    def test_concurrent_runs(self):
+        # two records published at once, as --watch does, are a run each
+        dns_recs = [DNSCNameRecord(name)
+                    for name in ('new.example.com', 'api.example.com')]
+        for dns_rec in dns_recs:
+            dns_rec.zoneid = 'Z1'
+            dns_rec.journal = PublishDNS.new_journal_run(self.journal_file)
+        for dns_rec in dns_recs:
+            PublishDNS.update_r53(dns_rec, 'green.elb')
+        runs = [dns_rec.journal.run for dns_rec in dns_recs]
+        self.assertNotEqual(runs[0], runs[1])
+        self.assertEqual(sorted(self.runs()), sorted(runs))
+
+        PublishDNS.rollback_run(runs[0], self.journal_file)
+        self.assertEqual(sorted((r['Name'], r['ResourceRecords'][0]['Value'])
+                                for r in PublishDNS._boto_r53.record_sets),
+                         [('api.example.com.', 'green.elb'),
+                          ('www.example.com.', 'blue.elb')])
+
+
+class RecordLookupTest(unittest.TestCase):
+
+    def setUp(self):
+        record_sets = [cname_rrs('host' + str(i) + '.example.com.',
+                                 'old.elb.amazonaws.com')
+                       for i in range(0, 1000)]
+        record_sets += [{'Name': 'www.example.com.', 'Type': 'A',
+                         'AliasTarget': {'HostedZoneId': 'ZELB',
+                                         'DNSName': 'elb.'}},
+                        cname_rrs('www.example.com.', 'blue.elb.amazonaws.com',
+                                  SetIdentifier='blue', Weight=90),
+                        cname_rrs('www.example.com.',
+                                  'green.elb.amazonaws.com',
+                                  SetIdentifier='green', Weight=10)]
+        self.addCleanup(setattr, PublishDNS, '_boto_r53',
+                        PublishDNS._boto_r53)
+        PublishDNS._boto_r53 = FakeRecordSets(record_sets)
+        PublishDNS._record_cache.clear()
+        self.addCleanup(PublishDNS._record_cache.clear)
+
+    def test_exact_lookup(self):
+        dns_rec = DNSCNameRecord('host500.example.com')
+        dns_rec.zoneid = 'Z1'
+        self.assertEqual(get_r53_cname_rec(dns_rec), 0)
+        self.assertEqual((dns_rec._cname_target, dns_rec.ttl),
+                         ('old.elb.amazonaws.com', 60))
+        self.assertEqual(PublishDNS._boto_r53.calls,
+                         [('list', 'host500.example.com.', '1')])
+
+        dns_rec = DNSCNameRecord('nothere.example.com')
+        dns_rec.zoneid = 'Z1'
+        self.assertEqual(get_r53_cname_rec(dns_rec), -1)
+
+        sets = lookup_r53_records('Z1', 'www.example.com.', 'CNAME')
+        self.assertEqual(sorted(sets), ['blue', 'green'])
+        self.assertEqual(sets['green'],
+                         (60, ('green.elb.amazonaws.com',), None, 10, None))
+        self.assertEqual(lookup_r53_records('Z1', 'www.example.com.', 'A'),
+                         {None: (None, (), ('ZELB', 'elb.'), None, None)})
+
+    def test_zone_cache(self):
+        # 2 exact lookups are cheaper than reading 4 pages, 20 are not
+        prefetch_zone_records('Z1', 2)
+        self.assertEqual(PublishDNS._record_cache, {})
+        prefetch_zone_records('Z1', 20)
+        self.assertEqual(len(PublishDNS._record_cache['Z1']), 1002)
+
+        PublishDNS._boto_r53.calls = []
+        for i in range(0, 20):
+            dns_rec = DNSCNameRecord('host' + str(i) + '.example.com')
+            dns_rec.zoneid = 'Z1'
+            self.assertEqual(get_r53_cname_rec(dns_rec), 0)
+        self.assertEqual(PublishDNS._boto_r53.calls, [])
+        self.assertEqual(sorted(lookup_r53_records('Z1', 'WWW.example.com.',
+                                                   'CNAME')),
+                         ['blue', 'green'])
+
+
+# plays route53, cloudformation, elb and elbv2 for drift scans, every list
+# is served a page at a time
+class FakeAccount:
+
+    def __init__(self, records, lbs, stacks, page_size=2):
+        self.records = records
+        self.lbs = lbs
+        self.stacks = stacks
+        self.page_size = page_size
+        self.operation = None
+
+    def get_paginator(self, operation):
+        fake = FakeAccount(self.records, self.lbs, self.stacks,
+                           self.page_size)
+        fake.operation = operation
+        return fake
+
+    def pages(self, key, items):
+        for i in range(0, max(len(items), 1), self.page_size):
+            yield {key: items[i:i + self.page_size]}
+
+    def paginate(self, HostedZoneId=None):
+        if self.operation == 'list_hosted_zones':
+            return self.pages('HostedZones', [{'Name': 'example.com.',
+                                               'Id': '/hostedzone/Z1'}])
+        if self.operation == 'list_resource_record_sets':
+            return self.pages('ResourceRecordSets', self.records)
+        if self.operation == 'list_stacks':
+            return self.pages('StackSummaries',
+                              [{'StackName': name, 'StackStatus': status}
+                               for name, status in self.stacks])
+        classic = [lb for lb in self.lbs if not lb[0].startswith('arn:')]
+        if classic == self.lbs:
+            return self.pages('LoadBalancerDescriptions', [
+                {'LoadBalancerName': name, 'DNSName': dns,
+                 'CanonicalHostedZoneNameID': 'ZELB'}
+                for name, dns, stack in classic])
+        return self.pages('LoadBalancers', [
+            {'LoadBalancerArn': arn, 'DNSName': dns,
+             'CanonicalHostedZoneId': 'ZNLB'}
+            for arn, dns, stack in self.lbs if arn.startswith('arn:')])
+
+    def describe_tags(self, LoadBalancerNames=None, ResourceArns=None):
+        assert len(LoadBalancerNames or ResourceArns) <= 20
+        key = 'LoadBalancerName' if LoadBalancerNames else 'ResourceArn'
+        names = LoadBalancerNames or ResourceArns
+        return {'TagDescriptions': [
+            {key: name, 'Tags': [{'Key': 'aws:cloudformation:stack-name',
+                                  'Value': stack}] if stack else []}
+            for name, dns, stack in self.lbs if name in names]}
+
+
+class DriftTest(unittest.TestCase):
+
+    def setUp(self):
+        records = [cname_rrs('www.example.com.',
+                             'web-v2-1.us-east-1.elb.amazonaws.com'),
+                   cname_rrs('old.example.com.',
+                             'web-v1-1.us-east-1.elb.amazonaws.com'),
+                   cname_rrs('gone.example.com.',
+                             'web-v0-1.us-east-1.elb.amazonaws.com'),
+                   cname_rrs('hand.example.com.',
+                             'manual-1.us-east-1.elb.amazonaws.com'),
+                   cname_rrs('eu.example.com.',
+                             'web-1.eu-west-1.elb.amazonaws.com'),
+                   cname_rrs('blog.example.com.', 'example.github.io'),
+                   {'Name': 'example.com.', 'Type': 'A',
+                    'AliasTarget': {'HostedZoneId': 'ZELB', 'DNSName':
+                                    'dualstack.api-nlb-1.elb.us-east-1'
+                                    '.amazonaws.com.'}},
+                   {'Name': 'api.example.com.', 'Type': 'A',
+                    'AliasTarget': {'HostedZoneId': 'ZNLB', 'DNSName':
+                                    'api-nlb-1.elb.us-east-1'
+                                    '.amazonaws.com.'}}]
+        nlb = ('arn:aws:elasticloadbalancing:us-east-1:1:loadbalancer/net/'
+               'api-nlb/1')
+        lbs = [('web-v2', 'web-v2-1.us-east-1.elb.amazonaws.com', 'web-v2'),
+               ('web-v1', 'web-v1-1.us-east-1.elb.amazonaws.com', 'web-v1'),
+               ('manual', 'manual-1.us-east-1.elb.amazonaws.com', None),
+               (nlb, 'api-nlb-1.elb.us-east-1.amazonaws.com', 'api-v3')]
+        stacks = [('web-v2', 'UPDATE_COMPLETE'),
+                  ('web-v1', 'DELETE_COMPLETE'),
+                  ('web-v1', 'DELETE_IN_PROGRESS'),
+                  ('api-v3', 'CREATE_COMPLETE')]
+        self.addCleanup(setattr, PublishDNS, '_boto_r53',
+                        PublishDNS._boto_r53)
+        PublishDNS._boto_r53 = FakeAccount(records, [], [])
+        for service, fake_lbs in (('elb', lbs[:3]), ('elbv2', lbs[3:])):
+            PublishDNS._boto_clients[(service, 'us-east-1')] = \
+                FakeAccount([], fake_lbs, [])
+        PublishDNS._boto_clients[('cloudformation', 'us-east-1')] = \
+            FakeAccount([], [], stacks)
+        PublishDNS._zone_index = None
+        self.addCleanup(setattr, PublishDNS, '_zone_cache_file',
+                        PublishDNS._zone_cache_file)
+        PublishDNS._zone_cache_file = None
+        self.addCleanup(setattr, PublishDNS, '_zone_index', None)
+        self.addCleanup(PublishDNS._boto_clients.clear)
+
+    def test_elb_hostname(self):
+        self.assertEqual(
+            elb_hostname('Web-1.ap-southeast-2.elb.amazonaws.com.'),
+            ('web-1.ap-southeast-2.elb.amazonaws.com', 'ap-southeast-2'))
+        self.assertEqual(
+            elb_hostname('dualstack.nlb-1.elb.us-east-1.amazonaws.com'),
+            ('nlb-1.elb.us-east-1.amazonaws.com', 'us-east-1'))
+        self.assertIsNone(elb_hostname('bucket.s3.amazonaws.com'))
+
+    def test_drift_scan(self):
+        manifest = [{'stackname': 'api-v2', 'DNSTarget': 'api.example.com',
+                     'AWSRegion': 'us-east-1', 'elb': None}]
+        report = drift_scan(['us-east-1'], manifest)
+
+        def reasons(kind):
+            return [(r['name'], r['reason']) for r in report[kind]]
+        self.assertEqual((report['zones'], report['records'],
+                          report['elb_records']), (1, 8, 7))
+        self.assertEqual((report['load_balancers'], report['ok'],
+                          report['unscanned']), (4, 1, 1))
+        self.assertEqual(reasons('dangling'),
+                         [('gone.example.com', 'no such load balancer')])
+        self.assertEqual(reasons('stale'),
+                         [('old.example.com', 'stack is DELETE_IN_PROGRESS'),
+                          ('hand.example.com',
+                           'load balancer was not made by CloudFormation')])
+        self.assertEqual(reasons('mismatched'),
+                         [('example.com', 'alias hosted zone is ZELB, '
+                           'the load balancer is in ZNLB'),
+                          ('api.example.com',
+                           'manifest has stack api-v2 in us-east-1')])
+        json.dumps(report)
+
+
+# canned Route53 replies, handed to botocore in place of the HTTP round trip
+class FakeHTTPBody:
+
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+THROTTLED_XML = (b'<?xml version="1.0"?><ErrorResponse '
+                 b'xmlns="https://route53.amazonaws.com/doc/2013-04-01/">'
+                 b'<Error><Type>Sender</Type><Code>Throttling</Code>'
+                 b'<Message>Rate exceeded</Message></Error>'
+                 b'<RequestId>r</RequestId></ErrorResponse>')
+INSYNC_XML = (b'<?xml version="1.0"?><GetChangeResponse '
+              b'xmlns="https://route53.amazonaws.com/doc/2013-04-01/">'
+              b'<ChangeInfo><Id>/change/C1</Id><Status>INSYNC</Status>'
+              b'<SubmittedAt>2020-01-01T00:00:00Z</SubmittedAt>'
+              b'</ChangeInfo></GetChangeResponse>')
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.retry_base = PublishDNS.R53_RETRY_BASE
+        PublishDNS.R53_RETRY_BASE = 0.01
+        self.addCleanup(setattr, PublishDNS, 'R53_RETRY_BASE',
+                        self.retry_base)
+        self.addCleanup(setattr, PublishDNS, '_boto_session', None)
+        self.addCleanup(setattr, PublishDNS, '_r53_limiter', None)
+        PublishDNS._boto_session = boto3.session.Session(
+            aws_access_key_id='x', aws_secret_access_key='y')
+
+    def test_token_bucket(self):
+        limiter = R53RateLimiter(rate=20)
+        start = time.time()
+        for i in range(0, 25):
+            limiter.acquire()
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        self.assertEqual(limiter.waits, 5)
+
+        limiter.throttled()
+        limiter.throttled()
+        self.assertEqual(limiter.rate, 5)
+        for i in range(0, 200):
+            limiter.succeeded()
+        self.assertEqual(limiter.rate, 20)
+
+    def test_retry_budget(self):
+        limiter = R53RateLimiter(budget=3, max_attempts=2)
+        self.assertIsNotNone(limiter.retry_delay(1))
+        self.assertIsNone(limiter.retry_delay(2))
+        self.assertIsNotNone(limiter.retry_delay(1))
+        self.assertIsNotNone(limiter.retry_delay(1))
+        self.assertIsNone(limiter.retry_delay(1))
+        # spent, until enough good calls earn one back
+        for _ in range(PublishDNS.R53_RETRY_EARN - 1):
+            limiter.succeeded()
+        self.assertIsNone(limiter.retry_delay(1))
+        limiter.succeeded()
+        self.assertIsNotNone(limiter.retry_delay(1))
+        self.assertIsNone(limiter.retry_delay(1))
+        for _ in range(100 * PublishDNS.R53_RETRY_EARN):
+            limiter.succeeded()
+        self.assertEqual(limiter.budget, 3)
+
+    def test_throttled_call(self):
+        replies = [(400, THROTTLED_XML), (400, THROTTLED_XML),
+                   (200, INSYNC_XML)]
+
+        def reply(request, **kwargs):
+            status, body = replies.pop(0)
+            return botocore.awsrequest.AWSResponse(request.url, status, {},
+                                                   FakeHTTPBody(body))
+        PublishDNS._r53_limiter = R53RateLimiter(budget=2)
+        r53 = PublishDNS.make_boto_client('route53', 'us-east-1')
+        r53.meta.events.register('before-send', reply)
+
+        self.assertEqual(r53.get_change(Id='C1')['ChangeInfo']['Status'],
+                         'INSYNC')
+        self.assertEqual(PublishDNS._r53_limiter.retries, 2)
+        self.assertLess(PublishDNS._r53_limiter.rate, PublishDNS.R53_RATE)
+
+        # the budget is spent, the next throttle goes back to the caller
+        replies[:] = [(400, THROTTLED_XML), (200, INSYNC_XML)]
+        with self.assertRaises(botocore.exceptions.ClientError):
+            r53.get_change(Id='C1')
+
+        # good calls earn retries back, so a long --watch keeps retrying
+        for _ in range(PublishDNS.R53_RETRY_EARN):
+            PublishDNS._r53_limiter.succeeded()
+        replies[:] = [(400, THROTTLED_XML), (200, INSYNC_XML)]
+        self.assertEqual(r53.get_change(Id='C1')['ChangeInfo']['Status'],
+                         'INSYNC')
+        self.assertEqual(PublishDNS._r53_limiter.retries, 3)
+        self.assertEqual(PublishDNS._r53_limiter.budget, 0)
+
+
 if __name__ == '__main__':
     unittest.main()